@@ -0,0 +1,290 @@
+"""Stand-in bitcoind JSON-RPC server serving synthetic regtest-like chain
+
+Every block has a coinbase and --txs transactions, every --big-every block
+has --big-txs transactions instead. Non-coinbase transactions form chains
+where each transaction spends output 0 of the previous one, chain is
+restarted from the coinbase after --history transactions, which gives deep
+colored-coin histories for prefetch.
+
+    python bench/fakebitcoind.py --blocks 100000 --latency 0.002
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import struct
+import sys
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+
+COLOR_VALUE = 10000
+REGTEST_BITS = 0x207fffff
+REGTEST_TARGET = 0x7fffff << (8 * (0x20 - 3))
+
+
+def dsha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def hash_encode(h):
+    return h[::-1].encode('hex')
+
+def hash_decode(h):
+    return h.decode('hex')[::-1]
+
+def varint(n):
+    if n < 0xfd:
+        return chr(n)
+    if n <= 0xffff:
+        return '\xfd' + struct.pack('<H', n)
+    return '\xfe' + struct.pack('<I', n)
+
+def serialize_tx(inputs, outputs):
+    """inputs: list of (prevhash, n, script), outputs: list of (value, script)"""
+    return ''.join([
+        struct.pack('<I', 1),
+        varint(len(inputs)),
+        ''.join(prevhash + struct.pack('<I', n) + varint(len(script)) + script + '\xff\xff\xff\xff'
+                for prevhash, n, script in inputs),
+        varint(len(outputs)),
+        ''.join(struct.pack('<Q', value) + varint(len(script)) + script
+                for value, script in outputs),
+        struct.pack('<I', 0),
+    ])
+
+def mine(header):
+    """Append nonce giving valid proof-of-work for regtest target"""
+    nonce = 0
+    while int(hash_encode(dsha256(header + struct.pack('<I', nonce))), 16) > REGTEST_TARGET:
+        nonce += 1
+    return header + struct.pack('<I', nonce)
+
+def merkle_root(hashes):
+    while len(hashes) > 1:
+        if len(hashes) % 2:
+            hashes.append(hashes[-1])
+        hashes = [dsha256(hashes[i] + hashes[i+1]) for i in xrange(0, len(hashes), 2)]
+    return hashes[0]
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super(RPCError, self).__init__(message)
+        self.code = code
+
+
+class Chain(object):
+    def __init__(self, blocks, txs=2, big_every=0, big_txs=2000, history=100):
+        self.txs_per_block = txs
+        self.big_every = big_every
+        self.big_txs = big_txs
+        self.history = history
+        self.headers = []
+        self.hashes = []
+        self.heights = {}
+        self.blocks = []
+        self.txs = {}
+        self.mempool = []
+        # (txhash, depth) of the last tx of current history chain
+        self._tip = None
+        self.generate(blocks)
+
+    @property
+    def height(self):
+        return len(self.headers) - 1
+
+    def _coinbase(self, height, tag):
+        return serialize_tx([('\x00' * 32, 0xffffffff, struct.pack('<I', height) + tag)],
+                            [(50 * 10**8, '\x51')])
+
+    def _history_tx(self, height, coinbase, i):
+        if self._tip is None or self._tip[1] >= self.history:
+            prev, depth = coinbase, 0
+        else:
+            prev, depth = self._tip
+        raw = serialize_tx([(prev, 0, struct.pack('<II', height, i))],
+                           [(COLOR_VALUE, '\x51')])
+        txhash = dsha256(raw)
+        self._tip = (txhash, depth + 1)
+        return txhash, raw
+
+    def generate(self, count, tag='x', mempool=()):
+        for _ in xrange(count):
+            height = len(self.headers)
+            raw = self._coinbase(height, tag)
+            coinbase = dsha256(raw)
+            block = [(coinbase, raw)]
+            ntxs = self.txs_per_block
+            if self.big_every and height and height % self.big_every == 0:
+                ntxs = self.big_txs
+            for i in xrange(ntxs):
+                block.append(self._history_tx(height, coinbase, i))
+            block.extend((hash_decode(txid), self.txs[txid][0]) for txid in mempool)
+            mempool = ()
+
+            prev = hash_decode(self.hashes[-1]) if self.hashes else '\x00' * 32
+            header = mine(struct.pack('<I', 1) + prev + merkle_root([h for h, _ in block]) +
+                          struct.pack('<II', 1231006505 + height * 600, REGTEST_BITS))
+            blockhash = hash_encode(dsha256(header))
+            txids = []
+            for txhash, raw in block:
+                txid = hash_encode(txhash)
+                self.txs[txid] = (raw, height)
+                txids.append(txid)
+            self.headers.append(header)
+            self.hashes.append(blockhash)
+            self.heights[blockhash] = height
+            self.blocks.append(txids)
+        return self.hashes[-count:] if count else []
+
+    def invalidate(self, height):
+        """Drop blocks from height, their txs are forgotten"""
+        while len(self.headers) > height:
+            self.headers.pop()
+            del self.heights[self.hashes.pop()]
+            for txid in self.blocks.pop():
+                self.txs.pop(txid, None)
+        self._tip = None
+
+
+class RPCResource(Resource):
+    isLeaf = True
+
+    def __init__(self, chain, latency=0, jitter=0):
+        Resource.__init__(self)
+        self.chain = chain
+        self.latency = latency
+        self.jitter = jitter
+
+    def render_POST(self, request):
+        try:
+            query = json.loads(request.content.read())
+        except ValueError:
+            request.setResponseCode(500)
+            return json.dumps({'result': None, 'error': {'code': -32700, 'message': 'Parse error'}, 'id': None})
+
+        if isinstance(query, list):
+            body = json.dumps([self._call(x) for x in query])
+        else:
+            response = self._call(query)
+            if response['error'] is not None:
+                request.setResponseCode(500)
+            body = json.dumps(response)
+
+        delay = self.latency + random.random() * self.jitter
+        if not delay:
+            return body
+        def finish():
+            if not request.finished:
+                request.write(body)
+                request.finish()
+        reactor.callLater(delay, finish)
+        return NOT_DONE_YET
+
+    def _call(self, query):
+        try:
+            method = getattr(self, 'rpc_' + query['method'], None)
+            if method is None:
+                raise RPCError(-32601, 'Method not found')
+            result = method(*query.get('params', []))
+            return {'result': result, 'error': None, 'id': query.get('id')}
+        except RPCError, e:
+            error = {'code': e.code, 'message': str(e)}
+        except Exception, e:
+            error = {'code': -1, 'message': str(e)}
+        return {'result': None, 'error': error, 'id': query.get('id')}
+
+    def _height(self, blockhash):
+        if blockhash not in self.chain.heights:
+            raise RPCError(-5, 'Block not found')
+        return self.chain.heights[blockhash]
+
+    def rpc_getblockcount(self):
+        return self.chain.height
+
+    def rpc_getblockhash(self, height):
+        if not 0 <= height <= self.chain.height:
+            raise RPCError(-8, 'Block height out of range')
+        return self.chain.hashes[height]
+
+    def rpc_getblockheader(self, blockhash, verbose=True):
+        height = self._height(blockhash)
+        if not verbose:
+            return self.chain.headers[height].encode('hex')
+        return {
+            'hash': blockhash,
+            'height': height,
+            'confirmations': self.chain.height - height + 1,
+            'previousblockhash': self.chain.hashes[height-1] if height else None,
+        }
+
+    def rpc_getblock(self, blockhash, verbose=True):
+        height = self._height(blockhash)
+        txids = self.chain.blocks[height]
+        if not verbose:
+            return (self.chain.headers[height] + varint(len(txids)) +
+                    ''.join(self.chain.txs[txid][0] for txid in txids)).encode('hex')
+        return {
+            'hash': blockhash,
+            'height': height,
+            'confirmations': self.chain.height - height + 1,
+            'tx': txids,
+            'previousblockhash': self.chain.hashes[height-1] if height else None,
+        }
+
+    def rpc_getrawtransaction(self, txid, verbose=0):
+        if txid not in self.chain.txs:
+            raise RPCError(-5, 'No information available about transaction')
+        raw, height = self.chain.txs[txid]
+        if not verbose:
+            return raw.encode('hex')
+        result = {'hex': raw.encode('hex'), 'txid': txid}
+        if height is not None:
+            result['blockhash'] = self.chain.hashes[height]
+            result['confirmations'] = self.chain.height - height + 1
+        return result
+
+    def rpc_getrawmempool(self):
+        return list(self.chain.mempool)
+
+    def rpc_sendrawtransaction(self, txhex):
+        raw = txhex.decode('hex')
+        txid = hash_encode(dsha256(raw))
+        if txid not in self.chain.txs:
+            self.chain.txs[txid] = (raw, None)
+            self.chain.mempool.append(txid)
+        return txid
+
+    def rpc_generate(self, count):
+        mempool, self.chain.mempool = self.chain.mempool, []
+        return self.chain.generate(count, tag='g', mempool=mempool)
+
+    def rpc_invalidateblock(self, blockhash):
+        self.chain.invalidate(self._height(blockhash))
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake bitcoind for benchmarks')
+    parser.add_argument('--port', type=int, default=18555)
+    parser.add_argument('--blocks', type=int, default=10000, help='chain length')
+    parser.add_argument('--txs', type=int, default=2, help='non-coinbase txs per block')
+    parser.add_argument('--big-every', type=int, default=0, help='every Nth block is large')
+    parser.add_argument('--big-txs', type=int, default=2000, help='txs in large blocks')
+    parser.add_argument('--history', type=int, default=100, help='length of tx chains')
+    parser.add_argument('--latency', type=float, default=0, help='added to every response (seconds)')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra latency (seconds)')
+    args = parser.parse_args()
+
+    chain = Chain(args.blocks, args.txs, args.big_every, args.big_txs, args.history)
+    reactor.listenTCP(args.port, Site(RPCResource(chain, args.latency, args.jitter)),
+                      interface='127.0.0.1')
+    print 'fakebitcoind: %d blocks on port %d' % (len(chain.headers), args.port)
+    sys.stdout.flush()
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Load generator for one server method
+
+Request parameters are sampled from the chain served by bitcoind (normally
+bench/fakebitcoind.py), so every request hits existing data.
+
+    python bench/load.py getmerkle --concurrency 20 --duration 10 --pid 1234
+"""
+
+import argparse
+import json
+import random
+import time
+import urllib2
+from StringIO import StringIO
+
+from twisted.internet import defer, reactor
+from twisted.web import client, http_headers
+
+
+class Targets(object):
+    """Random heights, blocks and txs of bitcoind chain"""
+
+    def __init__(self, bitcoind_url, height, samples=200):
+        self._url = bitcoind_url
+        self.height = height
+        self.blocks = []
+        heights = [random.randint(1, height) for _ in xrange(samples)]
+        hashes = self._call_batch([('getblockhash', [h]) for h in heights])
+        for block in self._call_batch([('getblock', [h]) for h in hashes]):
+            self.blocks.append((block['hash'], block['height'], block['tx']))
+        # fakebitcoind txs spend output 0 of previous tx in the block
+        genesis = self._call('getblock', [self._call('getblockhash', [1])])['tx'][1]
+        self.color_desc = 'obc:%s:0:1' % genesis
+
+    def _call(self, method, params):
+        return self._call_batch([(method, params)])[0]
+
+    def _call_batch(self, calls):
+        data = json.dumps([{'method': method, 'params': params, 'id': i}
+                           for i, (method, params) in enumerate(calls)])
+        responses = json.loads(urllib2.urlopen(urllib2.Request(self._url, data)).read())
+        for response in responses:
+            if response['error'] is not None:
+                raise Exception(response['error'])
+        return [x['result'] for x in sorted(responses, key=lambda x: x['id'])]
+
+    def block(self):
+        return random.choice(self.blocks)
+
+    def tx(self):
+        blockhash, height, txids = self.block()
+        return random.choice(txids), blockhash
+
+    def history_tip(self):
+        """Last tx of the block, the end of the longest history"""
+        return self.block()[2][-1]
+
+
+def _post(method, params):
+    return 'POST', '/', json.dumps({'method': method, 'params': params}), {}
+
+METHODS = {
+    'getblockcount':     lambda t: _post('getblockcount', {}),
+    'getheader':         lambda t: _post('getheader', {'height': random.randint(0, t.height)}),
+    'getheaders':        lambda t: _post('getheaders', {'start': random.randint(0, t.height), 'count': 2016}),
+    'getchunk':          lambda t: _post('getchunk', {'index': random.randint(0, t.height // 2016)}),
+    'chunk':             lambda t: ('GET', '/chunk/%d' % random.randint(0, t.height // 2016), None,
+                                    {'Accept-Encoding': ['gzip']}),
+    'getmerkle':         lambda t: _post('getmerkle', dict(zip(('txhash', 'blockhash'), t.tx()))),
+    'getmerkles':        lambda t: _post('getmerkles', {'txhashes': [t.tx()[0] for _ in xrange(20)]}),
+    'getrawtransaction': lambda t: _post('getrawtransaction', {'txhash': t.tx()[0]}),
+    'gettxblockhash':    lambda t: _post('gettxblockhash', {'txhash': t.tx()[0]}),
+    'prefetch':          lambda t: _post('prefetch', {'txhash': t.history_tip(), 'output_set': [0],
+                                                      'color_desc': t.color_desc, 'limit': 100}),
+}
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.first_error = None
+
+    def error(self, msg):
+        self.errors += 1
+        if self.first_error is None:
+            self.first_error = msg
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def memory(pid):
+    """Return (rss, peak rss) of process in kB from /proc"""
+    values = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                values[key] = int(value.split()[0])
+    return values.get('VmRSS'), values.get('VmHWM')
+
+
+@defer.inlineCallbacks
+def worker(agent, url, make_request, targets, stop_at, stats):
+    while time.time() < stop_at:
+        method, path, body, headers = make_request(targets)
+        producer = None if body is None else client.FileBodyProducer(StringIO(body))
+        start = time.time()
+        try:
+            response = yield agent.request(method, url.rstrip('/') + path,
+                                           http_headers.Headers(headers), producer)
+            data = yield client.readBody(response)
+            if response.code != 200:
+                stats.error('HTTP %d: %s' % (response.code, data[:200]))
+            elif method == 'POST' and json.loads(data)['error'] is not None:
+                stats.error(json.loads(data)['error'])
+        except Exception, e:
+            stats.error(repr(e))
+        stats.latencies.append(time.time() - start)
+
+
+@defer.inlineCallbacks
+def run(args, stats):
+    try:
+        targets = Targets(args.bitcoind, json.loads(urllib2.urlopen(urllib2.Request(
+            args.url, json.dumps({'method': 'getblockcount', 'params': {}}))).read())['result'])
+        pool = client.HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = args.concurrency
+        agent = client.Agent(reactor, pool=pool)
+        stop_at = time.time() + args.duration
+        start = time.time()
+        yield defer.gatherResults([
+            worker(agent, args.url, METHODS[args.method], targets, stop_at, stats)
+            for _ in xrange(args.concurrency)])
+        stats.elapsed = time.time() - start
+        yield pool.closeCachedConnections()
+    except Exception, e:
+        stats.first_error = repr(e)
+    finally:
+        reactor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load one server method')
+    parser.add_argument('method', choices=sorted(METHODS))
+    parser.add_argument('--url', default='http://127.0.0.1:28832/')
+    parser.add_argument('--bitcoind', default='http://127.0.0.1:18555/',
+                        help='fakebitcoind url, used to pick request parameters')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--pid', type=int, help='server pid for memory usage')
+    parser.add_argument('--json', action='store_true', help='print result as JSON')
+    args = parser.parse_args()
+
+    stats = Stats()
+    stats.elapsed = None
+    reactor.callWhenRunning(run, args, stats)
+    reactor.run()
+    if stats.elapsed is None:
+        raise SystemExit('benchmark failed: %s' % stats.first_error)
+
+    result = {
+        'method':   args.method,
+        'requests': len(stats.latencies),
+        'errors':   stats.errors,
+        'rps':      len(stats.latencies) / stats.elapsed,
+        'p50_ms':   stats.percentile(0.5) * 1000 if stats.latencies else None,
+        'p99_ms':   stats.percentile(0.99) * 1000 if stats.latencies else None,
+        'error':    stats.first_error,
+    }
+    if args.pid:
+        result['rss_kb'], result['peak_rss_kb'] = memory(args.pid)
+    if args.json:
+        print json.dumps(result)
+        return
+
+    print '%(method)s: %(requests)d requests, %(errors)d errors, %(rps).1f req/s' % result
+    if stats.latencies:
+        print '  p50 %(p50_ms).2f ms  p99 %(p99_ms).2f ms' % result
+    if args.pid:
+        print '  server rss %(rss_kb)d kB, peak %(peak_rss_kb)d kB' % result
+    if stats.first_error is not None:
+        print '  first error: %(error)s' % result
+
+if __name__ == '__main__':
+    main()
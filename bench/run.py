@@ -0,0 +1,153 @@
+"""Run the benchmark suite against a fresh server and fake bitcoind
+
+Starts bench/fakebitcoind.py and server.py with a throwaway store, measures
+initial header sync, then loads every method in turn and prints a table of
+throughput, latency and server memory.
+
+    python bench/run.py --blocks 50000 --latency 0.001 --duration 10
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+CONFIG = """\
+[server]
+host = 127.0.0.1
+port = %(port)d
+threads = %(threads)d
+workers = %(workers)d
+
+[store]
+path = %(store)s
+
+[logging]
+logging = True
+filename = %(store)s/server.log
+level = warning
+
+[bitcoind]
+host = 127.0.0.1
+port = %(bitcoind_port)d
+user = bench
+password = bench
+
+[sync]
+# fakebitcoind mines regtest difficulty
+pow_limit = 207fffff
+
+[txindex]
+enabled = %(txindex)s
+"""
+
+
+def call(url, method, params):
+    request = urllib2.Request(url, json.dumps({'method': method, 'params': params}))
+    return json.loads(urllib2.urlopen(request, timeout=10).read())['result']
+
+
+def wait_for(test, timeout, what):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if test():
+                return
+        except Exception:
+            pass
+        time.sleep(0.05)
+    raise SystemExit('timeout waiting for %s' % what)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ngcccbase-server benchmark suite')
+    parser.add_argument('--blocks', type=int, default=20000)
+    parser.add_argument('--txs', type=int, default=2, help='non-coinbase txs per block')
+    parser.add_argument('--big-every', type=int, default=1000)
+    parser.add_argument('--big-txs', type=int, default=2000)
+    parser.add_argument('--history', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.001, help='bitcoind latency (seconds)')
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--txindex', action='store_true')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=5, help='seconds per method')
+    parser.add_argument('--methods', default='getblockcount,getheader,getheaders,getchunk,chunk,'
+                        'getmerkle,getmerkles,getrawtransaction,gettxblockhash,prefetch')
+    parser.add_argument('--port', type=int, default=28900)
+    parser.add_argument('--bitcoind-port', type=int, default=18600)
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    args = parser.parse_args()
+
+    store = tempfile.mkdtemp(prefix='ngcccbase-bench-')
+    url = 'http://127.0.0.1:%d/' % args.port
+    bitcoind_url = 'http://127.0.0.1:%d/' % args.bitcoind_port
+    processes = []
+    try:
+        conf = os.path.join(store, 'server.conf')
+        with open(conf, 'w') as f:
+            f.write(CONFIG % dict(port=args.port, threads=args.threads, workers=args.workers,
+                                  store=store, bitcoind_port=args.bitcoind_port,
+                                  txindex=args.txindex))
+
+        bitcoind = subprocess.Popen([
+            sys.executable, os.path.join(BENCH_DIR, 'fakebitcoind.py'),
+            '--port', str(args.bitcoind_port), '--blocks', str(args.blocks),
+            '--txs', str(args.txs), '--big-every', str(args.big_every),
+            '--big-txs', str(args.big_txs), '--history', str(args.history),
+            '--latency', str(args.latency), '--jitter', str(args.jitter)])
+        processes.append(bitcoind)
+        wait_for(lambda: call(bitcoind_url, 'getblockcount', []) == args.blocks - 1,
+                 600, 'fakebitcoind')
+
+        start = time.time()
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'server.py'), '-c', conf],
+                                  cwd=ROOT_DIR)
+        processes.append(server)
+        wait_for(lambda: call(url, 'getblockcount', {}) == args.blocks - 1, 3600, 'header sync')
+        elapsed = time.time() - start
+        sync = {'method': 'sync', 'blocks': args.blocks, 'seconds': elapsed,
+                'blocks_per_s': args.blocks / elapsed}
+        if args.json:
+            print json.dumps(sync)
+        else:
+            print 'header sync: %(blocks)d blocks in %(seconds).2f s (%(blocks_per_s).0f blocks/s)' % sync
+            print '%-18s %9s %7s %9s %9s %9s %11s' % (
+                'method', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'peak rss kB')
+        sys.stdout.flush()
+
+        for method in args.methods.split(','):
+            output = subprocess.check_output([
+                sys.executable, os.path.join(BENCH_DIR, 'load.py'), method,
+                '--url', url, '--bitcoind', bitcoind_url, '--concurrency', str(args.concurrency),
+                '--duration', str(args.duration), '--pid', str(server.pid), '--json'])
+            result = json.loads(output)
+            if args.json:
+                print json.dumps(result)
+            else:
+                print '%-18s %9d %7d %9.1f %9s %9s %11d%s' % (
+                    method, result['requests'], result['errors'], result['rps'],
+                    '%.2f' % result['p50_ms'] if result['p50_ms'] is not None else '-',
+                    '%.2f' % result['p99_ms'] if result['p99_ms'] is not None else '-',
+                    result['peak_rss_kb'],
+                    '  (%s)' % result['error'][:60] if result['error'] else '')
+            sys.stdout.flush()
+    finally:
+        for process in reversed(processes):
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        shutil.rmtree(store, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import collections
+import heapq
+import itertools
+import time
+
+from twisted.internet import defer, reactor
+
+
+# lower runs first, sync and background work is never rejected
+PRIORITY_SYNC = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+
+class Overloaded(Exception):
+    """Work rejected because of full queue, rendered with code 503"""
+
+
+class DeadlineExceeded(Exception):
+    """Work not done in time, rendered with code 503"""
+
+
+class PrioritySemaphore(object):
+    """DeferredSemaphore where waiters are woken up by priority
+
+    Client (PRIORITY_NORMAL) waiters are rejected with Overloaded when
+    max_queue of them is already waiting, and fail with DeadlineExceeded
+    when they have waited longer than timeout. Any waiter fails with
+    DeadlineExceeded at deadline given to acquire.
+    """
+
+    def __init__(self, tokens, max_queue=0, timeout=0, clock=reactor):
+        self.tokens = tokens
+        self.limit = tokens
+        self._max_queue = max_queue
+        self._timeout = timeout
+        self._clock = clock
+        self._waiters = []
+        self._normal_waiters = 0
+        self._seq = itertools.count()
+
+    def __len__(self):
+        """Number of waiters"""
+        return len(self._waiters)
+
+    def acquire(self, priority=PRIORITY_NORMAL, deadline=None):
+        now = self._clock.seconds()
+        if deadline is not None and deadline <= now:
+            return defer.fail(DeadlineExceeded('deadline exceeded'))
+        if self.tokens > 0:
+            self.tokens -= 1
+            return defer.succeed(self)
+        if priority == PRIORITY_NORMAL:
+            if self._max_queue and self._normal_waiters >= self._max_queue:
+                return defer.fail(Overloaded('bitcoind queue is full'))
+            self._normal_waiters += 1
+        expire = []
+        if deadline is not None:
+            expire.append((deadline, 'deadline exceeded'))
+        if priority == PRIORITY_NORMAL and self._timeout:
+            expire.append((now + self._timeout, 'bitcoind queue timeout'))
+        d = defer.Deferred(canceller=self._cancel)
+        timer = None
+        if expire:
+            when, message = min(expire)
+            timer = self._clock.callLater(when - now, self._expire, d, message)
+        heapq.heappush(self._waiters, (priority, next(self._seq), d, timer))
+        return d
+
+    def _remove(self, index):
+        priority, _, d, timer = self._waiters.pop(index)
+        heapq.heapify(self._waiters)
+        if priority == PRIORITY_NORMAL:
+            self._normal_waiters -= 1
+        if timer is not None and timer.active():
+            timer.cancel()
+
+    def _cancel(self, d):
+        for index, waiter in enumerate(self._waiters):
+            if waiter[2] is d:
+                self._remove(index)
+                return
+
+    def _expire(self, d, message):
+        self._cancel(d)
+        d.errback(DeadlineExceeded(message))
+
+    def release(self):
+        if self._waiters:
+            priority, _, d, timer = heapq.heappop(self._waiters)
+            if priority == PRIORITY_NORMAL:
+                self._normal_waiters -= 1
+            if timer is not None:
+                timer.cancel()
+            d.callback(self)
+            return
+        self.tokens += 1
+
+    def run(self, priority, f, *args, **kwargs):
+        def execute(_):
+            d = defer.maybeDeferred(f, *args, **kwargs)
+            def release(result):
+                self.release()
+                return result
+            return d.addBoth(release)
+        return self.acquire(priority).addCallback(execute)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def take(self, count=1):
+        """Return 0 if count tokens were taken, else seconds to wait"""
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= count:
+            self.tokens -= count
+            return 0
+        return (count - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """Token bucket per client, least recently seen clients are forgotten
+
+    Buckets live in one process, worker processes do not share them.
+    """
+
+    def __init__(self, rate, burst, max_clients=100000):
+        self._rate = rate
+        self._burst = burst
+        self._max_clients = max_clients
+        self._buckets = collections.OrderedDict()
+
+    def take(self, client, count=1):
+        """Return 0 if request of cost count is allowed, else seconds to wait"""
+        if not self._rate:
+            return 0
+        bucket = self._buckets.pop(client, None)
+        if bucket is None:
+            bucket = TokenBucket(self._rate, self._burst)
+            if len(self._buckets) >= self._max_clients:
+                self._buckets.popitem(last=False)
+        self._buckets[client] = bucket
+        return bucket.take(min(count, self._burst))
@@ -1 +1,2 @@
-from backend import Backend
+from backend import Backend, max_target
+from rawblocks import RawBlockBackend
@@ -1,223 +1,894 @@
 import os
-import json
-import hashlib
+import time
+import signal
+import binascii
+import collections
 
-from twisted.internet import defer, reactor
+from zope.interface import implements
+from twisted.internet import defer, reactor, task
 from twisted.python import log
 
 import bitcoin.core
 from coloredcoinlib import CTransaction, ColorDefinition
 
-from bitcoind import BitcoinJSONRPC
+from ... import config as cfg
+from ... import metrics
+from ... import tracing
+from ...admission import PRIORITY_SYNC, PRIORITY_BACKGROUND
+from ...workers import WorkerPool
+from ..cache import LRUCache
+from ..chain import HashIndex, bits_to_target, hash_headers, link_headers
+from ..colorstate import ColorStateCache
+from ..chunks import CHUNK_SIZE, build_chunk, chunk_size
+from ..hashes import hash_digest
+from ..headers import HeadersStore, HEADER_SIZE
+from ..interface import (IBackend, CAP_BROADCAST, CAP_COLORSTATE, CAP_MEMPOOL,
+                         CAP_TXINDEX)
+from ..merkle import MerkleTree
+from ..singleflight import SingleFlight, coalesce
+from ..txindex import TxIndex
+from bitcoind import BitcoinJSONRPC, JSONRPCException, check_batch
+from mempool import Mempool
 
 
-def rev_hex(s):
-    return s.decode('hex')[::-1].encode('hex')
-
-def int_to_hex(i, length=1):
-    s = hex(i)[2:].rstrip('L')
-    s = "0"*(2*length - len(s)) + s
-    return rev_hex(s)
-
 def hex_to_int(s):
     return int('0x' + s[::-1].encode('hex'), 16)
 
-def hash_decode(x):
-    return x.decode('hex')[::-1]
-
 def hash_encode(x):
     return x[::-1].encode('hex')
 
-def hash_digest(x):
-    return hashlib.sha256(hashlib.sha256(x).digest()).digest()
-
-def header_to_raw(h):
-    s = int_to_hex(h.get('version'),4) \
-        + rev_hex(h.get('previousblockhash', "0"*64)) \
-        + rev_hex(h.get('merkleroot')) \
-        + int_to_hex(h.get('time'),4) \
-        + rev_hex(h.get('bits')) \
-        + int_to_hex(h.get('nonce'),4)
-    return s.decode('hex')
-
 def hash_header(raw_header):
-    return hashlib.sha256(hashlib.sha256(raw_header).digest()).digest()[::-1].encode('hex_codec')
+    return hash_digest(raw_header)[::-1].encode('hex_codec')
+
+def max_target(config):
+    """Highest target allowed by [sync] pow_limit"""
+    return bits_to_target(int(cfg.get(config, 'sync', 'pow_limit', '1d00ffff'), 16))
 
+@tracing.inlineCallbacks
+def gather_results(ds):
+    """Like defer.gatherResults, but fails with the first error itself"""
+    try:
+        results = yield defer.gatherResults(ds, consumeErrors=True)
+    except defer.FirstError, e:
+        e.subFailure.raiseException()
+    defer.returnValue(results)
 
 class AsyncCTransaction(CTransaction):
-    @defer.inlineCallbacks
+    @tracing.inlineCallbacks
     def ensure_input_values(self):
         if self.have_input_values:
             return
+        prev_txhashes = sorted(set(inp.prevout.hash for inp in self.inputs
+                                   if inp.prevout.hash != 'coinbase'))
+        prev_txs = yield self.bs.get_async_transactions(prev_txhashes)
+        prev_txs = dict(zip(prev_txhashes, prev_txs))
         for inp in self.inputs:
-            prev_tx_hash = inp.prevout.hash
-            if prev_tx_hash != 'coinbase':
-                txhex = yield self.bs.bitcoind.call('getrawtransaction', [prev_tx_hash])
-                txbin = bitcoin.core.x(txhex)
-                tx = bitcoin.core.CTransaction.deserialize(txbin)
-                prevtx = AsyncCTransaction.from_bitcoincore(prev_tx_hash, tx, self.bs)
-                inp.prevtx = prevtx
-                inp.value = prevtx.outputs[inp.prevout.n].value
+            if inp.prevout.hash != 'coinbase':
+                # only the value is kept, decoded txs are cached and links to
+                #  prev txs would keep whole histories alive past eviction
+                inp.value = prev_txs[inp.prevout.hash].outputs[inp.prevout.n].value
             else:
-                inp.value = 0  # TODO: value of coinbase tx?
+                # coinbase input brings block subsidy and fees, that is
+                #  exactly what the tx outputs spend
+                inp.value = sum(out.value for out in self.outputs)
         self.have_input_values = True
 
 
 class Backend(object):
-    def __init__(self, config):
+    """Backend reading blocks and txs through bitcoind JSON-RPC"""
+    implements(IBackend)
+
+    # seconds between checks for headers written by syncer process
+    REFRESH_INTERVAL = 0.2
+
+    def __init__(self, config, rebuild_txindex=False, readonly=False, shared=False):
+        """In readonly mode headers are synced by parent process, shared
+        means that readonly processes use the same header store
+        """
         self._store_path = config.get('store', 'path')
-        self._headers = ''
+        self._readonly = readonly
+        self._shared = shared or readonly
+        self._tip_hashes = {}
+        self._headers = None
+        # height -> blockhash of stored headers, syncer only
+        self._hashes = None
+        self._max_target = max_target(config)
+        self._txindex = None
+        self._txindex_enabled = cfg.getboolean(config, 'txindex', 'enabled', False)
+        self._txindex_batch = cfg.getint(config, 'txindex', 'batch', 50)
+        self._txindex_batches = cfg.getint(config, 'txindex', 'batches', 10)
+        self._next_update_txindex = None
+        self._rebuild_txindex = rebuild_txindex
         self._next_update_headers = None
+        self._update_notified = False
+        self._update_interval = cfg.getfloat(config, 'sync', 'interval', 1)
+        self._height_waiters = []
+        self._bitcoind_height = None
+        self._sync_batch = cfg.getint(config, 'sync', 'batch', 500)
+        self._sync_window = max(self._sync_batch, cfg.getint(config, 'sync', 'window', 2000))
+
+        # only data from main chain blocks is cached, it can change on reorg only
+        self._tx_cache = LRUCache(cfg.getint(config, 'cache', 'transactions', 64) * 1024*1024)
+        self._decoded_cache = LRUCache(cfg.getint(config, 'cache', 'decoded', 32) * 1024*1024)
+        self._block_cache = LRUCache(cfg.getint(config, 'cache', 'blocks', 16) * 1024*1024)
+        self._chunk_cache = LRUCache(cfg.getint(config, 'cache', 'chunks', 64) * 1024*1024)
+        self.workers = WorkerPool(cfg.getint(config, 'server', 'threads', 4),
+                                  processes=cfg.getint(config, 'server', 'processes', 0))
+        self._prefetch_timeout = cfg.getfloat(config, 'prefetch', 'timeout', 10)
+        self._prefetch_concurrency = cfg.getint(config, 'prefetch', 'concurrency', 8)
+        # concurrent identical calls share one request to bitcoind
+        self._singleflight = SingleFlight()
+        self._color_defs = LRUCache(1000)
+        self._colorstate = None
+        if cfg.getboolean(config, 'colorstate', 'enabled', True):
+            self._colorstate = ColorStateCache(
+                os.path.join(self._store_path, 'colorstate.sqlite'),
+                max_entries=cfg.getint(config, 'colorstate', 'entries', 1000000),
+                memory_entries=cfg.getint(config, 'colorstate', 'memory', 100000),
+                readonly=readonly)
+            self._colorstate_flush = task.LoopingCall(self._flush_colorstate)
+            reactor.callWhenRunning(self._colorstate_flush.start,
+                                    cfg.getfloat(config, 'colorstate', 'flush_interval', 5), now=False)
 
         self.bitcoind = BitcoinJSONRPC(config)
 
+        self._mempool = None
+        self._mempool_lock = defer.DeferredLock()
+        self._mempool_interval = cfg.getfloat(config, 'mempool', 'interval', 5)
+        # readonly processes look unconfirmed txs up in bitcoind, one poller
+        #  (in syncer, which also drops mined txs) is enough
+        if cfg.getboolean(config, 'mempool', 'enabled', True) and not readonly:
+            self._mempool = Mempool(self.bitcoind, cfg.getint(config, 'mempool', 'size', 64) * 1024*1024)
+            reactor.callWhenRunning(self._update_mempool)
+
+        capabilities = set([CAP_BROADCAST])
+        if self._txindex_enabled:
+            capabilities.add(CAP_TXINDEX)
+        if self._mempool is not None:
+            capabilities.add(CAP_MEMPOOL)
+        if self._colorstate is not None:
+            capabilities.add(CAP_COLORSTATE)
+        self.capabilities = frozenset(capabilities)
+
         reactor.callWhenRunning(self._init_headers)
+        self._register_metrics()
+
+    def _register_metrics(self):
+        """Export stats on /metrics, values are read on scrape only"""
+        def per_cache(key):
+            return lambda: dict(((name,), stats[key])
+                                for name, stats in self.cache_stats().iteritems())
+        def hit_ratio():
+            return dict(((name,), float(stats['hits']) / (stats['hits'] + stats['misses'])
+                                  if stats['hits'] + stats['misses'] else None)
+                        for name, stats in self.cache_stats().iteritems())
+        metrics.gauge_func('ngcccbase_height', 'Height of synced headers',
+                           lambda: self.current_height)
+        metrics.gauge_func('ngcccbase_bitcoind_height', 'Last block count reported by bitcoind',
+                           lambda: self._bitcoind_height)
+        metrics.counter_func('ngcccbase_cache_hits_total', 'Cache hits', per_cache('hits'), ('cache',))
+        metrics.counter_func('ngcccbase_cache_misses_total', 'Cache misses', per_cache('misses'), ('cache',))
+        metrics.gauge_func('ngcccbase_cache_hit_ratio', 'Cache hits / lookups', hit_ratio, ('cache',))
+        metrics.gauge_func('ngcccbase_cache_bytes', 'Size of cached values', per_cache('size'), ('cache',))
+        metrics.gauge_func('ngcccbase_cache_entries', 'Cached values', per_cache('entries'), ('cache',))
+        metrics.counter_func('ngcccbase_singleflight_deduplicated_total',
+                             'Calls answered by identical call in flight',
+                             lambda: self._singleflight.deduplicated)
+        metrics.gauge_func('ngcccbase_backend_capability', 'Capabilities of backend',
+                           lambda: dict(((name,), 1) for name in self.capabilities), ('capability',))
+        metrics.gauge_func('ngcccbase_mempool_transactions', 'Transactions kept from bitcoind mempool',
+                           lambda: (self.mempool_stats() or {}).get('entries'))
 
     @property
     def current_height(self):
-        return len(self._headers)/80 - 1
+        if self._headers is None:
+            return -1
+        return self._headers.height
 
+    @tracing.inlineCallbacks
     def _init_headers(self):
-        with open(os.path.join(self._store_path, 'blockchain_headers'), 'ab+') as headers:
-            self._headers = headers.read()
+        self._headers = HeadersStore(os.path.join(self._store_path, 'blockchain_headers'),
+                                     readonly=self._readonly)
+        if self._txindex_enabled:
+            self._txindex = TxIndex(os.path.join(self._store_path, 'txindex.sqlite'),
+                                    readonly=self._readonly)
+            if self._rebuild_txindex and not self._readonly:
+                log.msg('Rebuild txindex')
+                self._txindex.clear()
+            if not self._readonly:
+                self._txindex.rollback(self.current_height + 1)
         reactor.addSystemEventTrigger('before', 'shutdown', self._shutdown_headers)
-        self._next_update_headers = reactor.callLater(0, self._update_headers)
+        if self._readonly:
+            self._remember_tip()
+            self._next_update_headers = reactor.callLater(0, self._refresh_headers)
+        else:
+            self._hashes = yield self._load_hashes()
+            self._next_update_headers = reactor.callLater(0, self._update_headers)
+            if self._txindex is not None:
+                self._next_update_txindex = reactor.callLater(0, self._update_txindex)
+
+    @tracing.inlineCallbacks
+    def _load_hashes(self):
+        """Return HashIndex of stored headers, only headers added since
+        last save are hashed
+        """
+        path = os.path.join(self._store_path, 'blockchain_hashes')
+        hashes = HashIndex.load(path)
+        hashes.truncate(len(self._headers))
+        # last saved header is replaced when any saved one is, as a header
+        #  commits to all below it, checking it checks them all
+        height = len(hashes) - 1
+        if height >= 0 and hashes.digest(height) != hash_digest(str(self._headers.get(height))):
+            log.msg('Saved block hashes do not match headers, rehashing')
+            hashes = HashIndex()
+        start = len(hashes)
+        if start < len(self._headers):
+            hashes.append((yield self.workers.run_process(
+                hash_headers, str(self._headers.get_range(start, len(self._headers))))))
+            hashes.save(path)
+        defer.returnValue(hashes)
+
+    def _block_hash(self, height):
+        if self._hashes is not None:
+            return self._hashes.get(height)
+        return hash_header(self._headers.get(height))
+
+    @tracing.inlineCallbacks
+    def _fetch_headers(self, start, count):
+        hashes = check_batch((yield self.bitcoind.call_batch(
+            [('getblockhash', [height]) for height in xrange(start, start+count)],
+            priority=PRIORITY_SYNC)))
+        headers = check_batch((yield self.bitcoind.call_batch(
+            [('getblockheader', [blockhash, False]) for blockhash in hashes],
+            priority=PRIORITY_SYNC)))
+        defer.returnValue(''.join(header.decode('hex') for header in headers))
+
+    @tracing.inlineCallbacks
+    def _append_headers(self, raw_headers):
+        """Append headers linked to current tip, return False on mismatch"""
+        prev_hash = None
+        if self.current_height >= 0:
+            prev_hash = self._hashes.digest(self.current_height)
+        hashes, count = yield self.workers.run_process(link_headers, prev_hash, raw_headers,
+                                                       self._max_target)
+        self._headers.append(raw_headers[:count*HEADER_SIZE])
+        self._hashes.append(hashes)
+        defer.returnValue(count*HEADER_SIZE == len(raw_headers))
+
+    def _replace_headers(self, height, raw_headers, hashes):
+        """Replace headers from height with one write, drop cached data
+        of orphaned blocks
+        """
+        orphaned = set(self._hashes.get(h) for h in xrange(height, self.current_height + 1))
+        if self._txindex is not None:
+            self._txindex.rollback(height)
+        self._headers.replace(height, raw_headers)
+        self._hashes.replace(height, hashes)
+        self._headers.flush()
+        log.msg('Reorg: %d blocks from height %d replaced by %d' % (
+            len(orphaned), height, len(raw_headers) / HEADER_SIZE))
+        try:
+            self._invalidate_blocks(height, orphaned)
+        except Exception:
+            # headers are replaced already, cache errors must not undo reorg
+            log.err()
+
+    @tracing.inlineCallbacks
+    def _find_fork_point(self, height):
+        """Return first height where stored headers differ from bitcoind
+
+        Heights below the tip are probed at doubling distances in one
+        batch, then the gap between the last mismatch and the first match
+        is searched by bisection, gaps up to sync batch size are fetched
+        at once.
+        """
+        def matches(heights):
+            d = self.bitcoind.call_batch([('getblockhash', [h]) for h in heights],
+                                         priority=PRIORITY_SYNC)
+            return d.addCallback(lambda hashes: [blockhash == self._hashes.get(h)
+                                                 for h, blockhash in zip(heights, hashes)])
+
+        tip = min(height, self.current_height)
+        probes, step = [], 1
+        while tip - step + 1 >= 0:
+            probes.append(tip - step + 1)
+            step *= 2
+        if probes[-1] != 0:
+            probes.append(0)
+        good, bad = -1, tip + 1
+        for h, match in zip(probes, (yield matches(probes))):
+            if match:
+                good = h
+                break
+            bad = h
+
+        while bad - good > 1:
+            if bad - good - 1 <= self._sync_batch:
+                heights = range(good + 1, bad)
+                results = yield matches(heights)
+                bad = heights[results.index(False)] if False in results else bad
+                break
+            mid = (good + bad) // 2
+            if (yield matches([mid]))[0]:
+                good = mid
+            else:
+                bad = mid
+        defer.returnValue(bad)
+
+    @tracing.inlineCallbacks
+    def _reorg(self, fork, height):
+        """Replace headers from fork with first batch of bitcoind chain"""
+        count = min(height - fork + 1, self._sync_batch)
+        raw_headers = (yield self._fetch_headers(fork, count)) if count > 0 else ''
+        prev_hash = self._hashes.digest(fork - 1) if fork > 0 else None
+        hashes, count = yield self.workers.run_process(link_headers, prev_hash, raw_headers,
+                                                       self._max_target)
+        self._replace_headers(fork, raw_headers[:count*HEADER_SIZE], hashes)
+        self._notify_height_waiters()
+
+    def _invalidate_blocks(self, height, orphaned):
+        """Drop cached data of orphaned blocks from height and above"""
+        for blockhash in orphaned:
+            self._block_cache.pop(blockhash)
+        self._tx_cache.remove_if(lambda txhash, tx: tx['blockhash'] in orphaned)
+        self._decoded_cache.remove_if(lambda txhash, tx: tx['blockhash'] in orphaned)
+        self._chunk_cache.remove_if(lambda index, chunk: index >= height // CHUNK_SIZE)
+        if self._colorstate is not None:
+            self._colorstate.remove_blocks(orphaned)
+
+    def _remember_tip(self):
+        """Keep hashes of last headers to find fork point on refresh"""
+        self._tip_hashes = dict((h, self._block_hash(h))
+                                for h in xrange(max(0, self.current_height - 99),
+                                                self.current_height + 1))
+
+    def _find_fork(self):
+        """Return lowest height changed since _remember_tip or None"""
+        if not self._tip_hashes:
+            return None
+        for height in sorted(self._tip_hashes, reverse=True):
+            if height <= self.current_height and \
+                    self._block_hash(height) == self._tip_hashes[height]:
+                break
+        else:
+            # reorg is deeper than remembered hashes
+            return min(self._tip_hashes)
+        if height == max(self._tip_hashes):
+            return None
+        return height + 1
+
+    def _refresh_headers(self):
+        """Readonly mode: pick up headers written by syncer process"""
+        try:
+            height = self.current_height
+            self._headers.refresh()
+            fork = self._find_fork()
+            if fork is not None:
+                self._invalidate_blocks(fork, set(
+                    blockhash for h, blockhash in self._tip_hashes.iteritems() if h >= fork))
+            if fork is not None or height != self.current_height:
+                self._remember_tip()
+                self._notify_height_waiters()
+        except Exception, e:
+            log.err()
 
-    @defer.inlineCallbacks
+        self._next_update_headers = reactor.callLater(self.REFRESH_INTERVAL, self._refresh_headers)
+
+    @tracing.inlineCallbacks
+    def _sync_headers(self, height):
+        """Fetch headers up to height keeping a window of batches in flight,
+        return False if fetched headers do not link to stored ones
+        """
+        pending = collections.deque()
+        linked = True
+        next_height = self.current_height + 1
+        started, synced = time.time(), 0
+        try:
+            while next_height <= height or pending:
+                while next_height <= height and \
+                        len(pending) * self._sync_batch < self._sync_window:
+                    count = min(self._sync_batch, height - next_height + 1)
+                    pending.append(self._fetch_headers(next_height, count))
+                    next_height += count
+
+                raw_headers = yield pending.popleft()
+                linked = yield self._append_headers(raw_headers)
+                self._headers.flush()
+
+                synced += len(raw_headers) / HEADER_SIZE
+                rate = synced / max(time.time() - started, 0.001)
+                log.msg('New height: %d (%.1f blocks/s)' % (self.current_height, rate))
+                self._notify_height_waiters()
+                if not linked:
+                    break
+        finally:
+            for d in pending:
+                d.addErrback(lambda _: None)
+        defer.returnValue(linked)
+
+    @tracing.inlineCallbacks
     def _update_headers(self):
         try:
-            height = yield self.bitcoind.call('getblockcount')
-            if height < self.current_height:
-                self._headers = self._headers[:height*80]
-            while height > self.current_height:
-                block_height = self.current_height + 1
-                blockhash = yield self.bitcoind.call('getblockhash', [block_height])
-                block = yield self.bitcoind.call('getblock', [blockhash])
-
-                if block_height == 0:
-                    self._headers = header_to_raw(block)
-                else:
-                    prev_hash = hash_header(self._headers[-80:])
-                    if prev_hash == block.get('previousblockhash'):
-                        self._headers += header_to_raw(block)
-                    else:
-                        self._headers = self._headers[:-80]
-                log.msg('New height: %d' % self.current_height)
+            changed = False
+            while True:
+                calls = [('getblockcount', [])]
+                if self.current_height >= 0:
+                    calls.append(('getblockhash', [self.current_height]))
+                results = yield self.bitcoind.call_batch(calls, priority=PRIORITY_SYNC)
+                height = check_batch(results[:1])[0]
+                self._bitcoind_height = height
+                # tip hash error means bitcoind chain is shorter now
+                if self.current_height >= 0 and results[1] != self._hashes.get(self.current_height):
+                    fork = yield self._find_fork_point(height)
+                    yield self._reorg(fork, height)
+                    changed = True
+                if height <= self.current_height:
+                    break
+                changed = True
+                if (yield self._sync_headers(height)):
+                    break
+            if changed:
+                if self._mempool is not None:
+                    # move mined txs out of mempool right away
+                    yield self._mempool_lock.run(self._mempool.refresh)
         except Exception, e:
             log.err()
 
-        self._next_update_headers = reactor.callLater(1, self._update_headers)
+        interval = 0 if self._update_notified else self._update_interval
+        self._update_notified = False
+        self._next_update_headers = reactor.callLater(interval, self._update_headers)
 
-    def _shutdown_headers(self):
+    @tracing.inlineCallbacks
+    def _update_mempool(self):
+        try:
+            yield self._mempool_lock.run(self._mempool.refresh)
+        except Exception, e:
+            log.err()
+        reactor.callLater(self._mempool_interval, self._update_mempool)
+
+    def notify_block(self):
+        """Update headers right now, for bitcoind -blocknotify"""
+        if self._readonly:
+            # syncer is parent process, see server.py
+            os.kill(os.getppid(), signal.SIGUSR1)
+            return
         if self._next_update_headers is not None and self._next_update_headers.active():
-            self._next_update_headers.cancel()
-        with open(os.path.join(self._store_path, 'blockchain_headers'), 'wb') as headers:
-            headers.write(self._headers)
+            self._next_update_headers.reset(0)
+        else:
+            # update is running now, run next one right after it
+            self._update_notified = True
+
+    def _notify_height_waiters(self):
+        waiters = [w for w in self._height_waiters if w['height'] < self.current_height]
+        for waiter in waiters:
+            self._height_waiters.remove(waiter)
+            waiter['timeout'].cancel()
+            waiter['d'].callback(self._new_headers(waiter['height']))
+
+    @tracing.inlineCallbacks
+    def _update_txindex(self):
+        """Index tx lists of at most [txindex] batches batches of blocks
+
+        Runs apart from header sync, so initial build of the index does not
+        hold up new headers. Next run starts at once while behind.
+        """
+        behind = False
+        try:
+            # far behind means initial build, indexes are recreated after it
+            yield self.workers.run(self._txindex.set_bulk,
+                                   self.current_height - self._txindex.height > 2016)
+            started, indexed = time.time(), 0
+            for _ in xrange(self._txindex_batches):
+                if self._txindex.height >= self.current_height:
+                    break
+                start = self._txindex.height + 1
+                stop = min(start + self._txindex_batch, self.current_height + 1)
+                blockhashes = [self._block_hash(h) for h in xrange(start, stop)]
+                txids = yield self._fetch_txids(blockhashes)
+                # headers could be truncated while we were waiting
+                if self._txindex.height != start - 1 or self.current_height < stop - 1 or \
+                        blockhashes[-1] != self._block_hash(stop - 1):
+                    break
+                yield self.workers.run(self._txindex.add_blocks, zip(xrange(start, stop), txids))
+                if self._mempool is not None:
+                    for block_txids in txids:
+                        self._mempool.remove(block_txids)
+
+                indexed += stop - start
+                log.msg('Txindex height: %d (%.1f blocks/s)' % (
+                    self._txindex.height, indexed / max(time.time() - started, 0.001)))
+            behind = self._txindex.height < self.current_height
+            if not behind:
+                yield self.workers.run(self._txindex.set_bulk, False)
+        except Exception, e:
+            log.err()
 
+        self._next_update_txindex = reactor.callLater(
+            0 if behind else self._update_interval, self._update_txindex)
+
+    def _shutdown_headers(self):
+        for call in (self._next_update_headers, self._next_update_txindex):
+            if call is not None and call.active():
+                call.cancel()
+        self._headers.close(trim=not self._shared)
+        if self._hashes is not None:
+            self._hashes.save(os.path.join(self._store_path, 'blockchain_hashes'))
+        if self._txindex is not None:
+            self._txindex.close()
+        if self._colorstate is not None:
+            if self._colorstate_flush.running:
+                self._colorstate_flush.stop()
+            self._colorstate.close()
+
+    def _flush_colorstate(self):
+        try:
+            self._colorstate.flush()
+        except Exception, e:
+            # pending entries are kept for the next try
+            log.err()
+
+
+    @tracing.inlineCallbacks
+    def _get_transaction(self, txhash):
+        """Return dict with hex and blockhash, confirmed txs are cached,
+        unconfirmed are served from mempool snapshot
+        """
+        tx = self._tx_cache.get(txhash)
+        if tx is None and self._mempool is not None and txhash in self._mempool:
+            tx = {'hex': self._mempool.get(txhash), 'blockhash': None}
+        if tx is None:
+            tx, confirmed = yield self._load_transaction(txhash)
+            # mempool txs bypass cache
+            if confirmed:
+                self._tx_cache.set(txhash, tx, len(tx['hex']) + 200)
+        defer.returnValue(tx)
+
+    @tracing.inlineCallbacks
+    def _load_transaction(self, txhash):
+        """Return (dict with hex and blockhash, confirmed)"""
+        data = yield self.bitcoind.call('getrawtransaction', [txhash, 1])
+        defer.returnValue(({'hex': data['hex'], 'blockhash': data.get('blockhash')},
+                           data.get('confirmations', 0) > 0))
+
+    @tracing.inlineCallbacks
+    def _get_block(self, blockhash):
+        """Return dict with height and merkle tree of block tx list,
+        main chain blocks are cached
+        """
+        block = self._block_cache.get(blockhash)
+        if block is None:
+            block, main_chain = yield self._load_block(blockhash)
+            if main_chain:
+                self._block_cache.set(blockhash, block, block['tree'].size + 200)
+        defer.returnValue(block)
+
+    @tracing.inlineCallbacks
+    def _load_block(self, blockhash):
+        """Return (dict with height and merkle tree, in main chain)"""
+        data = yield self.bitcoind.call('getblock', [blockhash])
+        tree = yield self.workers.run_process(MerkleTree, data['tx'])
+        # orphaned blocks have confirmations -1
+        defer.returnValue(({'height': data['height'], 'tree': tree}, data.get('confirmations', 0) > 0))
+
+    @tracing.inlineCallbacks
+    def _fetch_txids(self, blockhashes):
+        """Return tx lists of blocks"""
+        blocks = check_batch((yield self.bitcoind.call_batch(
+            [('getblock', [blockhash]) for blockhash in blockhashes],
+            priority=PRIORITY_BACKGROUND)))
+        defer.returnValue([block['tx'] for block in blocks])
+
+    def cache_stats(self):
+        stats = {
+            'transactions': self._tx_cache.stats(),
+            'decoded':      self._decoded_cache.stats(),
+            'blocks':       self._block_cache.stats(),
+            'chunks':       self._chunk_cache.stats(),
+        }
+        if self._colorstate is not None:
+            stats['colorstate'] = self._colorstate.stats()
+        return stats
+
+    def mempool_stats(self):
+        if self._mempool is None:
+            return None
+        return self._mempool.stats()
+
+    def singleflight_stats(self):
+        return self._singleflight.stats()
 
     def get_block_count(self):
         return self.current_height
 
+    @coalesce
+    @tracing.inlineCallbacks
+    def get_completed_chunk(self, index):
+        """Return dict with etag, hex and raw_gzip bodies of chunk or None
+        if chunk is not completed yet
+        """
+        if index < 0 or (index+1)*CHUNK_SIZE > len(self._headers):
+            defer.returnValue(None)
+        chunk = self._chunk_cache.get(index)
+        if chunk is None:
+            raw = str(self.get_chunk_raw(index))
+            chunk = yield self.workers.run(build_chunk, raw)
+            # headers could be truncated while we were waiting
+            if (index+1)*CHUNK_SIZE > len(self._headers) or \
+                    str(self.get_chunk_raw(index)) != raw:
+                defer.returnValue(None)
+            self._chunk_cache.set(index, chunk, chunk_size(chunk))
+        defer.returnValue(chunk)
+
+    def get_chunk_raw(self, index):
+        return self._headers.get_range(index*CHUNK_SIZE, (index+1)*CHUNK_SIZE)
+
+    @tracing.inlineCallbacks
     def get_chunk(self, index):
-        lower, upper = index*2016*80, (index+1)*2016*80
-        lower = max(0, lower)
-        upper = min(len(self._headers), upper)
-        return self._headers[lower:upper].encode('hex')
+        chunk = yield self.get_completed_chunk(index)
+        if chunk is not None:
+            defer.returnValue(chunk['hex'])
+        defer.returnValue(binascii.hexlify(self.get_chunk_raw(index)))
+
+    def get_headers_raw(self, start, count):
+        if start > self.current_height or start < 0:
+            raise Exception('height number out of range')
+        return self._headers.get_range(start, start + count)
+
+    def get_headers(self, start, count):
+        return binascii.hexlify(self.get_headers_raw(start, count))
+
+    def _new_headers(self, height):
+        start = max(0, height + 1)
+        return {
+            'height': self.current_height,
+            'headers': binascii.hexlify(self._headers.get_range(start, start + CHUNK_SIZE)),
+        }
+
+    def wait_headers(self, height, timeout):
+        """Wait until current height is above height, return current height
+        and headers after height (empty when timeout expires)
+        """
+        if self.current_height > height:
+            return defer.succeed(self._new_headers(height))
+
+        def cancel(d):
+            self._height_waiters.remove(waiter)
+            waiter['timeout'].cancel()
+
+        def expire():
+            self._height_waiters.remove(waiter)
+            waiter['d'].callback(self._new_headers(height))
+
+        waiter = {
+            'height': height,
+            'd': defer.Deferred(cancel),
+            'timeout': reactor.callLater(timeout, expire),
+        }
+        self._height_waiters.append(waiter)
+        return waiter['d']
 
     def get_header(self, height):
         if height > self.current_height or height < 0:
             raise Exception('height number out of range')
-        header = self._headers[height*80:(height+1)*80]
-        return json.dumps({
+        header = self._headers.get(height)
+        return {
             'version':         hex_to_int(header[0:4]),
             'prev_block_hash': hash_encode(header[4:36]),
             'merkle_root':     hash_encode(header[36:68]),
             'timestamp':       hex_to_int(header[68:72]),
             'bits':            hex_to_int(header[72:76]),
             'nonce':           hex_to_int(header[76:80]),
-        })
+        }
 
-    @defer.inlineCallbacks
+    @coalesce
+    @tracing.inlineCallbacks
     def get_merkle(self, txhash, blockhash):
-        block = yield self.bitcoind.call('getblock', [blockhash])
-        tx_list = block['tx']
-        tx_pos = tx_list.index(txhash)
-
-        merkle = map(hash_decode, tx_list)
-        target_hash = hash_decode(txhash)
-        s = []
-        while len(merkle) != 1:
-            if len(merkle) % 2:
-                merkle.append(merkle[-1])
-            n = []
-            while merkle:
-                new_hash = hash_digest(merkle[0] + merkle[1])
-                if merkle[0] == target_hash:
-                    s.append(hash_encode(merkle[1]))
-                    target_hash = new_hash
-                elif merkle[1] == target_hash:
-                    s.append(hash_encode(merkle[0]))
-                    target_hash = new_hash
-                n.append(new_hash)
-                merkle = merkle[2:]
-            merkle = n
-
-        defer.returnValue(json.dumps({
+        block = yield self._get_block(blockhash)
+        defer.returnValue({
             'block_height': block['height'],
-            'merkle': s,
-            'pos': tx_pos,
-        }))
+            'merkle': block['tree'].branch(txhash),
+            'pos': block['tree'].position(txhash),
+        })
 
+    @coalesce
+    @tracing.inlineCallbacks
+    def get_merkles(self, txhashes, blockhash=None):
+        """Return merkle branches for txhashes, all in block blockhash when
+        it is given, else every one in block of its tx; unconfirmed and
+        unknown txs and txs not in the block get None
+        """
+        def unknown(failure):
+            failure.trap(JSONRPCException)
+            return None
+
+        if blockhash is not None:
+            blockhashes = [blockhash] * len(txhashes)
+        else:
+            blockhashes = yield gather_results([
+                self._get_tx_blockhash(txhash).addCallbacks(lambda location: location[0], unknown)
+                for txhash in txhashes])
+
+        distinct = sorted(set(blockhashes) - set([None]))
+        blocks = yield gather_results([self._get_block(x).addErrback(unknown) for x in distinct])
+        blocks = dict(zip(distinct, blocks))
+
+        result = []
+        for txhash, blockhash in zip(txhashes, blockhashes):
+            block = blocks.get(blockhash)
+            if block is None or txhash not in block['tree']:
+                result.append(None)
+                continue
+            result.append({
+                'block_height': block['height'],
+                'merkle': block['tree'].branch(txhash),
+                'pos': block['tree'].position(txhash),
+            })
+        defer.returnValue(result)
+
+    @coalesce
+    @tracing.inlineCallbacks
     def get_raw_transaction(self, txhash):
-        return self.bitcoind.call('getrawtransaction', [txhash])
-
-    @defer.inlineCallbacks
+        tx = yield self._get_transaction(txhash)
+        defer.returnValue(tx['hex'])
+
+    @coalesce
+    @tracing.inlineCallbacks
+    def _get_tx_blockhash(self, txhash):
+        """Return (blockhash, unconfirmed) for txhash"""
+        if self._txindex is not None:
+            location = self._txindex.get(txhash)
+            # syncer process can index blocks not picked up by us yet
+            if location is not None and location[0] <= self.current_height:
+                defer.returnValue((self._block_hash(location[0]), False))
+        tx = yield self._get_transaction(txhash)
+        defer.returnValue((tx['blockhash'], tx['blockhash'] is None))
+
+    @tracing.inlineCallbacks
     def get_tx_blockhash(self, txhash):
-        data = yield self.bitcoind.call('getrawtransaction', [txhash, 1])
-        defer.returnValue(json.dumps([
-            data.get('blockhash'),
-            'confirmations' not in data
-        ]))
-
-    @defer.inlineCallbacks
+        blockhash, unconfirmed = yield self._get_tx_blockhash(txhash)
+        defer.returnValue([blockhash, unconfirmed])
+
+    @coalesce
+    @tracing.inlineCallbacks
+    def _get_async_transaction(self, txhash):
+        """Return (hex, AsyncCTransaction), decoded confirmed txs are cached"""
+        entry = yield self._get_decoded_transaction(txhash)
+        defer.returnValue((entry['hex'], entry['tx']))
+
+    @tracing.inlineCallbacks
+    def _get_decoded_transaction(self, txhash):
+        """Return dict with hex, AsyncCTransaction and blockhash"""
+        entry = self._decoded_cache.get(txhash)
+        if entry is None:
+            tx = yield self._get_transaction(txhash)
+            bctx = yield self.workers.run(bitcoin.core.CTransaction.deserialize,
+                                          bitcoin.core.x(tx['hex']))
+            entry = {
+                'hex': tx['hex'],
+                'tx': AsyncCTransaction.from_bitcoincore(txhash, bctx, self),
+                'blockhash': tx['blockhash'],
+            }
+            if entry['blockhash'] is not None:
+                self._decoded_cache.set(txhash, entry, 4*len(entry['hex']) + 500)
+        defer.returnValue(entry)
+
+    @tracing.inlineCallbacks
+    def get_async_transactions(self, txhashes):
+        """Return list of AsyncCTransaction for txhashes fetched concurrently"""
+        txs = yield gather_results(map(self._get_async_transaction, txhashes))
+        defer.returnValue([tx for _, tx in txs])
+
+    def _color_definition(self, color_desc):
+        color_def = self._color_defs.get(color_desc)
+        if color_def is None:
+            # note the id doesn't actually matter we need to add it so
+            #  we have a valid color definition
+            color_def = ColorDefinition.from_color_desc(9999, color_desc)
+            self._color_defs.set(color_desc, color_def, 1)
+        return color_def
+
+    def _expand_known(self, color_desc, frontier, visited, have, budget=None, deadline=None):
+        """Walk cached part of affecting-input graph breadth-first
+
+        Return (txhashes of walked outpoints in walk order, outpoints not
+        in cache), visited is updated. Walk stops when budget txhashes not
+        in have are found or at deadline.
+        """
+        known, unknown = [], set()
+        found = set()
+        while frontier:
+            visited.update(frontier)
+            next_frontier = set()
+            for outpoint in sorted(frontier):
+                if (budget is not None and len(found) >= budget) or \
+                        (deadline is not None and time.time() >= deadline):
+                    return known, unknown
+                if outpoint[0] not in have:
+                    found.add(outpoint[0])
+                inputs = None
+                if self._colorstate is not None:
+                    inputs = self._colorstate.get(color_desc, *outpoint)
+                if inputs is None:
+                    unknown.add(outpoint)
+                    continue
+                known.append(outpoint[0])
+                next_frontier.update(x for x in inputs if x not in visited)
+            frontier = next_frontier
+        return known, unknown
+
+    @coalesce
+    @tracing.inlineCallbacks
     def prefetch(self, txhash, output_set, color_desc, limit):
-        # note the id doesn't actually matter we need to add it so
-        #  we have a valid color definition
-        color_def = ColorDefinition.from_color_desc(9999, color_desc)
+        """Gather txs affecting colorvalues of txhash outputs
+
+        The graph of affecting inputs is walked breadth-first. Parts of the
+        graph walked by earlier calls are taken from the color-state cache
+        at once, the rest is walked level by level, every level is fetched
+        concurrently. Walk stops when limit txs are gathered or when
+        prefetch timeout is exceeded.
+        """
+        color_def = self._color_definition(color_desc)
+        deadline = time.time() + self._prefetch_timeout
+        if tracing.deadline() is not None:
+            # nobody waits for the result after request deadline
+            deadline = min(deadline, tracing.deadline())
+        semaphore = defer.DeferredSemaphore(self._prefetch_concurrency)
+        # semaphore starts waiting calls from callbacks of other calls
+        get_transaction = tracing.bind(self._get_transaction)
+        get_decoded_transaction = tracing.bind(self._get_decoded_transaction)
         # gather all the transactions and return them
         tx_lookup = {}
-
-        @defer.inlineCallbacks
-        def process(current_txhash, current_outindex):
-            """For any tx out, process the colorvalues of the affecting
-            inputs first and then scan that tx.
-            """
-            if limit and len(tx_lookup) > limit:
-                defer.returnValue(None)
-            if tx_lookup.get(current_txhash):
-                defer.returnValue(None)
-
-            raw_transaction = yield self.bitcoind.call('getrawtransaction', [current_txhash])
-            txbin = bitcoin.core.x(txhex)
-            tx = bitcoin.core.CTransaction.deserialize(txbin)
-            current_tx = AsyncCTransaction.from_bitcoincore(txhash, tx, self)
-            if not current_tx:
-                defer.returnValue(None)
-
-            tx_lookup[current_txhash] = raw_transaction
-
-            # note a genesis tx will simply have 0 affecting inputs
-            inputs = set()
-            inputs = inputs.union(
-                color_def.get_affecting_inputs(current_tx,
-                                               [current_outindex]))
-            for i in inputs:
-                yield process(i.prevout.hash, i.prevout.n)
-
-        for oi in output_set:
-            yield process(txhash, oi)
+        visited = set()
+
+        frontier = set((txhash, outindex) for outindex in output_set)
+        while frontier and time.time() < deadline:
+            budget = max(0, limit - len(tx_lookup)) if limit else None
+            with tracing.span('colorstate.expand'):
+                known, unknown = self._expand_known(color_desc, frontier, visited, tx_lookup,
+                                                    budget, deadline)
+            outputs = collections.defaultdict(list)
+            for current_txhash, outindex in unknown:
+                outputs[current_txhash].append(outindex)
+
+            # txs of known outpoints are needed as hex only
+            known = [x for x in collections.OrderedDict.fromkeys(known) if x not in outputs]
+            current_txhashes = sorted(outputs)
+            if limit:
+                new_txhashes = [x for x in known + current_txhashes if x not in tx_lookup]
+                allowed = set(new_txhashes[:max(0, limit - len(tx_lookup))])
+                known = [x for x in known if x in tx_lookup or x in allowed]
+                current_txhashes = [x for x in current_txhashes
+                                    if x in tx_lookup or x in allowed]
+
+            known_txs, entries = yield gather_results([
+                gather_results([semaphore.run(get_transaction, x) for x in known]),
+                gather_results([semaphore.run(get_decoded_transaction, x)
+                                for x in current_txhashes])])
+            for current_txhash, tx in zip(known, known_txs):
+                tx_lookup[current_txhash] = tx['hex']
+
+            frontier = set()
+            for current_txhash, entry in zip(current_txhashes, entries):
+                if not entry['tx']:
+                    continue
+                tx_lookup[current_txhash] = entry['hex']
+
+                # note a genesis tx will simply have 0 affecting inputs
+                for outindex in outputs[current_txhash]:
+                    inputs = yield tracing.run_in_span(
+                        'colorstate.affecting_inputs', defer.maybeDeferred,
+                        color_def.get_affecting_inputs, entry['tx'], [outindex])
+                    inputs = [(inp.prevout.hash, inp.prevout.n) for inp in inputs]
+                    if self._colorstate is not None and entry['blockhash'] is not None:
+                        self._colorstate.set(color_desc, current_txhash, outindex,
+                                             entry['blockhash'], inputs)
+                    frontier.update(x for x in inputs if x not in visited)
 
         defer.returnValue(tx_lookup)
 
+    @tracing.inlineCallbacks
     def send_raw_transaction(self, txdata):
-        return self.bitcoind.call('sendrawtransaction', [txdata])
+        txhash = yield self.bitcoind.call('sendrawtransaction', [txdata])
+        if self._mempool is not None:
+            self._mempool.add(txhash, txdata)
+        defer.returnValue(txhash)
@@ -1,11 +1,22 @@
-import base64, json
+import base64, time
 
 from zope.interface import implements
 from twisted.internet import defer, protocol, reactor
-from twisted.web import client, http_headers, iweb
+from twisted.web import client, http, http_headers, iweb
+
+from ... import config as cfg
+from ... import jsoncodec
+from ... import metrics
+from ... import tracing
+from ...admission import PrioritySemaphore, PRIORITY_NORMAL
 
 client._HTTP11ClientFactory.noisy = False
 
+RPC_SECONDS = metrics.histogram('ngcccbase_bitcoind_rpc_seconds',
+    'bitcoind JSON-RPC request latency (without waiting for connection)', ('method', 'batch'))
+RPC_ERRORS = metrics.counter('ngcccbase_bitcoind_rpc_errors_total',
+    'Failed bitcoind JSON-RPC calls', ('method',))
+
 
 class StringProducer(object):
     implements(iweb.IBodyProducer)
@@ -27,14 +38,17 @@ class StringProducer(object):
 
 class BodyReceiver(protocol.Protocol):
     def __init__(self, d):
-        self.buf = ''
+        self.buf = []
         self.d = d
 
     def dataReceived(self, data):
-        self.buf += data
+        self.buf.append(data)
 
     def connectionLost(self, reason):
-        self.d.callback(self.buf)
+        if reason.check(client.ResponseDone, http.PotentialDataLoss):
+            self.d.callback(''.join(self.buf))
+        else:
+            self.d.errback(reason)
 
 
 class JSONRPCException(Exception):
@@ -44,9 +58,29 @@ class JSONRPCException(Exception):
         self.error = rpc_error
 
 
+def check_batch(results):
+    """Raise first error from call_batch results, return results otherwise"""
+    for result in results:
+        if isinstance(result, JSONRPCException):
+            raise result
+    return results
+
+
 class BitcoinJSONRPC(object):
     def __init__(self, config):
-        self._agent = client.Agent(reactor)
+        max_connections = cfg.getint(config, 'bitcoind', 'max_connections', 10)
+        # requests above max_connections wait for a free connection, header
+        # sync first, client requests are rejected when too many wait; limits
+        # are per process, every worker process has its own
+        self._semaphore = PrioritySemaphore(max_connections,
+            max_queue=cfg.getint(config, 'bitcoind', 'max_queue', 500),
+            timeout=cfg.getfloat(config, 'bitcoind', 'queue_timeout', 10))
+        metrics.gauge_func('ngcccbase_bitcoind_queue', 'Requests waiting for bitcoind connection',
+                           lambda: len(self._semaphore))
+        self._pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = max_connections
+        self._agent = client.Agent(reactor, pool=self._pool)
+        reactor.addSystemEventTrigger('before', 'shutdown', self._pool.closeCachedConnections)
 
         self._bitcoind_url = 'http://%s:%s/' % (config.get('bitcoind', 'host'), config.get('bitcoind', 'port'))
         authpair = config.get('bitcoind', 'user') + ':' + config.get('bitcoind', 'password')
@@ -60,20 +94,45 @@ class BitcoinJSONRPC(object):
         response.deliverBody(BodyReceiver(d))
         return d
 
-    @defer.inlineCallbacks
-    def call(self, method, params=None):
-        if params is None:
-            params = []
-        data = {"method": method, 'params': params, 'id': 'jsonrpc'}
-
-        request = yield self._agent.request(
-            'POST',
-            self._bitcoind_url,
-            self._headers,
-            StringProducer(json.dumps(data))
-        )
-        response = json.loads((yield self._get_body(request)))
-
+    def _request(self, data, priority, deadline):
+        return tracing.run_in_span('bitcoind:' + self._labels(data)[0], self._queue,
+                                   data, priority, deadline)
+
+    def _queue(self, data, priority, deadline):
+        queued = time.time()
+        def execute(_):
+            d = self._do_request(data, queued)
+            def release(result):
+                self._semaphore.release()
+                return result
+            return d.addBoth(release)
+        return self._semaphore.acquire(priority, deadline).addCallback(tracing.bind(execute))
+
+    def _labels(self, data):
+        if isinstance(data, dict):
+            return data['method'], 'false'
+        methods = set(x['method'] for x in data)
+        return methods.pop() if len(methods) == 1 else 'mixed', 'true'
+
+    @tracing.inlineCallbacks
+    def _do_request(self, data, queued):
+        start = time.time()
+        tracing.record('bitcoind.queue', queued, start)
+        try:
+            request = yield self._agent.request(
+                'POST',
+                self._bitcoind_url,
+                self._headers,
+                StringProducer(jsoncodec.dumps(data))
+            )
+            body = yield self._get_body(request)
+            with tracing.span('json.decode'):
+                response = jsoncodec.loads(body)
+            defer.returnValue(response)
+        finally:
+            RPC_SECONDS.observe(time.time() - start, self._labels(data))
+
+    def _get_result(self, response):
         if response['error'] is not None:
             raise JSONRPCException(response['error'])
         if 'result' not in response:
@@ -81,4 +140,65 @@ class BitcoinJSONRPC(object):
                 'code': -343,
                 'message': 'missing JSON-RPC result',
             })
-        defer.returnValue(response['result'])
+        return response['result']
+
+    @tracing.inlineCallbacks
+    def call(self, method, params=None, priority=PRIORITY_NORMAL, deadline=None):
+        """Call method, deadline defaults to deadline of request handled
+        now; the call fails with DeadlineExceeded if it is not sent by then
+        """
+        if deadline is None:
+            deadline = tracing.deadline()
+        if params is None:
+            params = []
+        data = {"method": method, 'params': params, 'id': 'jsonrpc'}
+
+        try:
+            response = yield self._request(data, priority, deadline)
+            result = self._get_result(response)
+        except Exception:
+            RPC_ERRORS.inc((method,))
+            raise
+        defer.returnValue(result)
+
+    @tracing.inlineCallbacks
+    def call_batch(self, calls, priority=PRIORITY_NORMAL, deadline=None):
+        """Send list of (method, params) as one JSON-RPC batch
+
+        Return list in the same order as calls, failed calls are
+        represented by JSONRPCException instances instead of results.
+        deadline is handled like in call.
+        """
+        if deadline is None:
+            deadline = tracing.deadline()
+        if not calls:
+            defer.returnValue([])
+        data = [{'method': method, 'params': params or [], 'id': i}
+                for i, (method, params) in enumerate(calls)]
+
+        try:
+            responses = yield self._request(data, priority, deadline)
+        except Exception:
+            for method, _ in calls:
+                RPC_ERRORS.inc((method,))
+            raise
+        if not isinstance(responses, list):
+            # bitcoind replies with single error object on malformed batch
+            raise JSONRPCException(responses.get('error') or {
+                'code': -343,
+                'message': 'unexpected JSON-RPC batch response',
+            })
+        if len(responses) != len(calls):
+            raise JSONRPCException({
+                'code': -343,
+                'message': 'JSON-RPC batch response length mismatch',
+            })
+        responses.sort(key=lambda x: x.get('id'))
+        results = []
+        for response in responses:
+            try:
+                results.append(self._get_result(response))
+            except JSONRPCException, e:
+                RPC_ERRORS.inc((calls[response.get('id')][0],))
+                results.append(e)
+        defer.returnValue(results)
@@ -0,0 +1,75 @@
+from twisted.internet import defer
+
+from ...admission import PRIORITY_BACKGROUND
+from bitcoind import JSONRPCException
+
+
+class Mempool(object):
+    """In-memory copy of bitcoind mempool
+
+    Refresh diffs getrawmempool with the current snapshot, so only new txs
+    are fetched from bitcoind. Txs not stored because of max_size are
+    remembered as skipped and not fetched again, lookups of them go to
+    bitcoind.
+    """
+
+    def __init__(self, bitcoind, max_size, batch=100):
+        self._bitcoind = bitcoind
+        self._max_size = max_size
+        self._batch = batch
+        self._txs = {}
+        self._skipped = set()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._txs)
+
+    def __contains__(self, txhash):
+        return txhash in self._txs
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, txhash):
+        return self._txs.get(txhash)
+
+    def add(self, txhash, txhex):
+        if txhash in self._txs:
+            return
+        if self._size + len(txhex) > self._max_size:
+            self._skipped.add(txhash)
+            return
+        self._txs[txhash] = txhex
+        self._size += len(txhex)
+
+    def remove(self, txhashes):
+        for txhash in txhashes:
+            self._skipped.discard(txhash)
+            txhex = self._txs.pop(txhash, None)
+            if txhex is not None:
+                self._size -= len(txhex)
+
+    @defer.inlineCallbacks
+    def refresh(self):
+        txhashes = set((yield self._bitcoind.call('getrawmempool', priority=PRIORITY_BACKGROUND)))
+        self.remove([txhash for txhash in self._txs if txhash not in txhashes])
+        self._skipped.intersection_update(txhashes)
+
+        added = sorted(txhashes.difference(self._txs, self._skipped))
+        for i in xrange(0, len(added), self._batch):
+            batch = added[i:i+self._batch]
+            results = yield self._bitcoind.call_batch(
+                [('getrawtransaction', [txhash]) for txhash in batch],
+                priority=PRIORITY_BACKGROUND)
+            for txhash, txhex in zip(batch, results):
+                # tx could leave mempool after getrawmempool
+                if not isinstance(txhex, JSONRPCException):
+                    self.add(txhash, txhex)
+
+    def stats(self):
+        return {
+            'entries': len(self._txs),
+            'skipped': len(self._skipped),
+            'size':    self._size,
+        }
@@ -0,0 +1,114 @@
+from twisted.internet import defer
+
+from ... import config as cfg
+from ... import tracing
+from ...admission import PRIORITY_NORMAL, PRIORITY_BACKGROUND
+from ..blocks import BlockFiles, parse_block
+from ..cache import LRUCache
+from ..interface import CAP_RAW_BLOCKS
+from backend import Backend, gather_results
+from bitcoind import check_batch
+
+
+def load_block(data, blockhash, is_hex=False):
+    """Return (raw block, parsed block), run in worker thread"""
+    if is_hex:
+        data = data.decode('hex')
+    return data, parse_block(data, blockhash)
+
+
+class RawBlockBackend(Backend):
+    """Backend parsing serialized blocks itself
+
+    Blocks are read from blk*.dat files of bitcoind when [rawblocks]
+    blocks_dir is set, else (and for blocks not found in files) fetched
+    with getblock verbose=0. Txids, tx offsets and merkle tree are taken
+    from one pass over the block in a worker thread, merkle root is
+    checked against the header. Confirmed txs located by txindex are cut
+    out of (cached) raw blocks, so they do not need bitcoind -txindex.
+    Headers are still synced through getblockheader.
+    """
+
+    def __init__(self, config, **kwargs):
+        Backend.__init__(self, config, **kwargs)
+        self.capabilities = self.capabilities | frozenset([CAP_RAW_BLOCKS])
+        self._raw_block_cache = LRUCache(cfg.getint(config, 'rawblocks', 'cache', 32) * 1024*1024)
+        self._block_files = None
+        blocks_dir = cfg.get(config, 'rawblocks', 'blocks_dir', '')
+        if blocks_dir:
+            self._block_files = BlockFiles(
+                blocks_dir, cfg.get(config, 'rawblocks', 'magic', 'f9beb4d9').decode('hex'))
+
+    @tracing.inlineCallbacks
+    def _fetch_raw_blocks(self, blockhashes, priority):
+        """Return list of (raw block, parsed block)"""
+        raws = [None] * len(blockhashes)
+        if self._block_files is not None:
+            raws = yield gather_results([self.workers.run(self._block_files.get, blockhash)
+                                         for blockhash in blockhashes])
+        missing = [i for i, raw in enumerate(raws) if raw is None]
+        if missing:
+            fetched = check_batch((yield self.bitcoind.call_batch(
+                [('getblock', [blockhashes[i], False]) for i in missing], priority=priority)))
+            for i, data in zip(missing, fetched):
+                raws[i] = data
+        missing = set(missing)
+        blocks = yield gather_results([
+            self.workers.run_process(load_block, raw, blockhash, i in missing)
+            for i, (raw, blockhash) in enumerate(zip(raws, blockhashes))])
+        defer.returnValue(blocks)
+
+    def _cache_raw_block(self, blockhash, raw, block):
+        self._raw_block_cache.set(blockhash, (raw, block['tx']), len(raw) + 150*len(block['tx']))
+
+    @tracing.inlineCallbacks
+    def _fetch_txids(self, blockhashes):
+        blocks = yield self._fetch_raw_blocks(blockhashes, PRIORITY_BACKGROUND)
+        defer.returnValue([block['txids'] for _, block in blocks])
+
+    @tracing.inlineCallbacks
+    def _load_block(self, blockhash):
+        header, blocks = yield gather_results([
+            self.bitcoind.call('getblockheader', [blockhash]),
+            self._fetch_raw_blocks([blockhash], PRIORITY_NORMAL)])
+        raw, block = blocks[0]
+        # orphaned blocks have confirmations -1
+        main_chain = header.get('confirmations', 0) > 0
+        if main_chain:
+            self._cache_raw_block(blockhash, raw, block)
+        defer.returnValue(({'height': header['height'], 'tree': block['tree']}, main_chain))
+
+    @tracing.inlineCallbacks
+    def _load_transaction(self, txhash):
+        location = None
+        if self._txindex is not None:
+            location = self._txindex.get(txhash)
+        if location is not None and location[0] <= self.current_height:
+            height = location[0]
+            blockhash = self._block_hash(height)
+            entry = self._raw_block_cache.get(blockhash)
+            block = None
+            if entry is None:
+                raw, block = (yield self._fetch_raw_blocks([blockhash], PRIORITY_NORMAL))[0]
+                entry = (raw, block['tx'])
+            # headers could be replaced while we were waiting
+            main_chain = height <= self.current_height and self._block_hash(height) == blockhash
+            if block is not None and main_chain:
+                self._cache_raw_block(blockhash, raw, block)
+            raw, offsets = entry
+            if txhash in offsets:
+                start, end = offsets[txhash]
+                defer.returnValue(({'hex': raw[start:end].encode('hex'), 'blockhash': blockhash},
+                                   main_chain))
+        result = yield Backend._load_transaction(self, txhash)
+        defer.returnValue(result)
+
+    def _invalidate_blocks(self, height, orphaned):
+        Backend._invalidate_blocks(self, height, orphaned)
+        for blockhash in orphaned:
+            self._raw_block_cache.pop(blockhash)
+
+    def cache_stats(self):
+        stats = Backend.cache_stats(self)
+        stats['raw_blocks'] = self._raw_block_cache.stats()
+        return stats
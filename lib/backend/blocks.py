@@ -0,0 +1,167 @@
+import os
+import re
+import struct
+import threading
+
+from hashes import hash_digest
+from headers import HEADER_SIZE
+from merkle import MerkleTree
+
+
+class InvalidBlock(Exception):
+    pass
+
+
+def read_varint(data, offset):
+    """Return (value, offset after it)"""
+    n = ord(data[offset])
+    if n < 0xfd:
+        return n, offset + 1
+    size = {0xfd: 2, 0xfe: 4, 0xff: 8}[n]
+    return struct.unpack('<' + {2: 'H', 4: 'I', 8: 'Q'}[size], data[offset+1:offset+1+size])[0], \
+        offset + 1 + size
+
+
+def _parse_tx(data, offset):
+    """Return (txid, offset after tx), witness data is skipped for txid"""
+    start = offset
+    offset += 4
+    segwit = data[offset] == '\x00' and data[offset+1] == '\x01'
+    if segwit:
+        offset += 2
+    body_start = offset
+    inputs, offset = read_varint(data, offset)
+    for _ in xrange(inputs):
+        script_size, offset = read_varint(data, offset + 36)
+        offset += script_size + 4
+    outputs, offset = read_varint(data, offset)
+    for _ in xrange(outputs):
+        script_size, offset = read_varint(data, offset + 8)
+        offset += script_size
+    body_end = offset
+    if segwit:
+        for _ in xrange(inputs):
+            items, offset = read_varint(data, offset)
+            for _ in xrange(items):
+                size, offset = read_varint(data, offset)
+                offset += size
+    offset += 4
+    if offset > len(data):
+        raise InvalidBlock('truncated transaction')
+    if segwit:
+        txid = hash_digest(data[start:start+4] + data[body_start:body_end] + data[offset-4:offset])
+    else:
+        txid = hash_digest(data[start:offset])
+    return txid[::-1].encode('hex'), offset
+
+
+def parse_block(raw, blockhash=None):
+    """Parse serialized block in one pass
+
+    Return dict with header, txids, tx (txid -> (start, end) of serialized
+    tx in raw) and merkle tree. Block hash (when given) and merkle root
+    are checked against the header.
+    """
+    header = raw[:HEADER_SIZE]
+    if len(header) != HEADER_SIZE:
+        raise InvalidBlock('truncated header')
+    if blockhash is not None and hash_digest(header)[::-1].encode('hex') != blockhash:
+        raise InvalidBlock('block hash mismatch')
+    try:
+        count, offset = read_varint(raw, HEADER_SIZE)
+        txids, txs = [], {}
+        for _ in xrange(count):
+            txid, end = _parse_tx(raw, offset)
+            txids.append(txid)
+            txs[txid] = (offset, end)
+            offset = end
+    except (IndexError, KeyError, struct.error):
+        raise InvalidBlock('truncated block')
+    if offset != len(raw):
+        raise InvalidBlock('trailing data after transactions')
+    tree = MerkleTree(txids)
+    if not txids or tree.root != header[36:68][::-1].encode('hex'):
+        raise InvalidBlock('merkle root mismatch')
+    return {'header': header, 'txids': txids, 'tx': txs, 'tree': tree}
+
+
+class BlockFiles(object):
+    """Read raw blocks straight from blk*.dat files of bitcoind
+
+    Files are scanned (record headers only) on first lookup of unknown
+    block and index blockhash -> location is kept in memory, files written
+    later are scanned incrementally. Blocks obfuscated with xor.dat key
+    (Bitcoin Core 28+) are supported. Blocking, call from worker threads.
+    """
+
+    FILE_RE = re.compile(r'^blk(\d{5})\.dat$')
+
+    def __init__(self, path, magic):
+        self._path = path
+        self._magic = magic
+        self._lock = threading.Lock()
+        # blockhash (internal byte order) -> packed (file number, offset, size)
+        self._index = {}
+        # file number -> scanned bytes
+        self._scanned = {}
+        self._key = '\x00' * 8
+        xor_path = os.path.join(path, 'xor.dat')
+        if os.path.exists(xor_path):
+            with open(xor_path, 'rb') as f:
+                self._key = f.read(8)
+
+    def __len__(self):
+        return len(self._index)
+
+    def _filename(self, number):
+        return os.path.join(self._path, 'blk%05d.dat' % number)
+
+    def _read(self, f, offset, size):
+        f.seek(offset)
+        data = f.read(size)
+        if self._key == '\x00' * 8 or not data:
+            return data
+        shift = offset % 8
+        key = (self._key[shift:] + self._key[:shift]) * (len(data) // 8 + 1)
+        value = int(data.encode('hex'), 16) ^ int(key[:len(data)].encode('hex'), 16)
+        return ('%x' % value).zfill(2 * len(data)).decode('hex')
+
+    def _scan(self):
+        numbers = sorted(int(m.group(1)) for m in map(self.FILE_RE.match, os.listdir(self._path)) if m)
+        for number in numbers:
+            filename = self._filename(number)
+            offset = self._scanned.get(number, 0)
+            file_size = os.path.getsize(filename)
+            if offset >= file_size:
+                continue
+            with open(filename, 'rb') as f:
+                while offset + 8 + HEADER_SIZE <= file_size:
+                    record = self._read(f, offset, 8 + HEADER_SIZE)
+                    if record[:4] != self._magic:
+                        # preallocated zeroes or partially written record
+                        break
+                    size = struct.unpack('<I', record[4:8])[0]
+                    if offset + 8 + size > file_size:
+                        break
+                    self._index[hash_digest(record[8:])] = struct.pack('<HQI', number, offset + 8, size)
+                    offset += 8 + size
+            self._scanned[number] = offset
+
+    def get(self, blockhash):
+        """Return raw block or None if not found in files"""
+        digest = blockhash.decode('hex')[::-1]
+        with self._lock:
+            location = self._index.get(digest)
+            if location is None:
+                self._scan()
+                location = self._index.get(digest)
+        if location is None:
+            return None
+        number, offset, size = struct.unpack('<HQI', location)
+        try:
+            with open(self._filename(number), 'rb') as f:
+                data = self._read(f, offset, size)
+        except IOError:
+            # pruned
+            return None
+        return data if len(data) == size else None
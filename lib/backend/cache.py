@@ -0,0 +1,71 @@
+import collections
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by total size of stored values
+
+    Size of every value is given by the caller on set, so the cache does not
+    need to know anything about the values.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._size = 0
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key, default=None):
+        try:
+            value, size = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = (value, size)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, size):
+        if size > self._max_size:
+            return
+        self.pop(key)
+        self._data[key] = (value, size)
+        self._size += size
+        while self._size > self._max_size:
+            _, (_, old_size) = self._data.popitem(last=False)
+            self._size -= old_size
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        value, size = self._data.pop(key)
+        self._size -= size
+        return value
+
+    def remove_if(self, predicate):
+        """Remove all entries for which predicate(key, value) is true"""
+        for key, (value, _) in self._data.items():
+            if predicate(key, value):
+                self.pop(key)
+
+    def clear(self):
+        self._data.clear()
+        self._size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'size':    self._size,
+            'hits':    self.hits,
+            'misses':  self.misses,
+        }
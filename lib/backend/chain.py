@@ -0,0 +1,106 @@
+import os
+
+from hashes import hash_digest
+from headers import HEADER_SIZE
+
+
+HASH_SIZE = 32
+
+
+class InvalidHeader(Exception):
+    pass
+
+
+def bits_to_target(bits):
+    """Decode compact target, raise InvalidHeader on negative or overflow"""
+    exponent, mantissa = bits >> 24, bits & 0x007fffff
+    if bits & 0x00800000:
+        raise InvalidHeader('negative target')
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    if exponent > 34:
+        raise InvalidHeader('target overflow')
+    return mantissa << (8 * (exponent - 3))
+
+
+def _le_int(data):
+    return int(data[::-1].encode('hex'), 16)
+
+
+def link_headers(prev_hash, raw_headers, max_target):
+    """Check headers link to prev_hash and each other and have valid PoW
+
+    Return (hashes, count): concatenated hashes (in internal byte order) of
+    the first count headers which are linked. Linked header with invalid
+    proof-of-work raises InvalidHeader.
+    """
+    hashes = []
+    for offset in xrange(0, len(raw_headers), HEADER_SIZE):
+        header = raw_headers[offset:offset+HEADER_SIZE]
+        if prev_hash is not None and header[4:36] != prev_hash:
+            break
+        prev_hash = hash_digest(header)
+        target = bits_to_target(_le_int(header[72:76]))
+        if not 0 < target <= max_target:
+            raise InvalidHeader('bits out of range in header %s' % prev_hash[::-1].encode('hex'))
+        if _le_int(prev_hash) > target:
+            raise InvalidHeader('invalid proof-of-work in header %s' % prev_hash[::-1].encode('hex'))
+        hashes.append(prev_hash)
+    return ''.join(hashes), len(hashes)
+
+
+def hash_headers(raw_headers):
+    """Return concatenated hashes of raw headers"""
+    return ''.join(hash_digest(raw_headers[i:i+HEADER_SIZE])
+                   for i in xrange(0, len(raw_headers), HEADER_SIZE))
+
+
+class HashIndex(object):
+    """In-memory height -> block hash index
+
+    Hashes are kept in one bytearray, 32 bytes per block. The index can be
+    saved to a file, so a restart hashes only headers added since.
+    """
+
+    def __init__(self, hashes=''):
+        self._data = bytearray(hashes)
+
+    @classmethod
+    def load(cls, path):
+        """Return index saved at path, empty if there is none"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return cls()
+        return cls(data[:len(data) - len(data) % HASH_SIZE])
+
+    def save(self, path):
+        """Write index to path, old file is replaced at once"""
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self._data)
+        os.rename(path + '.tmp', path)
+
+    def __len__(self):
+        return len(self._data) // HASH_SIZE
+
+    def digest(self, height):
+        """Return hash in internal byte order"""
+        if height < 0 or height >= len(self):
+            raise IndexError('height out of range')
+        return str(self._data[height*HASH_SIZE:(height+1)*HASH_SIZE])
+
+    def get(self, height):
+        """Return hex blockhash"""
+        return self.digest(height)[::-1].encode('hex')
+
+    def append(self, hashes):
+        self._data.extend(hashes)
+
+    def replace(self, height, hashes):
+        """Same as HeadersStore.replace"""
+        del self._data[height*HASH_SIZE:]
+        self._data.extend(hashes)
+
+    def truncate(self, height):
+        del self._data[max(0, height)*HASH_SIZE:]
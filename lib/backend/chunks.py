@@ -0,0 +1,30 @@
+import gzip
+import binascii
+import cStringIO
+
+from hashes import hash_digest
+from headers import HEADER_SIZE
+
+
+CHUNK_SIZE = 2016
+
+
+def gzip_compress(data):
+    buf = cStringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def build_chunk(raw):
+    """Return ready to send bodies of completed chunk"""
+    last_hash = hash_digest(raw[-HEADER_SIZE:])
+    return {
+        # hash of last header commits to the whole chunk
+        'etag': last_hash[::-1].encode('hex'),
+        'hex': binascii.hexlify(raw),
+        'raw_gzip': gzip_compress(raw),
+    }
+
+def chunk_size(chunk):
+    return len(chunk['hex']) + len(chunk['raw_gzip']) + 200
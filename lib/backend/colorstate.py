@@ -0,0 +1,136 @@
+import sqlite3
+import struct
+import urllib
+
+from cache import LRUCache
+
+
+def _encode_outpoints(outpoints):
+    return buffer(''.join(txhash.decode('hex') + struct.pack('<I', n) for txhash, n in outpoints))
+
+def _decode_outpoints(data):
+    data = str(data)
+    return [(data[i:i+32].encode('hex'), struct.unpack('<I', data[i+32:i+36])[0])
+            for i in xrange(0, len(data), 36)]
+
+# seconds to wait for a lock; with WAL readers and the single writer only
+#  wait for each other during checkpoints
+BUSY_TIMEOUT = 5
+
+
+class ColorStateCache(object):
+    """(color_desc, outpoint) -> outpoints affecting its colorvalue
+
+    Affecting inputs are fixed by tx content, so entries never go stale
+    while the tx stays in the main chain. Entries remember blockhash of
+    the tx and are dropped when the block is orphaned. Recently used
+    entries are kept in memory, writes are batched until flush(). On-disk
+    entries above max_entries are evicted least recently used first.
+
+    One process (the syncer) writes the database, in readonly mode it is
+    only read: new entries stay in memory and uses do not count for
+    eviction.
+    """
+
+    def __init__(self, path, max_entries=1000000, memory_entries=100000, readonly=False):
+        self._readonly = readonly
+        self._max_entries = max_entries
+        self._memory = LRUCache(memory_entries)
+        # key -> (blockhash, inputs) not written yet, keys used since flush
+        self._pending = {}
+        self._touched = set()
+        if readonly:
+            self._conn = sqlite3.connect('file:%s?mode=ro' % urllib.quote(path),
+                                         timeout=BUSY_TIMEOUT)
+            return
+
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS colorstate ('
+                           'color_desc TEXT, txhash BLOB, outindex INTEGER, blockhash BLOB, '
+                           'inputs BLOB, used INTEGER, PRIMARY KEY (color_desc, txhash, outindex))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS colorstate_blockhash ON colorstate (blockhash)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS colorstate_used ON colorstate (used)')
+        self._conn.commit()
+        self._count = self._conn.execute('SELECT COUNT(*) FROM colorstate').fetchone()[0]
+        row = self._conn.execute('SELECT MAX(used) FROM colorstate').fetchone()
+        self._clock = (row[0] or 0) + 1
+
+    def get(self, color_desc, txhash, outindex):
+        """Return list of (txhash, outindex) or None if not known"""
+        key = (color_desc, txhash, outindex)
+        entry = self._memory.get(key)
+        if entry is None:
+            row = self._conn.execute(
+                'SELECT blockhash, inputs FROM colorstate WHERE '
+                'color_desc = ? AND txhash = ? AND outindex = ?',
+                (color_desc, buffer(txhash.decode('hex')), outindex)).fetchone()
+            if row is None:
+                return None
+            entry = (str(row[0]).encode('hex'), _decode_outpoints(row[1]))
+            self._memory.set(key, entry, 1)
+        if not self._readonly:
+            self._touched.add(key)
+        return entry[1]
+
+    def set(self, color_desc, txhash, outindex, blockhash, inputs):
+        key = (color_desc, txhash, outindex)
+        entry = (blockhash, list(inputs))
+        self._memory.set(key, entry, 1)
+        if not self._readonly:
+            self._pending[key] = entry
+
+    def remove_blocks(self, blockhashes):
+        """Drop entries of txs from orphaned blocks"""
+        blockhashes = set(blockhashes)
+        if not blockhashes:
+            return
+        self._memory.remove_if(lambda key, entry: entry[0] in blockhashes)
+        if self._readonly:
+            # writer sees the same reorg
+            return
+        for key, entry in self._pending.items():
+            if entry[0] in blockhashes:
+                del self._pending[key]
+        with self._conn:
+            cursor = self._conn.executemany('DELETE FROM colorstate WHERE blockhash = ?',
+                                            ((buffer(x.decode('hex')),) for x in blockhashes))
+            self._count -= max(0, cursor.rowcount)
+
+    def flush(self):
+        """Write pending entries and evict least recently used ones"""
+        if not self._pending and not self._touched:
+            return
+        used, self._clock = self._clock, self._clock + 1
+        with self._conn:
+            cursor = self._conn.executemany(
+                'INSERT OR IGNORE INTO colorstate VALUES (?, ?, ?, ?, ?, ?)',
+                ((color_desc, buffer(txhash.decode('hex')), outindex,
+                  buffer(blockhash.decode('hex')), _encode_outpoints(inputs), used)
+                 for (color_desc, txhash, outindex), (blockhash, inputs) in self._pending.iteritems()))
+            self._count += max(0, cursor.rowcount)
+            self._conn.executemany(
+                'UPDATE colorstate SET used = ? WHERE color_desc = ? AND txhash = ? AND outindex = ?',
+                ((used, color_desc, buffer(txhash.decode('hex')), outindex)
+                 for color_desc, txhash, outindex in self._touched))
+            if self._count > self._max_entries:
+                self._conn.execute(
+                    'DELETE FROM colorstate WHERE rowid IN '
+                    '(SELECT rowid FROM colorstate ORDER BY used LIMIT ?)',
+                    (self._count - self._max_entries,))
+                self._count = self._max_entries
+        self._pending.clear()
+        self._touched.clear()
+
+    def stats(self):
+        """Stats of in-memory part and number of entries on disk (known
+        to the writer only)
+        """
+        stats = self._memory.stats()
+        if not self._readonly:
+            stats['stored'] = self._count
+        return stats
+
+    def close(self):
+        self.flush()
+        self._conn.close()
@@ -0,0 +1,6 @@
+import hashlib
+
+
+def hash_digest(x):
+    """Double SHA-256, as used for block, tx and merkle hashes"""
+    return hashlib.sha256(hashlib.sha256(x).digest()).digest()
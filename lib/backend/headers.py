@@ -0,0 +1,142 @@
+import os
+import mmap
+
+
+HEADER_SIZE = 80
+# grow the file by one retarget period at a time
+PREALLOCATE = 2016 * HEADER_SIZE
+
+_EMPTY_HEADER = '\x00' * HEADER_SIZE
+
+
+class HeadersStore(object):
+    """Append-only blockchain_headers file mapped into memory
+
+    The file is preallocated with zeroes, so the real number of headers is
+    found on open by skipping empty records at the tail. A valid header
+    never is all zeroes (version and bits are non-zero).
+
+    In readonly mode another process writes the file and refresh() picks
+    up its changes.
+    """
+
+    def __init__(self, path, readonly=False):
+        self._path = path
+        self._readonly = readonly
+        self._mmap = None
+        self._count = 0
+        if readonly:
+            self._fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0644)
+            self.refresh()
+            return
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        size = os.fstat(self._fd).st_size
+        if size % HEADER_SIZE:
+            size -= size % HEADER_SIZE
+            os.ftruncate(self._fd, size)
+        if size == 0:
+            size = PREALLOCATE
+            os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+        self._recount(size / HEADER_SIZE)
+
+    def _recount(self, count):
+        total = len(self._mmap) / HEADER_SIZE if self._mmap is not None else 0
+        count = min(count, total)
+        while count < total and self._get(count) != _EMPTY_HEADER:
+            count += 1
+        while count > 0 and self._get(count - 1) == _EMPTY_HEADER:
+            count -= 1
+        self._count = count
+
+    def _get(self, index):
+        return self._mmap[index*HEADER_SIZE:(index+1)*HEADER_SIZE]
+
+    def refresh(self):
+        """Pick up headers written by another process (readonly mode)"""
+        size = os.fstat(self._fd).st_size
+        size -= size % HEADER_SIZE
+        if size == 0:
+            self._mmap, self._count = None, 0
+            return
+        if self._mmap is None or size != len(self._mmap):
+            # old map is unmapped when last buffer referencing it is gone
+            self._mmap = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        self._recount(self._count)
+
+    def _ensure_size(self, size):
+        if size <= len(self._mmap):
+            return
+        size += PREALLOCATE - size % PREALLOCATE
+        os.ftruncate(self._fd, size)
+        self._mmap.resize(size)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def height(self):
+        return self._count - 1
+
+    def get(self, height):
+        """Return buffer with raw header at height"""
+        if height < 0 or height >= self._count:
+            raise IndexError('height out of range')
+        return buffer(self._mmap, height*HEADER_SIZE, HEADER_SIZE)
+
+    def get_range(self, start, stop):
+        """Return buffer with raw headers from start to stop (not inclusive)"""
+        start = max(0, start)
+        stop = min(self._count, stop)
+        if start >= stop:
+            return buffer('')
+        return buffer(self._mmap, start*HEADER_SIZE, (stop-start)*HEADER_SIZE)
+
+    def append(self, raw_headers):
+        if len(raw_headers) % HEADER_SIZE:
+            raise ValueError('raw headers length not a multiple of %d' % HEADER_SIZE)
+        offset = self._count * HEADER_SIZE
+        self._ensure_size(offset + len(raw_headers))
+        self._mmap[offset:offset+len(raw_headers)] = raw_headers
+        self._count += len(raw_headers) / HEADER_SIZE
+
+    def replace(self, height, raw_headers):
+        """Write raw_headers from height in one go, old headers above the
+        new tip are dropped
+        """
+        if len(raw_headers) % HEADER_SIZE:
+            raise ValueError('raw headers length not a multiple of %d' % HEADER_SIZE)
+        if height < 0 or height > self._count:
+            raise IndexError('height out of range')
+        offset = height * HEADER_SIZE
+        end = offset + len(raw_headers)
+        old_end = self._count * HEADER_SIZE
+        self._ensure_size(end)
+        self._mmap[offset:max(end, old_end)] = raw_headers + '\x00' * max(0, old_end - end)
+        self._count = end / HEADER_SIZE
+
+    def truncate(self, height):
+        """Drop all headers from height and above"""
+        height = max(0, height)
+        if height >= self._count:
+            return
+        offset = height * HEADER_SIZE
+        self._mmap[offset:self._count*HEADER_SIZE] = \
+            '\x00' * ((self._count - height) * HEADER_SIZE)
+        self._count = height
+
+    def flush(self):
+        self._mmap.flush()
+        os.fsync(self._fd)
+
+    def close(self, trim=True):
+        """Close store, trim leaves exactly the stored headers on disk,
+        it must be off while readonly processes use the file
+        """
+        if not self._readonly:
+            self.flush()
+            self._mmap.close()
+            if trim:
+                os.ftruncate(self._fd, self._count * HEADER_SIZE)
+        os.close(self._fd)
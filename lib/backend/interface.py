@@ -0,0 +1,75 @@
+from zope.interface import Attribute, Interface
+
+
+# own txhash -> block index, confirmed txs are located without bitcoind
+CAP_TXINDEX = 'txindex'
+# unconfirmed txs are served from mempool snapshot
+CAP_MEMPOOL = 'mempool'
+# color-affecting inputs are cached across prefetch calls
+CAP_COLORSTATE = 'colorstate'
+# blocks are parsed by the server, merkle roots are checked against headers
+CAP_RAW_BLOCKS = 'raw_blocks'
+# sendrawtransaction is supported
+CAP_BROADCAST = 'broadcast'
+
+
+class IBackend(Interface):
+    """Chain data source behind the transport
+
+    Methods return plain values or Deferreds, errors are raised as
+    exceptions (or failures) with message for the client.
+    """
+
+    capabilities = Attribute('frozenset of CAP_* flags')
+
+    current_height = Attribute('height of synced headers, -1 before first sync')
+
+    def notify_block():
+        """New block trigger, check bitcoind for new headers now"""
+
+    def cache_stats():
+        """Return dict cache name -> stats dict"""
+
+    def get_block_count():
+        pass
+
+    def get_header(height):
+        pass
+
+    def get_headers(start, count):
+        pass
+
+    def get_headers_raw(start, count):
+        pass
+
+    def get_chunk(index):
+        pass
+
+    def get_chunk_raw(index):
+        pass
+
+    def get_completed_chunk(index):
+        """Return dict with etag, hex and raw_gzip of completed chunk or None"""
+
+    def wait_headers(height, timeout):
+        """Fire with current height and headers after height when there
+        are any, or when timeout expires
+        """
+
+    def get_merkle(txhash, blockhash):
+        pass
+
+    def get_merkles(txhashes, blockhash=None):
+        """Return list of merkle branches, None for unconfirmed and unknown txs"""
+
+    def get_raw_transaction(txhash):
+        pass
+
+    def get_tx_blockhash(txhash):
+        """Return [blockhash, unconfirmed]"""
+
+    def prefetch(txhash, output_set, color_desc, limit):
+        """Return dict txhash -> raw tx of txs needed to compute colorvalues"""
+
+    def send_raw_transaction(txdata):
+        pass
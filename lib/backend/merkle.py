@@ -0,0 +1,52 @@
+from hashes import hash_digest
+
+
+class MerkleTree(object):
+    """Merkle tree of one block
+
+    All levels are built once in linear time, after that a branch for any
+    tx of the block costs O(log n).
+    """
+
+    def __init__(self, txhashes):
+        self._index = dict((txhash, pos) for pos, txhash in enumerate(txhashes))
+        level = [txhash.decode('hex')[::-1] for txhash in txhashes]
+        self._levels = [level]
+        while len(level) > 1:
+            # odd level is balanced by hashing last element with itself
+            level = [hash_digest(level[i] + level[min(i+1, len(level)-1)])
+                     for i in xrange(0, len(level), 2)]
+            self._levels.append(level)
+
+    def __len__(self):
+        return len(self._levels[0])
+
+    def __contains__(self, txhash):
+        return txhash in self._index
+
+    @property
+    def root(self):
+        return self._levels[-1][0][::-1].encode('hex')
+
+    @property
+    def size(self):
+        """Rough memory usage in bytes"""
+        return sum(len(level) for level in self._levels) * 70 + len(self._index) * 170
+
+    def txhashes(self):
+        return [x[::-1].encode('hex') for x in self._levels[0]]
+
+    def position(self, txhash):
+        if txhash not in self._index:
+            raise Exception('txhash not in block')
+        return self._index[txhash]
+
+    def branch(self, txhash):
+        """Return list of hex encoded hashes from tx up to merkle root"""
+        pos = self.position(txhash)
+        branch = []
+        for level in self._levels[:-1]:
+            sibling = min(pos ^ 1, len(level) - 1)
+            branch.append(level[sibling][::-1].encode('hex'))
+            pos >>= 1
+        return branch
@@ -0,0 +1,60 @@
+import functools
+
+from twisted.internet import defer
+from twisted.python import failure
+
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return tuple(sorted((key, _freeze(value)) for key, value in obj.iteritems()))
+    if isinstance(obj, (list, tuple, set)):
+        return tuple(_freeze(x) for x in obj)
+    return obj
+
+
+class SingleFlight(object):
+    """Share one in-flight call between concurrent callers with the same key
+
+    Every caller gets own Deferred, so callbacks added by one caller never
+    see results changed by another. Nothing is kept after the call is done.
+    """
+
+    def __init__(self):
+        self._waiters = {}
+        self.calls = 0
+        self.deduplicated = 0
+
+    def call(self, key, func, *args, **kwargs):
+        self.calls += 1
+        d = defer.Deferred()
+        if key in self._waiters:
+            self.deduplicated += 1
+            self._waiters[key].append(d)
+            return d
+
+        waiters = self._waiters[key] = [d]
+        def fire(result):
+            del self._waiters[key]
+            for waiter in waiters:
+                if isinstance(result, failure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+        defer.maybeDeferred(func, *args, **kwargs).addBoth(fire)
+        return d
+
+    def stats(self):
+        return {
+            'calls':        self.calls,
+            'deduplicated': self.deduplicated,
+            'in_flight':    len(self._waiters),
+        }
+
+
+def coalesce(method):
+    """Decorator for methods of objects with a SingleFlight in _singleflight"""
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        key = (method.__name__, _freeze(args))
+        return self._singleflight.call(key, method, self, *args)
+    return wrapper
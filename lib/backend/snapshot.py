@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import time
+
+from chain import InvalidHeader, link_headers
+from colorstate import ColorStateCache
+from hashes import hash_digest
+from headers import HEADER_SIZE, HeadersStore
+from txindex import TxIndex
+
+
+SNAPSHOT_VERSION = 1
+
+HEADERS_FILE = 'blockchain_headers'
+TXINDEX_FILE = 'txindex.sqlite'
+COLORSTATE_FILE = 'colorstate.sqlite'
+MANIFEST_FILE = 'MANIFEST.json'
+SNAPSHOT_FILES = (HEADERS_FILE, TXINDEX_FILE, COLORSTATE_FILE)
+
+READ_SIZE = 1024*1024
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _sha256_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(READ_SIZE), ''):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def _copy_txindex(src, dst, height):
+    """Copy txindex rows of blocks up to height in one read transaction"""
+    TxIndex(dst).close()
+    conn = sqlite3.connect(src, isolation_level=None)
+    try:
+        conn.execute('ATTACH DATABASE ? AS snapshot', (dst,))
+        conn.execute('BEGIN')
+        row = conn.execute('SELECT value FROM main.meta WHERE key = ?', ('height',)).fetchone()
+        height = min(height, -1 if row is None else row[0])
+        conn.execute('INSERT INTO snapshot.txindex SELECT txhash, height, pos FROM main.txindex '
+                     'WHERE height <= ?', (height,))
+        conn.execute('INSERT OR REPLACE INTO snapshot.meta (key, value) VALUES (?, ?)',
+                     ('height', height))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return height
+
+
+def _copy_colorstate(src, dst, blockhashes):
+    """Copy colorstate entries of txs in blocks with given hashes"""
+    ColorStateCache(dst).close()
+    conn = sqlite3.connect(src)
+    try:
+        conn.execute('ATTACH DATABASE ? AS snapshot', (dst,))
+        conn.execute('CREATE TEMP TABLE blocks (blockhash BLOB PRIMARY KEY)')
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO temp.blocks VALUES (?)',
+                             ((buffer(x),) for x in blockhashes))
+            conn.execute('INSERT INTO snapshot.colorstate SELECT colorstate.* FROM main.colorstate '
+                         'JOIN temp.blocks ON colorstate.blockhash = blocks.blockhash')
+    finally:
+        conn.close()
+
+
+def export_snapshot(store_path, filename, max_target, confirmations=100):
+    """Write snapshot of store to filename (tar, gzipped for .gz name)
+
+    Store can be in use by running server. Headers are exported up to
+    confirmations blocks below the tip, so the exported chain is not
+    changed by a usual reorg while txindex and colorstate are copied.
+    Return manifest.
+    """
+    headers = HeadersStore(os.path.join(store_path, HEADERS_FILE), readonly=True)
+    try:
+        height = headers.height - confirmations
+        if height < 0:
+            raise SnapshotError('not enough headers to export')
+        raw_headers = str(headers.get_range(0, height + 1))
+        hashes, count = link_headers(None, raw_headers, max_target)
+        if count != height + 1:
+            raise SnapshotError('stored headers do not link at height %d' % count)
+
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with open(os.path.join(tmpdir, HEADERS_FILE), 'wb') as f:
+                f.write(raw_headers)
+            manifest = {
+                'version': SNAPSHOT_VERSION,
+                'time': int(time.time()),
+                'height': height,
+                'blockhash': hashes[-32:][::-1].encode('hex'),
+                'files': {},
+            }
+            if os.path.exists(os.path.join(store_path, TXINDEX_FILE)):
+                manifest['txindex_height'] = _copy_txindex(
+                    os.path.join(store_path, TXINDEX_FILE), os.path.join(tmpdir, TXINDEX_FILE), height)
+            if os.path.exists(os.path.join(store_path, COLORSTATE_FILE)):
+                # colorstate keeps blockhashes in display byte order
+                blockhashes = (hashes[i:i+32][::-1] for i in xrange(0, len(hashes), 32))
+                _copy_colorstate(os.path.join(store_path, COLORSTATE_FILE),
+                                 os.path.join(tmpdir, COLORSTATE_FILE), blockhashes)
+
+            # copied indexes are consistent with headers only if the
+            # exported part of chain was not reorged in the meantime
+            headers.refresh()
+            if headers.height < height or str(headers.get(height)) != raw_headers[-HEADER_SIZE:]:
+                raise SnapshotError('chain changed during export, try again')
+
+            names = sorted(os.listdir(tmpdir))
+            for name in names:
+                path = os.path.join(tmpdir, name)
+                manifest['files'][name] = {'size': os.path.getsize(path), 'sha256': _sha256_file(path)}
+            with open(os.path.join(tmpdir, MANIFEST_FILE), 'wb') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+
+            mode = 'w:gz' if filename.endswith('.gz') else 'w'
+            with tarfile.open(filename + '.tmp', mode) as tar:
+                # manifest goes first so import can check files as they come
+                for name in [MANIFEST_FILE] + names:
+                    tar.add(os.path.join(tmpdir, name), name)
+            os.rename(filename + '.tmp', filename)
+        finally:
+            shutil.rmtree(tmpdir)
+            if os.path.exists(filename + '.tmp'):
+                os.remove(filename + '.tmp')
+    finally:
+        headers.close(trim=False)
+    return manifest
+
+
+def _extract(tar, member, path, expected):
+    sha256 = hashlib.sha256()
+    size = 0
+    src = tar.extractfile(member)
+    with open(path, 'wb') as dst:
+        for data in iter(lambda: src.read(READ_SIZE), ''):
+            sha256.update(data)
+            size += len(data)
+            dst.write(data)
+    if size != expected['size'] or sha256.hexdigest() != expected['sha256']:
+        raise SnapshotError('checksum mismatch in %s' % member.name)
+
+
+def import_snapshot(filename, store_path, max_target, verify=False):
+    """Unpack snapshot into empty store, return manifest
+
+    Every file is checked against sha256 from manifest, with verify all
+    headers are checked to link and have valid proof-of-work. Server
+    started on the store catches up with bitcoind from snapshot height.
+    """
+    headers_path = os.path.join(store_path, HEADERS_FILE)
+    if os.path.exists(headers_path):
+        headers = HeadersStore(headers_path, readonly=True)
+        empty = headers.height < 0
+        headers.close(trim=False)
+        if not empty:
+            raise SnapshotError('store %s is not empty' % store_path)
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path)
+
+    paths = []
+    try:
+        with tarfile.open(filename, 'r:*') as tar:
+            member = tar.next()
+            if member is None or member.name != MANIFEST_FILE:
+                raise SnapshotError('manifest not found')
+            manifest = json.load(tar.extractfile(member))
+            if manifest.get('version') != SNAPSHOT_VERSION:
+                raise SnapshotError('unsupported snapshot version %r' % manifest.get('version'))
+            files = manifest['files']
+            if HEADERS_FILE not in files:
+                raise SnapshotError('%s not in snapshot' % HEADERS_FILE)
+            if not set(files) <= set(SNAPSHOT_FILES):
+                raise SnapshotError('unknown files in snapshot manifest')
+
+            extracted = set()
+            while True:
+                member = tar.next()
+                if member is None:
+                    break
+                if member.name not in files or member.name in extracted or not member.isfile():
+                    raise SnapshotError('unexpected file %s in snapshot' % member.name)
+                path = os.path.join(store_path, member.name + '.tmp')
+                paths.append(path)
+                _extract(tar, member, path, files[member.name])
+                extracted.add(member.name)
+            if extracted != set(files):
+                raise SnapshotError('missing files in snapshot: %s' %
+                                    ', '.join(sorted(set(files) - extracted)))
+
+        with open(os.path.join(store_path, HEADERS_FILE + '.tmp'), 'rb') as f:
+            raw_headers = f.read()
+        if len(raw_headers) != (manifest['height'] + 1) * HEADER_SIZE:
+            raise SnapshotError('snapshot height mismatch')
+        if hash_digest(raw_headers[-HEADER_SIZE:]) \
+                != manifest['blockhash'].decode('hex')[::-1]:
+            raise SnapshotError('snapshot blockhash mismatch')
+        if verify:
+            try:
+                count = link_headers(None, raw_headers, max_target)[1]
+            except InvalidHeader, e:
+                raise SnapshotError(str(e))
+            if count != manifest['height'] + 1:
+                raise SnapshotError('snapshot headers do not link at height %d' % count)
+
+        # stale index files of empty store must not survive next to new headers
+        for name in (TXINDEX_FILE, COLORSTATE_FILE):
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(os.path.join(store_path, name + suffix)):
+                    os.remove(os.path.join(store_path, name + suffix))
+        for name in files:
+            os.rename(os.path.join(store_path, name + '.tmp'), os.path.join(store_path, name))
+        paths = []
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    return manifest
@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+import urllib
+
+
+class TxIndex(object):
+    """On-disk txhash -> (height, position in block) index
+
+    Blocks are always added in height order, so the index is described by
+    the height of the last added block.
+
+    Writes go through own connection and can be run in worker thread,
+    get (from the thread that created the index) is not blocked by them.
+
+    In readonly mode another process (the syncer) writes the index, it is
+    opened for get only and height is the one at open.
+    """
+
+    def __init__(self, path, readonly=False):
+        self._lock = threading.Lock()
+        self._bulk = False
+        self._write_conn = None
+        if readonly:
+            self._conn = sqlite3.connect('file:%s?mode=ro' % urllib.quote(path))
+        else:
+            self._open_writer(path)
+            self._conn = sqlite3.connect(path)
+
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', ('height',)).fetchone()
+        self._height = -1 if row is None else row[0]
+
+    def _open_writer(self, path):
+        self._write_conn = sqlite3.connect(path, check_same_thread=False)
+        self._write_conn.execute('PRAGMA journal_mode=WAL')
+        self._write_conn.execute('CREATE TABLE IF NOT EXISTS txindex ('
+                                 'txhash BLOB PRIMARY KEY, height INTEGER, pos INTEGER)')
+        self._write_conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                                 'key TEXT PRIMARY KEY, value INTEGER)')
+        self._create_height_index()
+        self._write_conn.commit()
+
+    def _create_height_index(self):
+        self._write_conn.execute('CREATE INDEX IF NOT EXISTS txindex_height ON txindex (height)')
+
+    def _set_height(self, height):
+        self._write_conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                 ('height', height))
+        self._height = height
+
+    @property
+    def height(self):
+        return self._height
+
+    def add_blocks(self, blocks):
+        """Add list of (height, txhashes) following current height"""
+        with self._lock, self._write_conn:
+            for height, txhashes in blocks:
+                if height != self._height + 1:
+                    raise Exception('txindex height mismatch')
+                self._write_conn.executemany(
+                    'INSERT OR REPLACE INTO txindex (txhash, height, pos) VALUES (?, ?, ?)',
+                    ((buffer(txhash.decode('hex')), height, pos)
+                     for pos, txhash in enumerate(txhashes)))
+                self._set_height(height)
+
+    def get(self, txhash):
+        """Return (height, pos) or None for unknown tx"""
+        return self._conn.execute('SELECT height, pos FROM txindex WHERE txhash = ?',
+                                  (buffer(txhash.decode('hex')),)).fetchone()
+
+    def rollback(self, height):
+        """Drop all blocks from height and above"""
+        with self._lock, self._write_conn:
+            if height > self._height:
+                return
+            self._write_conn.execute('DELETE FROM txindex WHERE height >= ?', (height,))
+            self._set_height(height - 1)
+
+    def clear(self):
+        with self._lock, self._write_conn:
+            self._write_conn.execute('DELETE FROM txindex')
+            self._set_height(-1)
+
+    def set_bulk(self, bulk):
+        """Bulk mode drops height index and durability for fast inserts,
+        leaving it rebuilds the index (slow on large index)
+        """
+        with self._lock:
+            if bulk == self._bulk:
+                return
+            if bulk:
+                self._write_conn.execute('PRAGMA synchronous=OFF')
+                self._write_conn.execute('DROP INDEX IF EXISTS txindex_height')
+            else:
+                self._write_conn.execute('PRAGMA synchronous=FULL')
+                self._create_height_index()
+            self._write_conn.commit()
+            self._bulk = bulk
+
+    def close(self):
+        self._conn.close()
+        if self._write_conn is not None:
+            self.set_bulk(False)
+            self._write_conn.close()
@@ -0,0 +1,19 @@
+def get(config, section, option, default=None):
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
+def getint(config, section, option, default=None):
+    if config.has_option(section, option):
+        return config.getint(section, option)
+    return default
+
+def getfloat(config, section, option, default=None):
+    if config.has_option(section, option):
+        return config.getfloat(section, option)
+    return default
+
+def getboolean(config, section, option, default=None):
+    if config.has_option(section, option):
+        return config.getboolean(section, option)
+    return default
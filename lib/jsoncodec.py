@@ -0,0 +1,45 @@
+"""JSON encoding and decoding
+
+simplejson (with C speedups) is used when installed, it is API compatible
+with json from stdlib and faster on big documents.
+"""
+
+try:
+    import simplejson as _json
+except ImportError:
+    import json as _json
+
+
+loads = _json.loads
+dumps = _json.dumps
+load = _json.load
+
+
+def iterencode(obj, depth=2):
+    """Yield JSON of obj in pieces
+
+    Lists and dicts are split into their items down to depth levels, every
+    item is encoded separately (with C encoder) so the whole document is
+    never built as one string.
+    """
+    if depth <= 0 or not isinstance(obj, (list, tuple, dict)) or not obj:
+        yield dumps(obj)
+    elif isinstance(obj, dict):
+        separator = '{'
+        for key, value in obj.iteritems():
+            if not isinstance(key, basestring):
+                # same as json: 1 -> "1", None -> "null"
+                key = dumps(key)
+            yield separator + dumps(key) + ': '
+            for piece in iterencode(value, depth - 1):
+                yield piece
+            separator = ', '
+        yield '}'
+    else:
+        separator = '['
+        for value in obj:
+            yield separator
+            for piece in iterencode(value, depth - 1):
+                yield piece
+            separator = ', '
+        yield ']'
@@ -0,0 +1,170 @@
+import bisect
+
+
+# seconds, last bucket is +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+class Metric(object):
+    """Base of metrics in Prometheus text exposition format
+
+    Values are kept per tuple of label values, updates are plain dict
+    operations so they are cheap enough for the hot path.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def samples(self):
+        """Yield (suffix, labelvalues, extra labels, value)"""
+        for labels, value in sorted(self._values.items()):
+            yield '', labels, (), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, labels, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        _format_labels(self.labelnames, labels, extra),
+                                        _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def inc(self, labels=(), amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def get(self, labels=()):
+        return self._values.get(labels, 0)
+
+
+class GaugeFunc(Metric):
+    """Gauge evaluated on scrape
+
+    func returns value, or dict of label values tuple -> value for labelled
+    gauge. None values are not exported.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, func, labelnames=()):
+        super(GaugeFunc, self).__init__(name, help, labelnames)
+        self._func = func
+
+    def samples(self):
+        values = self._func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            if value is not None:
+                yield '', labels, (), value
+
+
+class CounterFunc(GaugeFunc):
+    """Counter maintained elsewhere and read on scrape"""
+
+    type = 'counter'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self._buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        try:
+            counts = self._values[labels]
+        except KeyError:
+            # per bucket counts (last is +Inf), sum
+            counts = self._values[labels] = [0] * (len(self._buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in sorted(self._values.items()):
+            total = 0
+            for bound, count in zip(self._buckets + (float('inf'),), counts):
+                total += count
+                yield '_bucket', labels, (('le', _format_value(float(bound))),), total
+            yield '_sum', labels, (), counts[-1]
+            yield '_count', labels, (), total
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """Add metric, metric with the same name is replaced"""
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        metrics = sorted(self._metrics.values(), key=lambda x: x.name)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.register(Gauge(name, help, labelnames))
+
+def gauge_func(name, help, func, labelnames=()):
+    return REGISTRY.register(GaugeFunc(name, help, func, labelnames))
+
+def counter_func(name, help, func, labelnames=()):
+    return REGISTRY.register(CounterFunc(name, help, func, labelnames))
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
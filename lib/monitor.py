@@ -0,0 +1,46 @@
+import time
+
+from twisted.internet import task
+from twisted.python import log
+
+from . import metrics
+
+
+class ReactorLagMonitor(object):
+    """Measure how late the reactor runs a timed call
+
+    Lag above warning (in seconds) is logged, it means something blocked
+    the event loop for that long.
+    """
+
+    def __init__(self, interval=0.1, warning=0.25):
+        self._interval = interval
+        self._warning = warning
+        self._expected = None
+        self._call = task.LoopingCall(self._tick)
+        self.last = 0.0
+        self.max = 0.0
+        metrics.gauge_func('ngcccbase_reactor_lag_seconds', 'Last measured reactor lag',
+                           lambda: self.last)
+        metrics.gauge_func('ngcccbase_reactor_lag_max_seconds', 'Max reactor lag since previous scrape',
+                           self.reset_max)
+
+    def start(self):
+        self._expected = time.time() + self._interval
+        self._call.start(self._interval, now=False)
+
+    def stop(self):
+        if self._call.running:
+            self._call.stop()
+
+    def _tick(self):
+        now = time.time()
+        self.last = max(0.0, now - self._expected)
+        self.max = max(self.max, self.last)
+        self._expected = now + self._interval
+        if self.last >= self._warning:
+            log.msg('Reactor lag: %.3f s' % self.last)
+
+    def reset_max(self):
+        value, self.max = self.max, 0.0
+        return value
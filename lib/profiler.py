@@ -0,0 +1,86 @@
+import cProfile
+import os
+import time
+
+from twisted.internet import reactor, task
+from twisted.python import log
+
+
+class SamplingProfiler(object):
+    """Profile reactor thread for duration seconds every interval seconds
+
+    Every window is dumped to directory as pstats file (read it with
+    python -m pstats), only the newest keep dumps are kept. Worker threads are
+    not profiled, their time shows up in worker spans of traces.
+    """
+
+    def __init__(self, directory, interval=60, duration=5, keep=20):
+        self.directory = directory
+        self.interval = interval
+        self.duration = duration
+        self.keep = keep
+        self.last_dump = None
+        self._loop = None
+        self._profile = None
+        self._end_call = None
+
+    def status(self):
+        return {
+            'enabled':   self._loop is not None,
+            'interval':  self.interval,
+            'duration':  self.duration,
+            'directory': self.directory,
+            'last_dump': self.last_dump,
+        }
+
+    def configure(self, enabled=None, interval=None, duration=None):
+        """Change settings (None keeps current value), return status
+
+        Window in progress is dumped, next one starts at once.
+        """
+        running = self._loop is not None
+        self.stop()
+        if interval is not None:
+            self.interval = interval
+        if duration is not None:
+            self.duration = duration
+        if enabled or (enabled is None and running):
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._loop = task.LoopingCall(self._start_window)
+            self._loop.start(self.interval, now=True)
+        return self.status()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+        if self._end_call is not None:
+            self._end_call.cancel()
+            self._end_window()
+
+    def _start_window(self):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self._end_call = reactor.callLater(min(self.duration, self.interval), self._end_window)
+
+    def _end_window(self):
+        self._end_call = None
+        profile, self._profile = self._profile, None
+        profile.disable()
+        filename = os.path.join(self.directory, 'profile-%s-%d.pstats' % (
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        try:
+            profile.dump_stats(filename)
+        except (IOError, OSError):
+            log.err()
+            return
+        self.last_dump = filename
+        self._prune()
+
+    def _prune(self):
+        suffix = '-%d.pstats' % os.getpid()
+        dumps = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith('profile-') and name.endswith(suffix))
+        for name in dumps[:-self.keep]:
+            os.remove(os.path.join(self.directory, name))
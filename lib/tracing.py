@@ -0,0 +1,285 @@
+"""Opt-in per-request tracing
+
+Transport starts a trace for a request, operations started while the
+request is handled (directly, or from generators decorated with
+tracing.inlineCallbacks instead of defer.inlineCallbacks) add timed spans
+to it. Finished traces feed ngcccbase_span_seconds, traces slower than
+slow_threshold are logged with their timing tree. With tracing disabled
+every traced call costs one check.
+
+The same generators keep the deadline of the request they work for, so
+bitcoind calls made for a request can fail once it has expired.
+"""
+
+import collections
+import contextlib
+import functools
+import random
+import sys
+import time
+
+from twisted.internet import defer
+from twisted.python import log
+
+from . import metrics
+
+
+SPAN_SECONDS = metrics.histogram('ngcccbase_span_seconds', 'Time spent in traced operations', ('span',))
+
+# spans of one trace above this are timed but not kept (prefetch can make thousands)
+MAX_SPANS = 2000
+
+_settings = {
+    'enabled':        False,
+    'sample':         1.0,
+    'slow_threshold': 1.0,
+}
+
+# span of operation running in reactor thread now, None when not traced
+_current = None
+
+# deadline (time.time() value) of request handled now, None without one
+_deadline = None
+
+# last slow traces, newest last
+_slow = collections.deque(maxlen=20)
+
+
+def configure(enabled=None, sample=None, slow_threshold=None):
+    """Change settings (None keeps current value), return settings"""
+    for key, value in (('enabled', enabled), ('sample', sample), ('slow_threshold', slow_threshold)):
+        if value is not None:
+            _settings[key] = value
+    return settings()
+
+
+def settings():
+    return dict(_settings)
+
+
+def slow_traces():
+    """Return list of dicts with name, start, duration and tree of last
+    slow traces
+    """
+    return list(_slow)
+
+
+class Span(object):
+    __slots__ = ('trace', 'name', 'start', 'end', 'children')
+
+    def __init__(self, trace, name, start=None):
+        self.trace = trace
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.children = []
+
+    @property
+    def duration(self):
+        return (time.time() if self.end is None else self.end) - self.start
+
+    def child(self, name, start=None):
+        return self.trace.add(self, name, start)
+
+    def finish(self, end=None):
+        if self.end is None:
+            self.end = time.time() if end is None else end
+
+
+class Trace(object):
+    def __init__(self, name, start=None):
+        self.root = Span(self, name, start)
+        self.spans = 1
+        self.dropped = 0
+
+    def add(self, parent, name, start=None):
+        span = Span(self, name, start)
+        if self.spans < MAX_SPANS:
+            parent.children.append(span)
+            self.spans += 1
+        else:
+            self.dropped += 1
+        return span
+
+    def walk(self):
+        spans = [self.root]
+        while spans:
+            span = spans.pop()
+            yield span
+            spans.extend(span.children)
+
+    def finish(self):
+        self.root.finish()
+        for span in self.walk():
+            SPAN_SECONDS.observe(span.duration, (span.name,))
+        if self.root.duration >= _settings['slow_threshold']:
+            tree = self.format()
+            _slow.append({'name': self.root.name, 'start': self.root.start,
+                          'duration': self.root.duration, 'tree': tree})
+            log.msg('Slow request %s %.3f s\n%s' % (self.root.name, self.root.duration, tree))
+
+    def format(self):
+        """Timing tree, sibling spans with the same name are merged
+
+        Lines are: start offset, wall time, name, for merged spans their
+        count and sum of their times. Time not covered by children went
+        to Python code and waiting for the reactor.
+        """
+        lines = []
+        self._format(self.root.children, 1, lines)
+        if self.dropped:
+            lines.append('  (%d spans not kept)' % self.dropped)
+        return '\n'.join(lines)
+
+    def _format(self, spans, depth, lines):
+        groups = collections.OrderedDict()
+        for span in spans:
+            groups.setdefault(span.name, []).append(span)
+        for name, group in groups.iteritems():
+            start = min(span.start for span in group)
+            end = max(span.start + span.duration for span in group)
+            line = '%s+%.3f %.3f s %s' % ('  ' * depth, start - self.root.start, end - start, name)
+            if len(group) > 1:
+                line += ' x%d (sum %.3f s)' % (len(group), sum(span.duration for span in group))
+            lines.append(line)
+            self._format([child for span in group for child in span.children], depth + 1, lines)
+
+
+def start_trace(name, start=None):
+    """Return root span of new trace, None if request is not traced"""
+    if not _settings['enabled'] or random.random() >= _settings['sample']:
+        return None
+    return Trace(name, start).root
+
+
+def current():
+    return _current
+
+
+@contextlib.contextmanager
+def activate(span):
+    """Make span current for block of synchronous code"""
+    global _current
+    previous, _current = _current, span
+    try:
+        yield span
+    finally:
+        _current = previous
+
+
+def deadline():
+    """Deadline of request handled now, None without one"""
+    return _deadline
+
+
+@contextlib.contextmanager
+def activate_deadline(deadline):
+    """Make deadline current for block of synchronous code"""
+    global _deadline
+    previous, _deadline = _deadline, deadline
+    try:
+        yield deadline
+    finally:
+        _deadline = previous
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time block of synchronous code as child of current span"""
+    parent = _current
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name)
+    try:
+        with activate(child):
+            yield child
+    finally:
+        child.finish()
+
+
+def record(name, start, end=None):
+    """Add finished child span to current span"""
+    parent = _current
+    if parent is not None:
+        parent.child(name, start).finish(end)
+
+
+def run_in_span(name, f, *args, **kwargs):
+    """Call f in new child span of current span, span ends when
+    returned Deferred fires
+    """
+    parent = _current
+    if parent is None:
+        return f(*args, **kwargs)
+    child = parent.child(name)
+    try:
+        with activate(child):
+            result = f(*args, **kwargs)
+    except:
+        child.finish()
+        raise
+    if isinstance(result, defer.Deferred):
+        def done(value):
+            child.finish()
+            return value
+        result.addBoth(done)
+    else:
+        child.finish()
+    return result
+
+
+def bind(f):
+    """Return f running in current span and deadline, for callbacks
+    fired by others
+    """
+    span, deadline = _current, _deadline
+    if span is None and deadline is None:
+        return f
+    @functools.wraps(f)
+    def bound(*args, **kwargs):
+        with activate(span), activate_deadline(deadline):
+            return f(*args, **kwargs)
+    return bound
+
+
+def _resume_in(span, deadline, gen):
+    """Run gen with span and deadline current every time it is resumed"""
+    global _current, _deadline
+    result, exc_info = None, None
+    while True:
+        previous = _current, _deadline
+        _current, _deadline = span, deadline
+        try:
+            if exc_info is None:
+                value = gen.send(result)
+            else:
+                value = gen.throw(*exc_info)
+        except StopIteration:
+            return
+        except defer._DefGen_Return, e:
+            # returnValue from this frame, inlineCallbacks warns otherwise
+            defer.returnValue(e.value)
+        finally:
+            _current, _deadline = previous
+            exc_info = None
+        try:
+            result = yield value
+        except Exception:
+            exc_info = sys.exc_info()
+
+_traced_generator = defer.inlineCallbacks(_resume_in)
+
+
+def inlineCallbacks(f):
+    """defer.inlineCallbacks which keeps current span and deadline
+    across yields
+    """
+    plain = defer.inlineCallbacks(f)
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        span, deadline = _current, _deadline
+        if span is None and deadline is None:
+            return plain(*args, **kwargs)
+        return _traced_generator(span, deadline, f(*args, **kwargs))
+    return wrapper
@@ -1,9 +1,143 @@
-import json
-import collections
+import math
+import os
+import time
+from StringIO import StringIO
 
+from zope.interface import implements
+from zope.interface.verify import verifyObject
+from twisted.web import server
 from twisted.web.resource import Resource
-from twisted.web.server import Site, NOT_DONE_YET
-from twisted.internet import defer
+from twisted.web.server import NOT_DONE_YET
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import IPullProducer
+from twisted.python import failure, log
+
+from .. import config as cfg
+from .. import jsoncodec
+from .. import metrics
+from .. import tracing
+from ..admission import Overloaded, DeadlineExceeded, RateLimiter
+from ..backend.interface import IBackend, CAP_BROADCAST
+from ..profiler import SamplingProfiler
+
+
+REQUESTS = metrics.counter('ngcccbase_requests_total', 'API calls', ('method',))
+ERRORS = metrics.counter('ngcccbase_request_errors_total', 'Failed API calls', ('method',))
+SECONDS = metrics.histogram('ngcccbase_request_seconds', 'API call latency', ('method',))
+IN_FLIGHT = metrics.gauge('ngcccbase_requests_in_flight', 'API calls in progress')
+REJECTED = metrics.counter('ngcccbase_requests_rejected_total', 'Requests rejected by admission control',
+                           ('reason',))
+
+
+class RequestError(Exception):
+    """Bad request, rendered with code 400"""
+
+
+class Request(server.Request):
+    """Request with bounded body
+
+    Body larger than site.max_body is rejected with 413 as soon as its
+    Content-Length is known (or chunked body grows too large), the rest
+    of it is not read.
+    """
+
+    rejected = False
+
+    def gotLength(self, length):
+        self._body_size = 0
+        max_body = self.channel.site.max_body
+        if max_body and length is not None and length > max_body:
+            self._reject_body()
+            self.content = StringIO()
+            return
+        server.Request.gotLength(self, length)
+
+    def handleContentChunk(self, data):
+        if self.rejected:
+            return
+        self._body_size += len(data)
+        max_body = self.channel.site.max_body
+        if max_body and self._body_size > max_body:
+            self._reject_body()
+            return
+        self.content.write(data)
+
+    def requestReceived(self, command, path, version):
+        if self.rejected:
+            return
+        # body is JSON whatever client says, do not parse it as form args
+        self.requestHeaders.removeHeader('content-type')
+        server.Request.requestReceived(self, command, path, version)
+
+    def _reject_body(self):
+        self.rejected = True
+        REJECTED.inc(('body_too_large',))
+        # channel sends 100 Continue after gotLength
+        self.requestHeaders.removeHeader('expect')
+        body = jsoncodec.dumps({'result': None, 'error': 'request body too large'})
+        self.channel.transport.write(
+            'HTTP/1.1 413 Request Entity Too Large\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: close\r\n\r\n%s' % (len(body), body))
+        self.channel.transport.loseConnection()
+
+
+class Site(server.Site):
+    requestFactory = Request
+
+    def __init__(self, resource, max_body=0, **kwargs):
+        server.Site.__init__(self, resource, **kwargs)
+        self.max_body = max_body
+
+
+class JSONProducer(object):
+    """Write JSON of obj to request when transport wants more data
+
+    Response is encoded piece by piece (see jsoncodec.iterencode), at most
+    about WRITE_SIZE bytes of it are held besides the transport buffer.
+    Request is finished when all is written.
+    """
+    implements(IPullProducer)
+
+    WRITE_SIZE = 65536
+
+    def __init__(self, request, obj, depth=2):
+        self._request = request
+        self._pieces = jsoncodec.iterencode(obj, depth)
+        self._span = tracing.current()
+
+    def start(self):
+        self._request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        data, size = [], 0
+        start = time.time()
+        try:
+            while size < self.WRITE_SIZE:
+                piece = next(self._pieces)
+                data.append(piece)
+                size += len(piece)
+        except StopIteration:
+            if self._span is not None:
+                self._span.child('json.encode', start).finish()
+            if data:
+                self._request.write(''.join(data))
+            self._request.unregisterProducer()
+            self._request.finish()
+            return
+        except Exception:
+            # headers are sent already, drop connection so client sees failure
+            log.err()
+            self._request.unregisterProducer()
+            self._request.transport.loseConnection()
+            return
+        if self._span is not None:
+            self._span.child('json.encode', start).finish()
+        self._request.write(''.join(data))
+
+    def stopProducing(self):
+        self._pieces = iter(())
 
 
 class RootResource(Resource):
@@ -13,48 +147,353 @@ class RootResource(Resource):
         'getblockcount':      'get_block_count',
         'getchunk':           'get_chunk',
         'getheader':          'get_header',
+        'getheaders':         'get_headers',
         'getmerkle':          'get_merkle',
+        'getmerkles':         'get_merkles',
         'getrawtransaction':  'get_raw_transaction',
         'gettxblockhash':     'get_tx_blockhash',
         'prefetch':           'prefetch',
         'sendrawtransaction': 'send_raw_transaction',
+        'waitheaders':        'wait_headers',
     }
 
-    def __init__(self, backend):
+    # methods available only with backend capability
+    METHOD_CAPABILITIES = {
+        'sendrawtransaction': CAP_BROADCAST,
+    }
+
+    # long-poll methods, dropped when client goes away
+    CANCELLABLE_METHODS = set(['waitheaders'])
+
+    LOCAL_CLIENTS = set(['127.0.0.1', '::1'])
+
+    # methods which can be answered with raw bytes
+    RAW_METHODS = {
+        'getchunk':           'get_chunk_raw',
+        'getheaders':         'get_headers_raw',
+    }
+
+    def __init__(self, backend, max_batch=1000, longpoll_timeout=60, max_inflight=1000,
+                 request_timeout=30, rate_limiter=None, max_prefetch=1000, profiler=None):
         self.backend = backend
+        self.profiler = profiler
+        self.max_batch = max_batch
+        self.longpoll_timeout = longpoll_timeout
+        self.max_inflight = max_inflight
+        self.request_timeout = request_timeout
+        self.rate_limiter = rate_limiter or RateLimiter(0, 0)
+        self.max_prefetch = max_prefetch
+        # calls in progress, long-polls excluded
+        self.in_flight = 0
+
+    def render_GET(self, request):
+        path = request.path.strip('/').split('/')
+        if len(path) == 2 and path[0] == 'chunk' and path[1].isdigit():
+            rejected = self._admit(request)
+            if rejected is not None:
+                return rejected
+            with tracing.activate(self._start_trace(request, 'http:chunk')):
+                self._measure('chunk', self._render_chunk(request, int(path[1])))
+            return NOT_DONE_YET
+        if path == ['metrics']:
+            request.setHeader('content-type', 'text/plain; version=0.0.4')
+            return metrics.REGISTRY.render()
+        if len(path) == 2 and path[0] == 'admin':
+            return self._render_admin(request, path[1])
+
+        request.setResponseCode(404)
+        return 'not found'
 
     def render_POST(self, request):
+        if request.path == '/notify':
+            return self._render_notify(request)
+        path = request.path.strip('/').split('/')
+        if len(path) == 2 and path[0] == 'admin':
+            return self._render_admin(request, path[1])
+
+        start = time.time()
         try:
-            query = json.loads(request.content.read())
+            query = jsoncodec.load(request.content)
         except (ValueError, TypeError):
             return self._render_error400(request, 'JSON loads error')
+        method = 'batch' if isinstance(query, list) else self._method_label(query)
+        # long-polls are slow by design
+        root = None
+        if method not in self.CANCELLABLE_METHODS:
+            root = self._start_trace(request, 'http:' + method, start)
+            if root is not None:
+                root.child('json.decode', start).finish()
+        with tracing.activate(root):
+            return self._render_query(request, query)
+
+    def _render_query(self, request, query):
+        rejected = self._admit(request, len(query) if isinstance(query, list) else 1)
+        if rejected is not None:
+            return rejected
+
+        if isinstance(query, list):
+            if not query:
+                return self._render_error400(request, 'empty batch')
+            if len(query) > self.max_batch:
+                return self._render_error400(request, 'batch too large')
+            self._render_batch(request, query)
+            return NOT_DONE_YET
+
+        raw = self._accepts_raw(request)
+        try:
+            d = self._dispatch(query, raw)
+        except RequestError, e:
+            return self._render_error400(request, str(e))
+        if query['method'] in self.CANCELLABLE_METHODS:
+            request.notifyFinish().addErrback(lambda _: d.cancel())
+        if raw and query['method'] in self.RAW_METHODS:
+            self._render_raw(request, d)
+        else:
+            self._render_func(request, d)
+        return NOT_DONE_YET
+
+    def _render_notify(self, request):
+        """New block trigger for bitcoind -blocknotify"""
+        if request.getClientIP() not in self.LOCAL_CLIENTS:
+            request.setResponseCode(403)
+            return 'forbidden'
+        self.backend.notify_block()
+        return 'ok'
+
+    def _render_admin(self, request, name):
+        """Runtime switches of tracing and profiler, local clients only
+
+        GET returns current settings, POST with JSON object of settings
+        changes them and returns the new ones.
+        """
+        if request.getClientIP() not in self.LOCAL_CLIENTS:
+            request.setResponseCode(403)
+            return 'forbidden'
+        handlers = {'tracing': self._admin_tracing, 'profile': self._admin_profile}
+        if name not in handlers:
+            request.setResponseCode(404)
+            return 'not found'
+        params = {}
+        if request.method == 'POST':
+            try:
+                params = jsoncodec.load(request.content)
+            except (ValueError, TypeError):
+                return self._render_error400(request, 'JSON loads error')
+            if not isinstance(params, dict):
+                return self._render_error400(request, 'params not dict')
+        try:
+            result = handlers[name](params)
+        except RequestError, e:
+            return self._render_error400(request, str(e))
+        request.setHeader('content-type', 'application/json')
+        return jsoncodec.dumps({'result': result, 'error': None})
+
+    def _admin_tracing(self, params):
+        enabled = params.get('enabled')
+        self._validate(enabled, lambda x: x is None or isinstance(x, bool), 'enabled not bool')
+        sample = params.get('sample')
+        self._validate(sample, lambda x: x is None or isinstance(x, (int, float)) and 0 <= x <= 1,
+                       'sample not number in range 0..1')
+        slow_threshold = params.get('slow_threshold')
+        self._validate(slow_threshold, lambda x: x is None or isinstance(x, (int, float)) and x >= 0,
+                       'slow_threshold not non-negative number')
+        result = tracing.configure(enabled, sample, slow_threshold)
+        result['slow'] = tracing.slow_traces()
+        return result
+
+    def _admin_profile(self, params):
+        if self.profiler is None:
+            raise RequestError('profiler not configured')
+        enabled = params.get('enabled')
+        self._validate(enabled, lambda x: x is None or isinstance(x, bool), 'enabled not bool')
+        interval = params.get('interval', self.profiler.interval)
+        self._validate(interval, lambda x: isinstance(x, (int, float)) and x >= 1,
+                       'interval not number >= 1')
+        duration = params.get('duration', self.profiler.duration)
+        self._validate(duration, lambda x: isinstance(x, (int, float)) and 0 < x <= interval,
+                       'duration not number in range 0..interval')
+        if not params:
+            return self.profiler.status()
+        return self.profiler.configure(enabled, interval, duration)
+
+    def _start_trace(self, request, name, start=None):
+        """Return root span of request trace or None, trace ends with
+        the request
+        """
+        root = tracing.start_trace(name, start)
+        if root is not None:
+            def finish(result):
+                root.trace.finish()
+            request.notifyFinish().addBoth(finish)
+        return root
 
-        if 'method' not in query:
-            return self._render_error400(request, 'method not in request')
+    def _admit(self, request, cost=1):
+        """Return rendered 503/429 error if request is rejected, else None"""
+        if self.in_flight >= self.max_inflight:
+            REJECTED.inc(('overloaded',))
+            return self._render_error503(request, 'server overloaded')
+        wait = self.rate_limiter.take(request.getClientIP(), cost)
+        if wait:
+            REJECTED.inc(('rate_limit',))
+            request.setResponseCode(429, 'Too Many Requests')
+            request.setHeader('retry-after', str(int(math.ceil(wait))))
+            return self._render_error(request, 'rate limit exceeded')
+        return None
+
+    def _with_deadline(self, d):
+        """Fail with DeadlineExceeded after request_timeout
+
+        Result of d is dropped after the deadline, d is cancelled (bitcoind
+        calls made for it fail with DeadlineExceeded by themselves).
+        """
+        result = defer.Deferred()
+        def expire():
+            result.errback(DeadlineExceeded('deadline exceeded'))
+            d.cancel()
+        call = reactor.callLater(self.request_timeout, expire)
+        def done(value):
+            if call.active():
+                call.cancel()
+                result.callback(value)
+        d.addBoth(done)
+        return result
+
+    def _accepts_raw(self, request):
+        accept = request.getHeader('accept') or ''
+        return 'application/octet-stream' in accept
+
+    def _method_label(self, query):
+        """Known method name, anything else is one label value"""
+        method = query.get('method') if isinstance(query, dict) else None
+        if isinstance(method, basestring) and method in self.AVAILABLE_METHODS:
+            return method
+        return 'unknown'
+
+    def _measure(self, method, d):
+        start = time.time()
+        REQUESTS.inc((method,))
+        IN_FLIGHT.inc()
+        counted = 0 if method in self.CANCELLABLE_METHODS else 1
+        self.in_flight += counted
+        def done(result):
+            IN_FLIGHT.dec()
+            self.in_flight -= counted
+            SECONDS.observe(time.time() - start, (method,))
+            if isinstance(result, failure.Failure) and not result.check(defer.CancelledError):
+                ERRORS.inc((method,))
+            return result
+        return d.addBoth(done)
+
+    def _dispatch(self, query, raw=False):
+        """Validate one call and return Deferred with its result"""
+        method = self._method_label(query)
+        deadline = None
+        if self.request_timeout and method not in self.CANCELLABLE_METHODS:
+            deadline = time.time() + self.request_timeout
+        try:
+            with tracing.activate_deadline(deadline):
+                d = tracing.run_in_span('call:' + method, self._call, query, raw)
+        except RequestError:
+            REQUESTS.inc((method,))
+            ERRORS.inc((method,))
+            raise
+        if deadline is not None:
+            d = self._with_deadline(d)
+        return self._measure(method, d)
+
+    def _call(self, query, raw):
+        if not isinstance(query, dict) or 'method' not in query:
+            raise RequestError('method not in request')
         if 'params' not in query:
-            return self._render_error400(request, 'params not in request')
+            raise RequestError('params not in request')
         if not isinstance(query['params'], dict):
-            return self._render_error400(request, 'params not dict')
+            raise RequestError('params not dict')
 
         method, params = query['method'], query['params']
-        if method in self.AVAILABLE_METHODS:
-            getattr(self, self.AVAILABLE_METHODS[method])(request, params)
-            return NOT_DONE_YET
+        if not isinstance(method, basestring):
+            raise RequestError('method not found')
+        if raw and method in self.RAW_METHODS:
+            return getattr(self, self.RAW_METHODS[method])(params)
+        if method not in self.AVAILABLE_METHODS:
+            raise RequestError('method not found')
+        capability = self.METHOD_CAPABILITIES.get(method)
+        if capability is not None and capability not in self.backend.capabilities:
+            raise RequestError('method not supported by backend')
+        return getattr(self, self.AVAILABLE_METHODS[method])(params)
 
-        return self._render_error400(request, 'method not found')
 
+    @tracing.inlineCallbacks
+    def _render_func(self, request, d):
+        try:
+            result = yield d
+            request.setHeader('content-type', 'application/json')
+            JSONProducer(request, {'result': result, 'error': None}).start()
+        except defer.CancelledError:
+            # client is gone
+            pass
+        except Exception, e:
+            self._render_exception(request, e)
+
+    @tracing.inlineCallbacks
+    def _render_raw(self, request, d):
+        try:
+            result = yield d
+            request.setHeader('content-type', 'application/octet-stream')
+            request.write(str(result))
+            request.finish()
+        except Exception, e:
+            self._render_exception(request, e)
 
-    @defer.inlineCallbacks
-    def _render_func(self, request, func, *args, **kwargs):
+    @tracing.inlineCallbacks
+    def _render_chunk(self, request, index):
+        """Raw headers of chunk, completed chunks are served with strong
+        ETag from precomputed (and gzipped) bodies
+        """
         try:
-            result = yield defer.maybeDeferred(func, *args, **kwargs)
-            request.write(json.dumps({'result': result, 'error': None}))
+            chunk = yield self.backend.get_completed_chunk(index)
+            request.setHeader('content-type', 'application/octet-stream')
+            if chunk is None:
+                request.setHeader('cache-control', 'no-store')
+                request.write(str(self.backend.get_chunk_raw(index)))
+                request.finish()
+                return
+
+            gzipped = 'gzip' in (request.getHeader('accept-encoding') or '')
+            etag = '"%s%s"' % (chunk['etag'], '-gzip' if gzipped else '')
+            request.setHeader('etag', etag)
+            request.setHeader('vary', 'Accept-Encoding')
+            # deep reorg can change completed chunk, so always revalidate
+            request.setHeader('cache-control', 'no-cache')
+            if_none_match = [x.strip() for x in (request.getHeader('if-none-match') or '').split(',')]
+            if etag in if_none_match or '*' in if_none_match:
+                request.setResponseCode(304)
+            elif gzipped:
+                request.setHeader('content-encoding', 'gzip')
+                request.write(chunk['raw_gzip'])
+            else:
+                request.write(str(self.backend.get_chunk_raw(index)))
             request.finish()
         except Exception, e:
-            self._render_error500(request, str(e))
+            ERRORS.inc(('chunk',))
+            self._render_exception(request, e)
+
+    @tracing.inlineCallbacks
+    def _render_batch(self, request, queries):
+        """Run all calls concurrently, errors are reported per call"""
+        ds = []
+        for query in queries:
+            try:
+                ds.append(self._dispatch(query))
+            except Exception, e:
+                ds.append(defer.fail(e))
+        results = yield defer.DeferredList(ds, consumeErrors=True)
+        JSONProducer(request, [
+            {'result': result, 'error': None} if success else
+            {'result': None, 'error': str(result.value)}
+            for success, result in results], depth=3).start()
 
     def _render_error(self, request, error):
-        request.write(json.dumps({'result': None, 'error': error}))
+        request.write(jsoncodec.dumps({'result': None, 'error': error}))
         request.finish()
         return NOT_DONE_YET
 
@@ -66,89 +505,135 @@ class RootResource(Resource):
         request.setResponseCode(500)
         return self._render_error(request, error)
 
+    def _render_error503(self, request, error):
+        request.setResponseCode(503)
+        return self._render_error(request, error)
+
+    def _render_exception(self, request, e):
+        if isinstance(e, (Overloaded, DeadlineExceeded)):
+            return self._render_error503(request, str(e))
+        return self._render_error500(request, str(e))
+
     def _require(self, params, key, msg):
         if key not in params:
-            raise Exception(msg)
+            raise RequestError(msg)
         return params[key]
 
     def _validate(self, key, test, msg):
         if not test(key):
-            raise Exception(msg)
+            raise RequestError(msg)
 
 
-    def get_block_count(self, request, params):
-        self._render_func(request, self.backend.get_block_count)
+    def get_block_count(self, params):
+        return defer.maybeDeferred(self.backend.get_block_count)
 
-    def get_chunk(self, request, params):
-        try:
-            index = self._require(params, 'index', 'index not found')
-            self._validate(index, lambda x: isinstance(x, int), 'index not int')
-        except Exception, e:
-            self._render_error400(request, str(e))
-        else:
-            self._render_func(request, self.backend.get_chunk, index)
+    def _chunk_index(self, params):
+        index = self._require(params, 'index', 'index not found')
+        self._validate(index, lambda x: isinstance(x, int), 'index not int')
+        return index
 
-    def get_header(self, request, params):
-        try:
-            height = self._require(params, 'height', 'height not found')
-            self._validate(height, lambda x: isinstance(x, int), 'height not int')
-        except Exception, e:
-            self._render_error400(request, str(e))
-        else:
-            self._render_func(request, self.backend.get_header, height)
+    def get_chunk(self, params):
+        return defer.maybeDeferred(self.backend.get_chunk, self._chunk_index(params))
 
-    def get_merkle(self, request, params):
-        try:
-            txhash = self._require(params, 'txhash', 'txhash not found')
-            self._validate(txhash, lambda x: isinstance(x, basestring), 'txhash not string')
-            blockhash = self._require(params, 'blockhash', 'blockhash not found')
-            self._validate(blockhash, lambda x: isinstance(x, basestring), 'blockhash not string')
-        except Exception, e:
-            self._render_error400(request, str(e))
-        else:
-            self._render_func(request, self.backend.get_merkle, txhash, blockhash)
+    def get_chunk_raw(self, params):
+        return defer.maybeDeferred(self.backend.get_chunk_raw, self._chunk_index(params))
 
-    def get_raw_transaction(self, request, params):
-        try:
-            txhash = self._require(params, 'txhash', 'txhash not found')
-            self._validate(txhash, lambda x: isinstance(x, basestring), 'txhash not string')
-        except Exception, e:
-            self._render_error400(request, str(e))
-        else:
-            self._render_func(request, self.backend.get_raw_transaction, txhash)
+    def get_header(self, params):
+        height = self._require(params, 'height', 'height not found')
+        self._validate(height, lambda x: isinstance(x, int), 'height not int')
+        return defer.maybeDeferred(self.backend.get_header, height)
 
-    def get_tx_blockhash(self, request, params):
-        try:
-            txhash = self._require(params, 'txhash', 'txhash not found')
-            self._validate(txhash, lambda x: isinstance(x, basestring), 'txhash not string')
-        except Exception, e:
-            self._render_error400(request, str(e))
-        else:
-            self._render_func(request, self.backend.get_tx_blockhash, txhash)
+    def _headers_range(self, params):
+        start = self._require(params, 'start', 'start not found')
+        self._validate(start, lambda x: isinstance(x, int), 'start not int')
+        self._validate(start, lambda x: 0 <= x <= self.backend.current_height, 'start out of range')
+        count = self._require(params, 'count', 'count not found')
+        self._validate(count, lambda x: isinstance(x, int), 'count not int')
+        self._validate(count, lambda x: 0 < x <= 2016, 'count not in range 1..2016')
+        return start, count
 
-    def prefetch(self, request, params):
-        try:
-            txhash = self._require(params, 'txhash', 'txhash not found')
-            self._validate(txhash, lambda x: isinstance(x, basestring), 'txhash not string')
-            output_set = self._require(params, 'output_set', 'output_set not found')
-            self._validate(output_set, lambda x: isinstance(x, collections.Iterable, 'output_set not iterable'))
-            color_desc = self._require(params, 'color_desc', 'color_desc not found')
-            #self._validate(color_desc, lambda x: isinstance(x, ???), 'color_desc not ???')
-            limit = params.get('limit')
-        except Exception, e:
-            self._render_error400(request, str(e))
-        else:
-            self._render_func(request, self.backend.prefetch, txhash, output_set, color_desc, limit)
+    def get_headers(self, params):
+        return defer.maybeDeferred(self.backend.get_headers, *self._headers_range(params))
 
-    def send_raw_transaction(self, request, params):
-        try:
-            txdata = self._require(params, 'txdata', 'txdata not found')
-            self._validate(txdata, lambda x: isinstance(x, basestring), 'txdata not string')
-        except Exception, e:
-            self._render_error400(request, str(e))
-        else:
-            self._render_func(request, self.backend.send_raw_transaction, txdata)
+    def get_headers_raw(self, params):
+        return defer.maybeDeferred(self.backend.get_headers_raw, *self._headers_range(params))
+
+    def get_merkle(self, params):
+        txhash = self._require(params, 'txhash', 'txhash not found')
+        self._validate(txhash, lambda x: isinstance(x, basestring), 'txhash not string')
+        blockhash = self._require(params, 'blockhash', 'blockhash not found')
+        self._validate(blockhash, lambda x: isinstance(x, basestring), 'blockhash not string')
+        return defer.maybeDeferred(self.backend.get_merkle, txhash, blockhash)
+
+    def get_merkles(self, params):
+        txhashes = self._require(params, 'txhashes', 'txhashes not found')
+        self._validate(txhashes, lambda x: isinstance(x, list), 'txhashes not list')
+        self._validate(txhashes, lambda x: all(isinstance(y, basestring) for y in x), 'txhashes not strings')
+        self._validate(txhashes, lambda x: len(x) <= self.max_batch, 'too many txhashes')
+        blockhash = params.get('blockhash')
+        self._validate(blockhash, lambda x: x is None or isinstance(x, basestring), 'blockhash not string')
+        return defer.maybeDeferred(self.backend.get_merkles, txhashes, blockhash)
+
+    def get_raw_transaction(self, params):
+        txhash = self._require(params, 'txhash', 'txhash not found')
+        self._validate(txhash, lambda x: isinstance(x, basestring), 'txhash not string')
+        return defer.maybeDeferred(self.backend.get_raw_transaction, txhash)
+
+    def get_tx_blockhash(self, params):
+        txhash = self._require(params, 'txhash', 'txhash not found')
+        self._validate(txhash, lambda x: isinstance(x, basestring), 'txhash not string')
+        return defer.maybeDeferred(self.backend.get_tx_blockhash, txhash)
+
+    def prefetch(self, params):
+        txhash = self._require(params, 'txhash', 'txhash not found')
+        self._validate(txhash, lambda x: isinstance(x, basestring), 'txhash not string')
+        output_set = self._require(params, 'output_set', 'output_set not found')
+        self._validate(output_set, lambda x: isinstance(x, list), 'output_set not list')
+        self._validate(output_set, lambda x: all(isinstance(y, int) for y in x), 'output_set not ints')
+        color_desc = self._require(params, 'color_desc', 'color_desc not found')
+        #self._validate(color_desc, lambda x: isinstance(x, ???), 'color_desc not ???')
+        limit = params.get('limit')
+        self._validate(limit, lambda x: x is None or isinstance(x, int), 'limit not int')
+        if self.max_prefetch:
+            limit = min(limit or self.max_prefetch, self.max_prefetch)
+        return defer.maybeDeferred(self.backend.prefetch, txhash, output_set, color_desc, limit)
+
+    def wait_headers(self, params):
+        height = self._require(params, 'height', 'height not found')
+        self._validate(height, lambda x: isinstance(x, int), 'height not int')
+        timeout = params.get('timeout', self.longpoll_timeout)
+        self._validate(timeout, lambda x: isinstance(x, (int, float)), 'timeout not number')
+        timeout = max(0, min(timeout, self.longpoll_timeout))
+        return defer.maybeDeferred(self.backend.wait_headers, height, timeout)
+
+    def send_raw_transaction(self, params):
+        txdata = self._require(params, 'txdata', 'txdata not found')
+        self._validate(txdata, lambda x: isinstance(x, basestring), 'txdata not string')
+        return defer.maybeDeferred(self.backend.send_raw_transaction, txdata)
 
 
 def get_HTTPFactory(config, backend):
-    return Site(RootResource(backend))
+    verifyObject(IBackend, backend)
+    tracing.configure(
+        enabled=cfg.getboolean(config, 'tracing', 'enabled', False),
+        sample=cfg.getfloat(config, 'tracing', 'sample', 1.0),
+        slow_threshold=cfg.getfloat(config, 'tracing', 'slow_threshold', 1.0))
+    profile_dir = (cfg.get(config, 'tracing', 'profile_dir') or
+                   os.path.join(config.get('store', 'path'), 'profiles'))
+    profiler = SamplingProfiler(profile_dir,
+        interval=cfg.getfloat(config, 'tracing', 'profile_interval', 60),
+        duration=cfg.getfloat(config, 'tracing', 'profile_duration', 5),
+        keep=cfg.getint(config, 'tracing', 'profile_keep', 20))
+    if cfg.getboolean(config, 'tracing', 'profile', False):
+        reactor.callWhenRunning(profiler.configure, enabled=True)
+    resource = RootResource(backend,
+        max_batch=cfg.getint(config, 'server', 'max_batch', 1000),
+        longpoll_timeout=cfg.getfloat(config, 'server', 'longpoll_timeout', 60),
+        max_inflight=cfg.getint(config, 'server', 'max_inflight', 1000),
+        request_timeout=cfg.getfloat(config, 'server', 'request_timeout', 30),
+        rate_limiter=RateLimiter(cfg.getfloat(config, 'ratelimit', 'rate', 0),
+                                 cfg.getfloat(config, 'ratelimit', 'burst', 100)),
+        max_prefetch=cfg.getint(config, 'prefetch', 'max_limit', 1000),
+        profiler=profiler,
+    )
+    return Site(resource, max_body=cfg.getint(config, 'server', 'max_body', 4000000))
@@ -0,0 +1,84 @@
+import multiprocessing
+import signal
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+from . import tracing
+
+
+def _call(func, args):
+    """Run func in pool process, exceptions are returned to be re-raised"""
+    try:
+        return True, func(*args)
+    except Exception, e:
+        return False, e
+
+
+def _init_process():
+    # pool processes are stopped by the server; a signal sent to its whole
+    #  process group (Ctrl-C, timeout, service manager) would kill an idle
+    #  one holding the task queue lock and leave Pool.terminate() hanging
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class WorkerPool(object):
+    """Run CPU-bound functions outside of the reactor thread
+
+    Threads keep the reactor responsive, but give no parallelism for the
+    hashing and tx parsing jobs: they hash 64 and 80 byte inputs or are
+    pure Python, so they hold the GIL (hashlib releases it for inputs
+    above 2 KB only). Jobs sent with run_process run in a pool of
+    processes when there is one, in parallel with the reactor and each
+    other, at the cost of pickling arguments and results.
+
+    With size 0 functions are called in the reactor thread directly.
+    Functions must not touch any state shared with the reactor thread.
+    """
+
+    def __init__(self, size, processes=0):
+        self._pool = None
+        if size > 0:
+            self._pool = ThreadPool(minthreads=1, maxthreads=size, name='workers')
+            reactor.callWhenRunning(self._pool.start)
+            reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+        self._processes = None
+        if processes > 0:
+            # forked now, before the server opens its sockets and stores
+            self._processes = multiprocessing.Pool(processes, _init_process)
+            reactor.addSystemEventTrigger('during', 'shutdown', self._stop_processes)
+
+    def run(self, func, *args, **kwargs):
+        name = 'worker:' + getattr(func, '__name__', 'function')
+        return tracing.run_in_span(name, self._run, func, *args, **kwargs)
+
+    def _run(self, func, *args, **kwargs):
+        if self._pool is None:
+            return defer.maybeDeferred(func, *args, **kwargs)
+        return threads.deferToThreadPool(reactor, self._pool, func, *args, **kwargs)
+
+    def run_process(self, func, *args):
+        """Run module-level func with picklable args and result in process
+        pool, in thread pool without it
+        """
+        if self._processes is None:
+            return self.run(func, *args)
+        name = 'process:' + func.__name__
+        return tracing.run_in_span(name, self._run_process, func, *args)
+
+    def _stop_processes(self):
+        # jobs are short, processes exit once they are done
+        self._processes.close()
+        self._processes.join()
+
+    def _run_process(self, func, *args):
+        d = defer.Deferred()
+        def done((success, result)):
+            if success:
+                d.callback(result)
+            else:
+                d.errback(result)
+        self._processes.apply_async(_call, (func, args),
+                                    callback=lambda result: reactor.callFromThread(done, result))
+        return d
@@ -1,16 +1,29 @@
 import argparse
 import ConfigParser
+import os
+import signal
 import socket
+import sys
 
 from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol
 
 import imp
 imp.load_module("ngcccbase_server", *imp.find_module("lib"))
+from ngcccbase_server import config as cfg
 from ngcccbase_server.log import startLogging
-from ngcccbase_server.backend.bitcoind import Backend as BitcoindBackend
+from ngcccbase_server.monitor import ReactorLagMonitor
+from ngcccbase_server.backend.bitcoind import Backend as BitcoindBackend, RawBlockBackend, max_target
+from ngcccbase_server.backend.snapshot import SnapshotError, export_snapshot, import_snapshot
 from ngcccbase_server.transport.http import get_HTTPFactory
 
 
+BACKENDS = {
+    'rpc':       BitcoindBackend,
+    'rawblocks': RawBlockBackend,
+}
+
+
 def arg_parser():
     parser = argparse.ArgumentParser(usage='%(prog)s [command-line options]')
     parser.add_argument('-c', '--conf',
@@ -20,6 +33,30 @@ def arg_parser():
         help='Specify configuration file',
         metavar='<file>'
     )
+    parser.add_argument('--rebuild-txindex',
+        action='store_true',
+        help='Drop txindex and build it from scratch'
+    )
+    parser.add_argument('--export-snapshot',
+        action='store',
+        type=str,
+        help='Write snapshot of store (also of running server) and exit',
+        metavar='<file>'
+    )
+    parser.add_argument('--import-snapshot',
+        action='store',
+        type=str,
+        help='Unpack snapshot into empty store and exit',
+        metavar='<file>'
+    )
+    parser.add_argument('--verify-snapshot',
+        action='store_true',
+        help='Check proof-of-work of all imported headers'
+    )
+    parser.add_argument('--reader',
+        action='store_true',
+        help=argparse.SUPPRESS
+    )
     return parser
 
 def load_config(filename):
@@ -28,21 +65,109 @@ def load_config(filename):
         return config
     raise IOError('load config failed')
 
+def listen_reuseport(port, factory, host):
+    """Listen on port shared with other worker processes"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+    sock.bind((host, port))
+    sock.listen(50)
+    sock.setblocking(False)
+    port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()
+    return port
+
+
+class ReaderProcess(ProcessProtocol):
+    """Read-only worker, respawned on unexpected exit"""
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def processEnded(self, reason):
+        self.workers.ended(self)
+
+
+class Workers(object):
+    def __init__(self, conf, count):
+        self.conf = conf
+        self.count = count
+        self.processes = set()
+        self.stopping = False
+
+    def start(self):
+        for _ in xrange(self.count):
+            self.spawn()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self):
+        protocol = ReaderProcess(self)
+        args = [sys.executable, os.path.abspath(__file__), '-c', self.conf, '--reader']
+        reactor.spawnProcess(protocol, sys.executable, args,
+                             env=os.environ, childFDs={0: 0, 1: 1, 2: 2})
+        self.processes.add(protocol)
+
+    def ended(self, protocol):
+        self.processes.discard(protocol)
+        if not self.stopping:
+            reactor.callLater(1, self.spawn)
+
+    def stop(self):
+        self.stopping = True
+        for protocol in self.processes:
+            protocol.transport.signalProcess('TERM')
+
+
+def snapshot(config, args):
+    store_path = config.get('store', 'path')
+    try:
+        if args.get('export_snapshot'):
+            manifest = export_snapshot(store_path, args['export_snapshot'], max_target(config))
+        else:
+            manifest = import_snapshot(args['import_snapshot'], store_path, max_target(config),
+                                       verify=args.get('verify_snapshot'))
+    except SnapshotError, e:
+        sys.exit('snapshot failed: %s' % e)
+    print 'snapshot of height %d (%s)' % (manifest['height'], manifest['blockhash'])
+
+
 def main():
     parser = arg_parser()
     args = vars(parser.parse_args())
 
     config = load_config(args.get('conf'))
 
+    if args.get('export_snapshot') or args.get('import_snapshot'):
+        return snapshot(config, args)
+
     startLogging(config)
 
-    backend = BitcoindBackend(config)
+    lag_monitor = ReactorLagMonitor(warning=cfg.getfloat(config, 'server', 'lag_warning', 0.25))
+    reactor.callWhenRunning(lag_monitor.start)
 
-    reactor.listenTCP(
-        int(config.get('server', 'port')),
-        get_HTTPFactory(config, backend),
-        interface=socket.gethostbyname(config.get('server', 'host'))
-    )
+    workers = cfg.getint(config, 'server', 'workers', 1)
+    reader = args.get('reader')
+    backend_type = cfg.get(config, 'backend', 'type', 'rpc')
+    if backend_type not in BACKENDS:
+        sys.exit('unknown backend type %s' % backend_type)
+    backend = BACKENDS[backend_type](config,
+                                     rebuild_txindex=args.get('rebuild_txindex') and not reader,
+                                     readonly=reader,
+                                     shared=workers > 1)
+
+    port = int(config.get('server', 'port'))
+    factory = get_HTTPFactory(config, backend)
+    host = socket.gethostbyname(config.get('server', 'host'))
+    if workers > 1:
+        listen_reuseport(port, factory, host)
+    else:
+        reactor.listenTCP(port, factory, interface=host)
+
+    if workers > 1 and not reader:
+        # readers forward -blocknotify to syncer
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: reactor.callFromThread(backend.notify_block))
+        reactor.callWhenRunning(Workers(args.get('conf'), workers - 1).start)
     reactor.run()
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+import unittest
+
+from twisted.internet import defer, task
+
+from lib.admission import (PrioritySemaphore, RateLimiter, Overloaded, DeadlineExceeded,
+                           PRIORITY_SYNC, PRIORITY_NORMAL, PRIORITY_BACKGROUND)
+
+
+class TestPrioritySemaphore(unittest.TestCase):
+    def _results(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results
+
+    def test_priority_order(self):
+        semaphore = PrioritySemaphore(1)
+        order = []
+        self._results(semaphore.acquire())
+        for priority in (PRIORITY_BACKGROUND, PRIORITY_NORMAL, PRIORITY_SYNC, PRIORITY_NORMAL):
+            semaphore.acquire(priority).addCallback(lambda _, p=priority: order.append(p))
+        for _ in xrange(4):
+            semaphore.release()
+        self.assertEqual(order, [PRIORITY_SYNC, PRIORITY_NORMAL, PRIORITY_NORMAL, PRIORITY_BACKGROUND])
+        semaphore.release()
+        self.assertEqual(semaphore.tokens, 1)
+
+    def test_max_queue(self):
+        semaphore = PrioritySemaphore(1, max_queue=1)
+        semaphore.acquire()
+        semaphore.acquire()
+        result = self._results(semaphore.acquire())
+        self.assertTrue(result[0].check(Overloaded))
+        # sync is never rejected
+        self.assertEqual(self._results(semaphore.acquire(PRIORITY_SYNC)), [])
+        self.assertEqual(len(semaphore), 2)
+
+    def test_timeout(self):
+        clock = task.Clock()
+        semaphore = PrioritySemaphore(1, timeout=1, clock=clock)
+        semaphore.acquire()
+        expired = self._results(semaphore.acquire())
+        sync = self._results(semaphore.acquire(PRIORITY_SYNC))
+        clock.advance(0.5)
+        waiting = self._results(semaphore.acquire())
+        # waiter fails at timeout, not at next release
+        clock.advance(0.6)
+        self.assertTrue(expired[0].check(DeadlineExceeded))
+        self.assertEqual(len(semaphore), 2)
+        semaphore.release()
+        semaphore.release()
+        self.assertEqual(sync, [semaphore])
+        self.assertEqual(waiting, [semaphore])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_deadline(self):
+        clock = task.Clock()
+        semaphore = PrioritySemaphore(1, timeout=10, clock=clock)
+        semaphore.acquire()
+        expired = self._results(semaphore.acquire(PRIORITY_SYNC, deadline=2))
+        clock.advance(2)
+        self.assertEqual(str(expired[0].value), 'deadline exceeded')
+        self.assertEqual(len(semaphore), 0)
+        # expired work gets no token even when there is one
+        semaphore.release()
+        self.assertTrue(self._results(semaphore.acquire(deadline=1))[0].check(DeadlineExceeded))
+        self.assertEqual(semaphore.tokens, 1)
+
+    def test_cancel(self):
+        semaphore = PrioritySemaphore(1)
+        semaphore.acquire()
+        d = semaphore.acquire()
+        result = self._results(d)
+        d.cancel()
+        self.assertTrue(result[0].check(defer.CancelledError))
+        self.assertEqual(len(semaphore), 0)
+        semaphore.release()
+        self.assertEqual(semaphore.tokens, 1)
+
+    def test_run_releases(self):
+        semaphore = PrioritySemaphore(1)
+        result = self._results(semaphore.run(PRIORITY_NORMAL, lambda x: x * 2, 21))
+        self.assertEqual(result, [42])
+        self.assertEqual(semaphore.tokens, 1)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_take(self):
+        limiter = RateLimiter(10, 5)
+        self.assertEqual(limiter.take('a', 5), 0)
+        self.assertTrue(0 < limiter.take('a') <= 0.1)
+        self.assertEqual(limiter.take('b'), 0)
+
+    def test_disabled(self):
+        limiter = RateLimiter(0, 0)
+        self.assertEqual(limiter.take('a', 1000), 0)
+
+    def test_forget_clients(self):
+        limiter = RateLimiter(1, 1, max_clients=2)
+        limiter.take('a')
+        limiter.take('b')
+        limiter.take('c')
+        # a was forgotten and gets full bucket again
+        self.assertEqual(limiter.take('a'), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
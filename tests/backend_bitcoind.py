@@ -0,0 +1,87 @@
+import unittest
+
+from twisted.internet import defer, error
+
+from lib import tracing
+from lib.backend.bitcoind.bitcoind import BitcoinJSONRPC, JSONRPCException, check_batch
+
+
+class FakeJSONRPC(BitcoinJSONRPC):
+    """Answers requests with canned responses instead of bitcoind"""
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.requests = []
+
+    def _request(self, data, priority, deadline):
+        self.requests.append(data)
+        self.deadline = deadline
+        return defer.succeed(self.reply(data))
+
+
+def echo(data):
+    return [{'id': x['id'], 'error': None, 'result': x['params']} for x in data]
+
+
+class TestCallBatch(unittest.TestCase):
+    def _result(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results[0]
+
+    def test_empty(self):
+        rpc = FakeJSONRPC(echo)
+        self.assertEqual(self._result(rpc.call_batch([])), [])
+        self.assertEqual(rpc.requests, [])
+
+    def test_order(self):
+        # bitcoind may answer batch items in any order
+        rpc = FakeJSONRPC(lambda data: echo(data)[::-1])
+        calls = [('getblockhash', [i]) for i in xrange(5)] + [('getblockcount', None)]
+        self.assertEqual(self._result(rpc.call_batch(calls)), [[i] for i in xrange(5)] + [[]])
+        self.assertEqual([x['id'] for x in rpc.requests[0]], range(6))
+
+    def test_item_errors(self):
+        def reply(data):
+            responses = echo(data)
+            responses[1] = {'id': 1, 'error': {'code': -5, 'message': 'No such tx'}, 'result': None}
+            del responses[2]['result']
+            return responses
+        rpc = FakeJSONRPC(reply)
+        results = self._result(rpc.call_batch([('getrawtransaction', [i]) for i in xrange(4)]))
+        # failed items do not fail the whole batch
+        self.assertEqual(results[0], [0])
+        self.assertEqual(results[3], [3])
+        self.assertEqual(results[1].error['code'], -5)
+        self.assertEqual(results[2].error['code'], -343)
+        self.assertEqual(check_batch([1, 2]), [1, 2])
+        self.assertRaises(JSONRPCException, check_batch, results)
+
+    def test_batch_errors(self):
+        # bitcoind replies with one error object to malformed batch
+        rpc = FakeJSONRPC(lambda data: {'id': None, 'error': {'code': -32700, 'message': 'Parse error'}})
+        failure = self._result(rpc.call_batch([('getblockcount', [])]))
+        self.assertEqual(failure.value.error['code'], -32700)
+
+        rpc = FakeJSONRPC(lambda data: echo(data)[1:])
+        failure = self._result(rpc.call_batch([('getblockcount', []), ('getblockcount', [])]))
+        self.assertTrue(failure.check(JSONRPCException))
+        self.assertEqual(failure.value.error['code'], -343)
+
+    def test_deadline(self):
+        rpc = FakeJSONRPC(echo)
+        with tracing.activate_deadline(5):
+            rpc.call_batch([('getblockcount', [])])
+        self.assertEqual(rpc.deadline, 5)
+        rpc.call_batch([('getblockcount', [])], deadline=3)
+        self.assertEqual(rpc.deadline, 3)
+
+    def test_connection_error(self):
+        rpc = FakeJSONRPC(None)
+        rpc._request = lambda data, priority, deadline: defer.fail(error.ConnectionRefusedError())
+        failure = self._result(rpc.call_batch([('getblockcount', [])]))
+        self.assertTrue(failure.check(error.ConnectionRefusedError))
+
+
+if __name__ == "__main__":
+    unittest.main()
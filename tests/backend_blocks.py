@@ -0,0 +1,74 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from lib.backend.blocks import BlockFiles, InvalidBlock, parse_block
+from lib.backend.merkle import MerkleTree
+
+
+MAGIC = '\xfa\xbf\xb5\xda'
+
+
+def dsha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def make_tx(n, witness=False):
+    inputs = '\x01' + dsha256(str(n)) + struct.pack('<I', 0) + '\x02\x51\x51' + '\xff' * 4
+    outputs = '\x01' + struct.pack('<Q', n) + '\x01\x51'
+    if witness:
+        return struct.pack('<I', 2) + '\x00\x01' + inputs + outputs + '\x01\x03abc' + '\x00' * 4, \
+            dsha256(struct.pack('<I', 2) + inputs + outputs + '\x00' * 4)[::-1].encode('hex')
+    raw = struct.pack('<I', 1) + inputs + outputs + '\x00' * 4
+    return raw, dsha256(raw)[::-1].encode('hex')
+
+def make_block(txs, merkle_root=None):
+    txids = [txid for _, txid in txs]
+    if merkle_root is None:
+        merkle_root = MerkleTree(txids).root.decode('hex')[::-1]
+    header = struct.pack('<I', 1) + '\x00' * 32 + merkle_root + struct.pack('<III', 0, 0x207fffff, 0)
+    raw = header + chr(len(txs)) + ''.join(tx for tx, _ in txs)
+    return raw, dsha256(header)[::-1].encode('hex')
+
+
+class TestBlocks(unittest.TestCase):
+    def test_parse_block(self):
+        txs = [make_tx(0), make_tx(1, witness=True), make_tx(2)]
+        raw, blockhash = make_block(txs)
+        block = parse_block(raw, blockhash)
+        self.assertEqual(block['txids'], [txid for _, txid in txs])
+        start, end = block['tx'][txs[1][1]]
+        self.assertEqual(raw[start:end], txs[1][0])
+        self.assertEqual(block['tree'].position(txs[2][1]), 2)
+
+        self.assertRaises(InvalidBlock, parse_block, raw, '00' * 32)
+        self.assertRaises(InvalidBlock, parse_block, raw[:-1])
+        self.assertRaises(InvalidBlock, parse_block, raw + '\x00')
+        raw, blockhash = make_block(txs, merkle_root='\x00' * 32)
+        self.assertRaises(InvalidBlock, parse_block, raw)
+
+    def test_block_files(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            blocks = [make_block([make_tx(i)]) for i in xrange(3)]
+            key = '\x01\x02\x03\x04\x05\x06\x07\x08'
+            with open(os.path.join(tmpdir, 'xor.dat'), 'wb') as f:
+                f.write(key)
+            def write(name, records):
+                data = ''.join(MAGIC + struct.pack('<I', len(raw)) + raw for raw, _ in records)
+                data += '\x00' * 100
+                with open(os.path.join(tmpdir, name), 'wb') as f:
+                    f.write(''.join(chr(ord(c) ^ ord(key[i % 8])) for i, c in enumerate(data)))
+
+            write('blk00000.dat', blocks[:2])
+            files = BlockFiles(tmpdir, MAGIC)
+            self.assertEqual(files.get(blocks[1][1]), blocks[1][0])
+            self.assertEqual(files.get(blocks[2][1]), None)
+            # new file is picked up on lookup of unknown block
+            write('blk00001.dat', blocks[2:])
+            self.assertEqual(files.get(blocks[2][1]), blocks[2][0])
+            self.assertEqual(len(files), 3)
+        finally:
+            shutil.rmtree(tmpdir)
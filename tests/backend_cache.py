@@ -0,0 +1,40 @@
+import unittest
+
+from lib.backend.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(30)
+        cache.set('a', 'A', 10)
+        cache.set('b', 'B', 10)
+        cache.set('c', 'C', 10)
+        self.assertEqual(cache.get('a'), 'A')
+        cache.set('d', 'D', 10)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.size, 30)
+
+    def test_too_big_value(self):
+        cache = LRUCache(10)
+        cache.set('a', 'A', 11)
+        self.assertEqual(len(cache), 0)
+
+    def test_stats(self):
+        cache = LRUCache(10)
+        cache.set('a', 'A', 1)
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_remove_if(self):
+        cache = LRUCache(100)
+        for i in xrange(10):
+            cache.set(i, i, 1)
+        cache.remove_if(lambda key, value: value % 2)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.size, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
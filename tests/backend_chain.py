@@ -0,0 +1,90 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from lib.backend.chain import (HashIndex, InvalidHeader, bits_to_target, hash_headers,
+                               link_headers)
+
+
+REGTEST_BITS = 0x207fffff
+
+
+def dsha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def make_chain(count, prev='\x00' * 32, bits=REGTEST_BITS, tag=0):
+    headers = []
+    target = bits_to_target(bits)
+    for i in xrange(count):
+        nonce = 0
+        while True:
+            header = struct.pack('<I', 1) + prev + struct.pack('<I', tag) + '\x00' * 28 + \
+                struct.pack('<III', i, bits, nonce)
+            if int(dsha256(header)[::-1].encode('hex'), 16) <= target:
+                break
+            nonce += 1
+        headers.append(header)
+        prev = dsha256(header)
+    return ''.join(headers)
+
+
+class TestChain(unittest.TestCase):
+    def test_bits_to_target(self):
+        self.assertEqual(bits_to_target(0x1d00ffff), 0xffff << 208)
+        self.assertEqual(bits_to_target(0x207fffff), 0x7fffff << 232)
+        self.assertEqual(bits_to_target(0x03123456), 0x123456)
+        self.assertRaises(InvalidHeader, bits_to_target, 0x04923456)
+
+    def test_link_headers(self):
+        raw = make_chain(10)
+        hashes, count = link_headers(None, raw, bits_to_target(REGTEST_BITS))
+        self.assertEqual(count, 10)
+        self.assertEqual(hashes, hash_headers(raw))
+
+        # fork after 5th header
+        fork = make_chain(3, prev=hashes[4*32:5*32], tag=1)
+        self.assertEqual(link_headers(hashes[-32:], fork, bits_to_target(REGTEST_BITS))[1], 0)
+        self.assertEqual(link_headers(None, raw[:400] + fork, bits_to_target(REGTEST_BITS))[1], 8)
+        self.assertEqual(link_headers(None, raw[:480] + fork, bits_to_target(REGTEST_BITS))[1], 6)
+
+    def test_invalid_pow(self):
+        raw = make_chain(1)
+        self.assertRaises(InvalidHeader, link_headers, None, raw, bits_to_target(0x1d00ffff))
+        # bits claim mainnet difficulty, hash is far above the target
+        header = raw[:72] + struct.pack('<I', 0x1d00ffff) + raw[76:]
+        self.assertRaises(InvalidHeader, link_headers, None, header, bits_to_target(0x207fffff))
+
+    def test_hash_index(self):
+        raw = make_chain(5)
+        index = HashIndex(hash_headers(raw[:240]))
+        index.append(hash_headers(raw[240:]))
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.get(4), dsha256(raw[320:])[::-1].encode('hex'))
+        index.replace(2, hash_headers(raw[:80]))
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.digest(2), dsha256(raw[:80]))
+        index.truncate(1)
+        self.assertRaises(IndexError, index.get, 1)
+
+    def test_hash_index_save(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'blockchain_hashes')
+            self.assertEqual(len(HashIndex.load(path)), 0)
+            raw = make_chain(3)
+            HashIndex(hash_headers(raw)).save(path)
+            index = HashIndex.load(path)
+            self.assertEqual(index.digest(2), dsha256(raw[160:]))
+            # partly written file
+            with open(path, 'ab') as f:
+                f.write('x' * 10)
+            self.assertEqual(len(HashIndex.load(path)), 3)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
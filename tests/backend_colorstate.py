@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.backend.bitcoind.backend import Backend
+from lib.backend.colorstate import ColorStateCache
+
+
+TX1 = '11' * 32
+TX2 = '22' * 32
+BLOCK1 = 'aa' * 32
+BLOCK2 = 'bb' * 32
+
+
+class TestColorStateCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'colorstate.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_set(self):
+        cache = ColorStateCache(self.path)
+        self.assertEqual(cache.get('obc:x:0:1', TX1, 0), None)
+        cache.set('obc:x:0:1', TX1, 0, BLOCK1, [(TX2, 1), (TX2, 3)])
+        self.assertEqual(cache.get('obc:x:0:1', TX1, 0), [(TX2, 1), (TX2, 3)])
+        self.assertEqual(cache.get('obc:x:0:1', TX1, 1), None)
+        self.assertEqual(cache.get('epobc:x:0:1', TX1, 0), None)
+
+    def test_persistence(self):
+        cache = ColorStateCache(self.path)
+        cache.set('obc:x:0:1', TX1, 0, BLOCK1, [(TX2, 1)])
+        cache.set('obc:x:0:1', TX2, 1, BLOCK2, [])
+        cache.close()
+        cache = ColorStateCache(self.path)
+        self.assertEqual(cache.get('obc:x:0:1', TX1, 0), [(TX2, 1)])
+        self.assertEqual(cache.get('obc:x:0:1', TX2, 1), [])
+        self.assertEqual(cache.stats()['stored'], 2)
+
+    def test_remove_blocks(self):
+        cache = ColorStateCache(self.path)
+        cache.set('obc:x:0:1', TX1, 0, BLOCK1, [(TX2, 1)])
+        cache.flush()
+        cache.set('obc:x:0:1', TX2, 1, BLOCK2, [])
+        cache.remove_blocks([BLOCK1, BLOCK2])
+        self.assertEqual(cache.get('obc:x:0:1', TX1, 0), None)
+        self.assertEqual(cache.get('obc:x:0:1', TX2, 1), None)
+        cache.close()
+        self.assertEqual(ColorStateCache(self.path).get('obc:x:0:1', TX1, 0), None)
+
+    def test_evict_least_recently_used(self):
+        cache = ColorStateCache(self.path, max_entries=2, memory_entries=1)
+        cache.set('obc:x:0:1', TX1, 0, BLOCK1, [])
+        cache.set('obc:x:0:1', TX1, 1, BLOCK1, [])
+        cache.flush()
+        cache.get('obc:x:0:1', TX1, 0)
+        cache.set('obc:x:0:1', TX1, 2, BLOCK1, [])
+        cache.flush()
+        cache.close()
+        cache = ColorStateCache(self.path)
+        self.assertEqual(cache.get('obc:x:0:1', TX1, 1), None)
+        self.assertEqual(cache.get('obc:x:0:1', TX1, 0), [])
+        self.assertEqual(cache.get('obc:x:0:1', TX1, 2), [])
+
+    def test_readonly(self):
+        cache = ColorStateCache(self.path)
+        reader = ColorStateCache(self.path, readonly=True)
+        cache.set('obc:x:0:1', TX1, 0, BLOCK1, [(TX2, 1)])
+        cache.flush()
+        self.assertEqual(reader.get('obc:x:0:1', TX1, 0), [(TX2, 1)])
+        # entries of reader stay in its memory
+        reader.set('obc:x:0:1', TX2, 1, BLOCK2, [])
+        reader.flush()
+        self.assertEqual(reader.get('obc:x:0:1', TX2, 1), [])
+        self.assertEqual(cache.get('obc:x:0:1', TX2, 1), None)
+        reader.remove_blocks([BLOCK1])
+        self.assertEqual(cache.get('obc:x:0:1', TX1, 0), [(TX2, 1)])
+        self.assertFalse('stored' in reader.stats())
+        reader.close()
+        cache.close()
+
+
+class ChainBackend(object):
+    """Just enough of Backend for _expand_known"""
+    _expand_known = Backend._expand_known.im_func
+
+    def __init__(self, cache):
+        self._colorstate = cache
+
+
+class TestExpandKnown(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ColorStateCache(os.path.join(self.tmpdir, 'colorstate.sqlite'))
+        # tx i spends output 0 of tx i+1, tx 50 is not in cache
+        self.txs = ['%064x' % i for i in xrange(51)]
+        for i in xrange(50):
+            self.cache.set('obc:x:0:1', self.txs[i], 0, BLOCK1, [(self.txs[i+1], 0)])
+        self.backend = ChainBackend(self.cache)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_walk(self):
+        known, unknown = self.backend._expand_known(
+            'obc:x:0:1', set([(self.txs[0], 0)]), set(), {})
+        self.assertEqual(known, self.txs[:50])
+        self.assertEqual(unknown, set([(self.txs[50], 0)]))
+
+    def test_budget(self):
+        visited = set()
+        known, unknown = self.backend._expand_known(
+            'obc:x:0:1', set([(self.txs[0], 0)]), visited, {self.txs[0]: ''}, budget=5)
+        self.assertEqual(known, self.txs[:6])
+        self.assertEqual(len(visited), 7)
+
+    def test_deadline(self):
+        known, unknown = self.backend._expand_known(
+            'obc:x:0:1', set([(self.txs[0], 0)]), set(), {}, deadline=0)
+        self.assertEqual((known, unknown), ([], set()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.backend.headers import HeadersStore, HEADER_SIZE, PREALLOCATE
+
+
+class TestHeadersStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'blockchain_headers')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _header(self, i):
+        return chr(i % 255 + 1) * HEADER_SIZE
+
+    def test_empty(self):
+        store = HeadersStore(self.path)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.height, -1)
+        self.assertEqual(len(store.get_range(0, 2016)), 0)
+        self.assertRaises(IndexError, store.get, 0)
+
+    def test_append_and_get(self):
+        store = HeadersStore(self.path)
+        store.append(''.join(self._header(i) for i in xrange(5000)))
+        self.assertEqual(store.height, 4999)
+        self.assertEqual(str(store.get(4321)), self._header(4321))
+        self.assertEqual(len(store.get_range(4032, 6048)), 968*HEADER_SIZE)
+
+    def test_reopen_without_close(self):
+        store = HeadersStore(self.path)
+        store.append(self._header(0) * 10)
+        store.flush()
+        self.assertEqual(len(HeadersStore(self.path)), 10)
+
+    def test_truncate(self):
+        store = HeadersStore(self.path)
+        store.append(self._header(0) * 10)
+        store.truncate(7)
+        self.assertEqual(store.height, 6)
+        store.close()
+        self.assertEqual(os.path.getsize(self.path), 7*HEADER_SIZE)
+        self.assertEqual(len(HeadersStore(self.path)), 7)
+
+    def test_replace(self):
+        store = HeadersStore(self.path)
+        store.append(''.join(self._header(i) for i in xrange(10)))
+        store.replace(4, self._header(100) * 2)
+        self.assertEqual(store.height, 5)
+        self.assertEqual(str(store.get(3)), self._header(3))
+        self.assertEqual(str(store.get(5)), self._header(100))
+        store.replace(6, ''.join(self._header(i) for i in xrange(3000)))
+        self.assertEqual(store.height, 3005)
+        store.flush()
+        self.assertEqual(len(HeadersStore(self.path)), 3006)
+
+    def test_invalid_writes(self):
+        store = HeadersStore(self.path)
+        store.append(self._header(0) * 3)
+        self.assertRaises(ValueError, store.append, 'x' * (HEADER_SIZE + 1))
+        self.assertRaises(ValueError, store.replace, 1, 'x' * 10)
+        self.assertRaises(IndexError, store.replace, 4, self._header(1))
+        self.assertEqual(len(store), 3)
+
+    def test_preallocation(self):
+        store = HeadersStore(self.path)
+        store.append(''.join(self._header(i) for i in xrange(2017)))
+        store.close(trim=False)
+        # zeroed tail of preallocated file is not counted
+        self.assertEqual(os.path.getsize(self.path), 2*PREALLOCATE)
+        store = HeadersStore(self.path)
+        self.assertEqual(len(store), 2017)
+        store.truncate(5)
+        store.close(trim=False)
+        self.assertEqual(len(HeadersStore(self.path)), 5)
+
+    def test_partial_record(self):
+        with open(self.path, 'wb') as f:
+            f.write(self._header(0) * 2 + 'x' * 10)
+        store = HeadersStore(self.path)
+        self.assertEqual(len(store), 2)
+        store.close()
+        self.assertEqual(os.path.getsize(self.path), 2*HEADER_SIZE)
+
+    def test_readonly_refresh(self):
+        store = HeadersStore(self.path)
+        reader = HeadersStore(self.path, readonly=True)
+        self.assertEqual(len(reader), 0)
+        store.append(''.join(self._header(i) for i in xrange(3000)))
+        reader.refresh()
+        self.assertEqual(reader.height, 2999)
+        self.assertEqual(str(reader.get(2999)), self._header(2999))
+        store.truncate(10)
+        reader.refresh()
+        self.assertEqual(len(reader), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
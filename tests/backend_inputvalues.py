@@ -0,0 +1,57 @@
+import unittest
+
+from twisted.internet import defer
+
+from lib.backend.bitcoind.backend import AsyncCTransaction
+
+
+class Record(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def make_tx(bs, prevouts, values):
+    tx = AsyncCTransaction.__new__(AsyncCTransaction)
+    tx.bs = bs
+    tx.have_input_values = False
+    tx.inputs = [Record(prevout=Record(hash=txhash, n=n)) for txhash, n in prevouts]
+    tx.outputs = [Record(value=value) for value in values]
+    return tx
+
+
+class FakeBackend(object):
+    def __init__(self):
+        self.txs = {}
+        self.requests = []
+
+    def get_async_transactions(self, txhashes):
+        self.requests.append(txhashes)
+        return defer.succeed([self.txs[x] for x in txhashes])
+
+
+class TestInputValues(unittest.TestCase):
+    def test_values(self):
+        bs = FakeBackend()
+        bs.txs['a'] = make_tx(bs, [('coinbase', 0)], [50])
+        bs.txs['b'] = make_tx(bs, [('a', 0)], [10, 20, 30])
+        tx = make_tx(bs, [('b', 2), ('a', 0), ('b', 0)], [85])
+        tx.ensure_input_values()
+        self.assertEqual([inp.value for inp in tx.inputs], [30, 50, 10])
+        # distinct prev txs are fetched in one go
+        self.assertEqual(bs.requests, [['a', 'b']])
+        # only values are kept, not prev txs
+        self.assertFalse(hasattr(tx.inputs[0], 'prevtx'))
+
+        tx.ensure_input_values()
+        self.assertEqual(len(bs.requests), 1)
+
+    def test_coinbase(self):
+        bs = FakeBackend()
+        tx = make_tx(bs, [('coinbase', 0)], [25, 3])
+        tx.ensure_input_values()
+        self.assertEqual(tx.inputs[0].value, 28)
+        self.assertEqual(bs.requests, [[]])
+
+
+if __name__ == "__main__":
+    unittest.main()
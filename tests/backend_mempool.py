@@ -0,0 +1,62 @@
+import unittest
+
+from twisted.internet import defer
+
+from lib.backend.bitcoind.bitcoind import JSONRPCException
+from lib.backend.bitcoind.mempool import Mempool
+
+
+class FakeBitcoind(object):
+    def __init__(self, txs):
+        self.txs = txs
+        self.fetched = []
+
+    def call(self, method, params=None, priority=None):
+        assert method == 'getrawmempool'
+        return defer.succeed(sorted(self.txs))
+
+    def call_batch(self, calls, priority=None):
+        results = []
+        for method, params in calls:
+            self.fetched.append(params[0])
+            # tx left mempool after getrawmempool
+            if self.txs[params[0]] is None:
+                results.append(JSONRPCException({'code': -5, 'message': 'No such tx'}))
+            else:
+                results.append(self.txs[params[0]])
+        return defer.succeed(results)
+
+
+class TestMempool(unittest.TestCase):
+    def test_refresh(self):
+        bitcoind = FakeBitcoind({'a': 'aaaa', 'b': 'bb', 'c': None})
+        mempool = Mempool(bitcoind, 100, batch=2)
+        mempool.refresh()
+        self.assertEqual(sorted(bitcoind.fetched), ['a', 'b', 'c'])
+        self.assertEqual(mempool.get('a'), 'aaaa')
+        self.assertFalse('c' in mempool)
+        self.assertEqual(mempool.size, 6)
+
+        # only new txs are fetched, txs gone from bitcoind are dropped
+        bitcoind.fetched = []
+        bitcoind.txs = {'b': 'bb', 'd': 'dd'}
+        mempool.refresh()
+        self.assertEqual(bitcoind.fetched, ['d'])
+        self.assertEqual(mempool.get('a'), None)
+        self.assertEqual(mempool.size, 4)
+
+    def test_skipped(self):
+        bitcoind = FakeBitcoind({'a': 'aaaa', 'b': 'bbbb'})
+        mempool = Mempool(bitcoind, 6)
+        mempool.refresh()
+        self.assertEqual(mempool.stats(), {'entries': 1, 'skipped': 1, 'size': 4})
+
+        # txs over max_size are not fetched again
+        bitcoind.fetched = []
+        mempool.refresh()
+        self.assertEqual(bitcoind.fetched, [])
+
+        # nor remembered after they left mempool
+        del bitcoind.txs['b']
+        mempool.refresh()
+        self.assertEqual(mempool.stats()['skipped'], 0)
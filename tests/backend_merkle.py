@@ -0,0 +1,40 @@
+import hashlib
+import unittest
+
+from lib.backend.merkle import MerkleTree, hash_digest
+
+
+def txhash(i):
+    return hashlib.sha256(str(i)).hexdigest()
+
+
+class TestMerkleTree(unittest.TestCase):
+    def _verify(self, tree, tx, branch):
+        h = tx.decode('hex')[::-1]
+        pos = tree.position(tx)
+        for sibling in branch:
+            sibling = sibling.decode('hex')[::-1]
+            h = hash_digest(sibling + h) if pos & 1 else hash_digest(h + sibling)
+            pos >>= 1
+        return h[::-1].encode('hex') == tree.root
+
+    def test_single_tx(self):
+        tree = MerkleTree([txhash(0)])
+        self.assertEqual(tree.root, txhash(0))
+        self.assertEqual(tree.branch(txhash(0)), [])
+
+    def test_branches(self):
+        for count in [2, 3, 7, 8, 33]:
+            txhashes = map(txhash, xrange(count))
+            tree = MerkleTree(txhashes)
+            self.assertEqual(tree.txhashes(), txhashes)
+            for tx in txhashes:
+                self.assertTrue(self._verify(tree, tx, tree.branch(tx)))
+
+    def test_unknown_tx(self):
+        tree = MerkleTree([txhash(0), txhash(1)])
+        self.assertRaises(Exception, tree.branch, txhash(2))
+
+
+if __name__ == "__main__":
+    unittest.main()
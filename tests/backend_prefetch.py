@@ -0,0 +1,99 @@
+import unittest
+
+from twisted.internet import defer
+
+from lib.backend.bitcoind.backend import Backend
+from lib.backend.singleflight import SingleFlight
+
+
+class Outpoint(object):
+    def __init__(self, txhash, n):
+        self.hash = txhash
+        self.n = n
+
+
+class Input(object):
+    def __init__(self, txhash, n):
+        self.prevout = Outpoint(txhash, n)
+
+
+class Transaction(object):
+    def __init__(self, inputs):
+        self.inputs = inputs
+
+
+class ColorDefinition(object):
+    """Every input affects every output"""
+
+    def get_affecting_inputs(self, tx, outputs):
+        return tx.inputs
+
+
+class GraphBackend(object):
+    """Just enough of Backend for prefetch, tx i spends output 0 of txs
+    2i+1 and 2i+2
+    """
+    prefetch = Backend.prefetch.im_func
+    _expand_known = Backend._expand_known.im_func
+
+    def __init__(self, count, concurrency=8, pending=False):
+        self._singleflight = SingleFlight()
+        self._colorstate = None
+        self._prefetch_timeout = 10
+        self._prefetch_concurrency = concurrency
+        self.txs = ['%064x' % i for i in xrange(count)]
+        self.pending = [] if pending else None
+        self.fetched = []
+
+    def _color_definition(self, color_desc):
+        return ColorDefinition()
+
+    def _get_transaction(self, txhash):
+        return defer.succeed({'hex': txhash[-2:], 'blockhash': None})
+
+    def _get_decoded_transaction(self, txhash):
+        self.fetched.append(txhash)
+        i = int(txhash, 16)
+        inputs = [Input(self.txs[x], 0) for x in (2*i + 1, 2*i + 2) if x < len(self.txs)]
+        entry = {'hex': txhash[-2:], 'tx': Transaction(inputs), 'blockhash': None}
+        if self.pending is None:
+            return defer.succeed(entry)
+        d = defer.Deferred()
+        self.pending.append((d, entry))
+        return d
+
+
+class TestPrefetch(unittest.TestCase):
+    def _result(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results[0]
+
+    def test_walk(self):
+        backend = GraphBackend(15)
+        result = self._result(backend.prefetch(backend.txs[0], [0], 'obc:x:0:1', 0))
+        self.assertEqual(sorted(result), backend.txs)
+        self.assertEqual(result[backend.txs[14]], '0e')
+        # breadth-first, every tx fetched once
+        self.assertEqual(backend.fetched, backend.txs)
+
+    def test_limit(self):
+        backend = GraphBackend(15)
+        result = self._result(backend.prefetch(backend.txs[0], [0], 'obc:x:0:1', 5))
+        self.assertEqual(sorted(result), backend.txs[:5])
+
+    def test_concurrency(self):
+        backend = GraphBackend(7, concurrency=2, pending=True)
+        d = backend.prefetch(backend.txs[0], [0], 'obc:x:0:1', 0)
+        in_flight = []
+        while backend.pending:
+            in_flight.append(len(backend.pending))
+            pending_d, entry = backend.pending.pop(0)
+            pending_d.callback(entry)
+        # one level at a time, at most two fetches at once
+        self.assertEqual(in_flight, [1, 2, 1, 2, 2, 2, 1])
+        self.assertEqual(len(self._result(d)), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+from twisted.internet import defer
+
+from lib.backend.singleflight import SingleFlight, coalesce
+
+
+class Source(object):
+    def __init__(self):
+        self._singleflight = SingleFlight()
+        self.pending = []
+
+    @coalesce
+    def get(self, key, params):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    @coalesce
+    def other(self, key, params):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_shared_call(self):
+        source = Source()
+        results = []
+        source.get('a', {'x': [1, 2]}).addCallback(results.append)
+        source.get('a', {'x': [1, 2]}).addCallback(results.append)
+        source.get('b', {'x': [1, 2]})
+        self.assertEqual(len(source.pending), 2)
+        self.assertEqual(source._singleflight.stats(), {'calls': 3, 'deduplicated': 1, 'in_flight': 2})
+
+        value = {'v': 1}
+        source.pending[0].callback(value)
+        self.assertEqual(results, [value, value])
+        self.assertEqual(source._singleflight.stats()['in_flight'], 1)
+
+        # nothing is kept after the call is done
+        source.get('a', {'x': [1, 2]})
+        self.assertEqual(len(source.pending), 3)
+
+    def test_failure(self):
+        singleflight = SingleFlight()
+        d = defer.Deferred()
+        errors = []
+        for _ in xrange(2):
+            singleflight.call('k', lambda: d).addErrback(lambda f: errors.append(f.value))
+        d.errback(ValueError('boom'))
+        self.assertEqual([str(e) for e in errors], ['boom', 'boom'])
+
+    def test_separate_deferreds(self):
+        singleflight = SingleFlight()
+        d = defer.Deferred()
+        d1 = singleflight.call('k', lambda: d)
+        d2 = singleflight.call('k', lambda: d)
+        # callback of one caller does not change result seen by other
+        d1.addCallback(lambda result: result + 1)
+        d.callback(1)
+        results = []
+        d2.addCallback(results.append)
+        self.assertEqual(results, [1])
+
+    def test_synchronous(self):
+        singleflight = SingleFlight()
+        results = []
+        singleflight.call('k', lambda: 1).addCallback(results.append)
+        singleflight.call('k', lambda: 1 / 0).addErrback(lambda f: results.append(f.type))
+        self.assertEqual(results, [1, ZeroDivisionError])
+        self.assertEqual(singleflight.stats()['in_flight'], 0)
+
+    def test_keys(self):
+        source = Source()
+        source.get('a', {'x': [1, 2], 'y': {'z': 1}})
+        # equal arguments share call whatever their dict order or sequence type
+        source.get('a', {'y': {'z': 1}, 'x': (1, 2)})
+        self.assertEqual(len(source.pending), 1)
+        source.get('a', {'x': [2, 1], 'y': {'z': 1}})
+        # methods do not share calls with the same arguments
+        source.other('a', {'x': [1, 2], 'y': {'z': 1}})
+        self.assertEqual(len(source.pending), 3)
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from lib.backend.chain import bits_to_target, hash_headers
+from lib.backend.colorstate import ColorStateCache
+from lib.backend.headers import HeadersStore
+from lib.backend.snapshot import SnapshotError, export_snapshot, import_snapshot
+from lib.backend.txindex import TxIndex
+from tests.backend_chain import REGTEST_BITS, make_chain
+
+
+MAX_TARGET = bits_to_target(REGTEST_BITS)
+
+
+def txhash(i):
+    return hashlib.sha256(str(i)).hexdigest()
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = os.path.join(self.tmpdir, 'store')
+        self.imported = os.path.join(self.tmpdir, 'imported')
+        os.mkdir(self.store)
+        self.raw = make_chain(10)
+        self.hashes = hash_headers(self.raw)
+        headers = HeadersStore(os.path.join(self.store, 'blockchain_headers'))
+        headers.append(self.raw)
+        headers.close()
+        txindex = TxIndex(os.path.join(self.store, 'txindex.sqlite'))
+        txindex.add_blocks([(h, [txhash(h)]) for h in xrange(10)])
+        txindex.close()
+        colorstate = ColorStateCache(os.path.join(self.store, 'colorstate.sqlite'))
+        for h in (3, 9):
+            colorstate.set('obc', txhash(h), 0, self._blockhash(h), [(txhash(h - 1), 0)])
+        colorstate.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _blockhash(self, height):
+        return self.hashes[height*32:(height+1)*32][::-1].encode('hex')
+
+    def test_export_import(self):
+        filename = os.path.join(self.tmpdir, 'snapshot.tar.gz')
+        manifest = export_snapshot(self.store, filename, MAX_TARGET, confirmations=2)
+        self.assertEqual(manifest['height'], 7)
+        self.assertEqual(manifest['blockhash'], self._blockhash(7))
+
+        manifest = import_snapshot(filename, self.imported, MAX_TARGET, verify=True)
+        self.assertEqual(manifest['height'], 7)
+        headers = HeadersStore(os.path.join(self.imported, 'blockchain_headers'))
+        self.assertEqual(str(headers.get_range(0, 8)), self.raw[:8*80])
+        self.assertEqual(headers.height, 7)
+        headers.close()
+        txindex = TxIndex(os.path.join(self.imported, 'txindex.sqlite'))
+        self.assertEqual(txindex.height, 7)
+        self.assertEqual(txindex.get(txhash(7)), (7, 0))
+        self.assertEqual(txindex.get(txhash(8)), None)
+        txindex.close()
+        # entries of blocks above snapshot height are not exported
+        colorstate = ColorStateCache(os.path.join(self.imported, 'colorstate.sqlite'))
+        self.assertEqual(colorstate.get('obc', txhash(3), 0), [(txhash(2), 0)])
+        self.assertEqual(colorstate.get('obc', txhash(9), 0), None)
+        colorstate.close()
+
+        self.assertRaises(SnapshotError, import_snapshot, filename, self.imported, MAX_TARGET)
+
+    def test_corrupted(self):
+        filename = os.path.join(self.tmpdir, 'snapshot.tar')
+        export_snapshot(self.store, filename, MAX_TARGET, confirmations=0)
+        with tarfile.open(filename) as tar:
+            names = tar.getnames()
+        self.assertEqual(names[0], 'MANIFEST.json')
+        with open(filename, 'r+b') as f:
+            data = f.read()
+            f.seek(data.index(self.raw[400:480]))
+            f.write('\x00' * 80)
+        self.assertRaises(SnapshotError, import_snapshot, filename, self.imported, MAX_TARGET)
+        self.assertFalse(os.path.exists(os.path.join(self.imported, 'blockchain_headers')))
+        self.assertEqual(os.listdir(self.imported), [])
@@ -0,0 +1,67 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from lib.backend.txindex import TxIndex
+
+
+def txhash(i):
+    return hashlib.sha256(str(i)).hexdigest()
+
+
+class TestTxIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'txindex.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _fill(self, index, count):
+        index.add_blocks([(h, [txhash(h*10 + i) for i in xrange(3)]) for h in xrange(count)])
+
+    def test_get(self):
+        index = TxIndex(self.path)
+        self._fill(index, 5)
+        self.assertEqual(index.height, 4)
+        self.assertEqual(index.get(txhash(42)), (4, 2))
+        self.assertEqual(index.get(txhash(5)), None)
+
+    def test_height_mismatch(self):
+        index = TxIndex(self.path)
+        self.assertRaises(Exception, index.add_blocks, [(1, [txhash(0)])])
+
+    def test_rollback(self):
+        index = TxIndex(self.path)
+        self._fill(index, 5)
+        index.rollback(3)
+        self.assertEqual(index.height, 2)
+        self.assertEqual(index.get(txhash(30)), None)
+        index.close()
+        self.assertEqual(TxIndex(self.path).height, 2)
+
+    def test_bulk(self):
+        index = TxIndex(self.path)
+        index.set_bulk(True)
+        self._fill(index, 5)
+        index.set_bulk(False)
+        self.assertEqual(index.get(txhash(11)), (1, 1))
+
+    def test_readonly(self):
+        index = TxIndex(self.path)
+        self._fill(index, 2)
+        reader = TxIndex(self.path, readonly=True)
+        self.assertEqual(reader.height, 1)
+        index.add_blocks([(2, [txhash(20)])])
+        self.assertEqual(reader.get(txhash(20)), (2, 0))
+        # bulk mode of writer drops height index, reader does not need it
+        index.set_bulk(True)
+        self.assertEqual(reader.get(txhash(11)), (1, 1))
+        reader.close()
+        index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
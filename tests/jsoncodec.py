@@ -0,0 +1,21 @@
+import json
+import unittest
+
+from lib.jsoncodec import iterencode
+
+
+class TestJSONCodec(unittest.TestCase):
+    def test_iterencode(self):
+        objs = [
+            None, 1, 'a', [], {},
+            {'result': [{'height': 1, 'hash': 'ab'}, [1, [2, []]]], 'error': None},
+            [{'result': {'tx': ['01', '02'], 1: True, None: 1.5}, 'error': None}, {}],
+        ]
+        for obj in objs:
+            for depth in xrange(5):
+                self.assertEqual(''.join(iterencode(obj, depth)), json.dumps(obj))
+
+    def test_pieces(self):
+        pieces = list(iterencode({'result': range(3), 'error': None}))
+        self.assertTrue(len(pieces) > 3)
+        self.assertTrue('1' in pieces)
@@ -0,0 +1,46 @@
+import unittest
+
+from lib.metrics import Counter, GaugeFunc, Histogram, Registry
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = Counter('calls_total', 'Calls', ('method',))
+        counter.inc(('a',))
+        counter.inc(('a',), 2)
+        counter.inc(('b"\\n',))
+        self.assertEqual(counter.render().split('\n'), [
+            '# HELP calls_total Calls',
+            '# TYPE calls_total counter',
+            'calls_total{method="a"} 3',
+            'calls_total{method="b\\"\\\\n"} 1',
+        ])
+
+    def test_histogram(self):
+        histogram = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.render().split('\n')[2:], [
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            'latency_seconds_sum 2.65',
+            'latency_seconds_count 4',
+        ])
+
+    def test_gauge_func(self):
+        values = {('x',): 1.5, ('y',): None}
+        gauge = GaugeFunc('ratio', 'Ratio', lambda: values, ('cache',))
+        self.assertEqual(gauge.render().split('\n')[2:], ['ratio{cache="x"} 1.5'])
+
+    def test_registry(self):
+        registry = Registry()
+        registry.register(GaugeFunc('b', 'B', lambda: 1))
+        registry.register(GaugeFunc('a', 'A', lambda: 2))
+        registry.register(GaugeFunc('a', 'A', lambda: 3))
+        self.assertEqual(registry.render(),
+                         '# HELP a A\n# TYPE a gauge\na 3\n# HELP b B\n# TYPE b gauge\nb 1\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+
+from twisted.internet import defer
+
+from lib import tracing
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self._settings = tracing.settings()
+        tracing.configure(enabled=True, sample=1.0, slow_threshold=1000)
+
+    def tearDown(self):
+        tracing.configure(**self._settings)
+
+    def test_disabled(self):
+        tracing.configure(enabled=False)
+        self.assertEqual(tracing.start_trace('http:x'), None)
+        with tracing.span('a') as span:
+            self.assertEqual(span, None)
+        f = lambda x: x + 1
+        self.assertTrue(tracing.bind(f) is f)
+        self.assertEqual(tracing.run_in_span('a', f, 1), 2)
+
+    def test_tree(self):
+        root = tracing.start_trace('http:x')
+        with tracing.activate(root):
+            with tracing.span('a'):
+                for _ in xrange(3):
+                    tracing.record('b', root.start, root.start + 0.5)
+            d = defer.Deferred()
+            self.assertTrue(tracing.run_in_span('c', lambda: d) is d)
+        self.assertEqual(tracing.current(), None)
+        self.assertEqual([span.name for span in root.children], ['a', 'c'])
+        self.assertEqual(root.children[1].end, None)
+        d.callback(None)
+        self.assertNotEqual(root.children[1].end, None)
+
+        lines = root.trace.format().split('\n')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].endswith(' a'))
+        self.assertTrue(lines[1].startswith('    +0.000 0.500 s b x3 (sum 1.500 s)'))
+        self.assertTrue(lines[2].endswith(' c'))
+
+    def test_max_spans(self):
+        root = tracing.start_trace('http:x')
+        for _ in xrange(tracing.MAX_SPANS + 10):
+            root.child('a').finish()
+        self.assertEqual(len(root.children), tracing.MAX_SPANS - 1)
+        self.assertEqual(root.trace.dropped, 11)
+
+    def test_slow(self):
+        tracing.configure(slow_threshold=0)
+        root = tracing.start_trace('http:slow')
+        root.trace.finish()
+        self.assertEqual(tracing.slow_traces()[-1]['name'], 'http:slow')
+
+    def test_inline_callbacks(self):
+        waiting = []
+        @tracing.inlineCallbacks
+        def inner():
+            d = defer.Deferred()
+            waiting.append(d)
+            yield d
+            tracing.record('inner', 0, 0)
+            defer.returnValue(1)
+        @tracing.inlineCallbacks
+        def outer():
+            value = yield tracing.run_in_span('call', inner)
+            try:
+                d = defer.Deferred()
+                waiting.append(d)
+                yield d
+            except ValueError:
+                tracing.record('error', 0, 0)
+            defer.returnValue(value + 1)
+
+        root = tracing.start_trace('http:x')
+        with tracing.activate(root):
+            result = outer()
+        waiting.pop(0).callback(None)
+        self.assertEqual(tracing.current(), None)
+        waiting.pop(0).errback(ValueError())
+        self.assertEqual(result.result, 2)
+        self.assertEqual([span.name for span in root.children], ['call', 'error'])
+        self.assertEqual([span.name for span in root.children[0].children], ['inner'])
+
+        # without trace it is plain inlineCallbacks
+        result = outer()
+        waiting.pop(0).callback(None)
+        waiting.pop(0).callback(None)
+        self.assertEqual(result.result, 2)
+
+    def test_deadline(self):
+        tracing.configure(enabled=False)
+        waiting = []
+        @tracing.inlineCallbacks
+        def work():
+            d = defer.Deferred()
+            waiting.append(d)
+            yield d
+            defer.returnValue(tracing.deadline())
+
+        with tracing.activate_deadline(5):
+            result = work()
+            bound = tracing.bind(tracing.deadline)
+        self.assertEqual(tracing.deadline(), None)
+        waiting.pop().callback(None)
+        self.assertEqual(result.result, 5)
+        self.assertEqual(bound(), 5)
+        self.assertEqual(tracing.deadline(), None)
@@ -2,6 +2,11 @@ import unittest
 import urllib2
 import json
 
+from twisted.test import proto_helpers
+from twisted.web.resource import Resource
+
+from lib.transport.http import Site
+
 
 class TestTransportHTTP(unittest.TestCase):
     def setUp(self):
@@ -51,6 +56,28 @@ class TestTransportHTTP(unittest.TestCase):
         self._assertError400(request, 'method not found')
 
 
+    def test_empty_batch(self):
+        request = urllib2.Request(self.server_url, json.dumps([]))
+        self._assertError400(request, 'empty batch')
+
+    def test_batch(self):
+        data = json.dumps([
+            {'method': 'getblockcount', 'params': {}},
+            {'method': 'strange method', 'params': {}},
+            {'method': 'getheader', 'params': {'height': 0}},
+        ])
+        response = json.loads(urllib2.urlopen(urllib2.Request(self.server_url, data)).read())
+        self.assertEqual(len(response), 3)
+        self.assertTrue(response[0]['result'] > 0)
+        self.assertEqual(response[1], {'result': None, 'error': 'method not found'})
+        self.assertEqual(response[2]['error'], None)
+
+    def test_batch_method_not_string(self):
+        data = json.dumps([{'method': ['getblockcount'], 'params': {}}])
+        response = json.loads(urllib2.urlopen(urllib2.Request(self.server_url, data)).read())
+        self.assertEqual(response, [{'result': None, 'error': 'method not found'}])
+
+
     def test_getblockcount(self):
         response = self._call('getblockcount')
         self.assertTrue(isinstance(response['result'], int))
@@ -60,19 +87,71 @@ class TestTransportHTTP(unittest.TestCase):
         response = self._call('getchunk', {'index': 0})
         self.assertEqual(len(response['result']), 322560)
 
+    def test_getchunk_raw(self):
+        data = json.dumps({'method': 'getchunk', 'params': {'index': 0}})
+        request = urllib2.Request(self.server_url, data, {'Accept': 'application/octet-stream'})
+        response = urllib2.urlopen(request)
+        self.assertEqual(response.info()['Content-Type'], 'application/octet-stream')
+        self.assertEqual(len(response.read()), 161280)
+
+    def test_get_chunk_etag(self):
+        response = urllib2.urlopen(self.server_url + 'chunk/0')
+        self.assertEqual(len(response.read()), 161280)
+        etag = response.info()['ETag']
+
+        request = urllib2.Request(self.server_url + 'chunk/0', headers={'If-None-Match': etag})
+        try:
+            urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 304)
+        else:
+            self.fail('chunk with matched ETag was sent again')
+
+    def test_getheaders(self):
+        response = self._call('getheaders', {'start': 0, 'count': 10})
+        self.assertEqual(len(response['result']), 1600)
+
+    def test_getheaders_out_of_range(self):
+        request = urllib2.Request(self.server_url, json.dumps({
+            'method': 'getheaders', 'params': {'start': 10**9, 'count': 10}}))
+        self._assertError400(request, 'start out of range')
+
     def test_getheader(self):
         response = self._call('getheader', {'height': 0})
-        header = json.loads(response['result'])
-        self.assertEqual(header['prev_block_hash'], '0'*64)
+        self.assertEqual(response['result']['prev_block_hash'], '0'*64)
+
+    def test_waitheaders(self):
+        height = self._call('getblockcount')['result']
+        response = self._call('waitheaders', {'height': height - 1})
+        self.assertEqual(response['result']['height'], height)
+        self.assertEqual(len(response['result']['headers']), 160)
+
+        response = self._call('waitheaders', {'height': height, 'timeout': 0.1})
+        self.assertEqual(response['result']['headers'], '')
 
     def test_germerkle(self):
         txhash = '748a2229c02e2a857a369249bdbd9c91e0338495ac004f1d3e27f9c978050fbd'
-        blockhash = json.loads(self._call('gettxblockhash', {'txhash': txhash})['result'])[0]
+        blockhash = self._call('gettxblockhash', {'txhash': txhash})['result'][0]
 
-        data = json.loads(self._call('getmerkle', {'txhash': txhash, 'blockhash': blockhash})['result'])
+        data = self._call('getmerkle', {'txhash': txhash, 'blockhash': blockhash})['result']
         self.assertEqual(data['block_height'], 244668)
         self.assertEqual(data['pos'], 1)
 
+    def test_getmerkles(self):
+        txhash = '748a2229c02e2a857a369249bdbd9c91e0338495ac004f1d3e27f9c978050fbd'
+        blockhash = self._call('gettxblockhash', {'txhash': txhash})['result'][0]
+
+        data = self._call('getmerkles', {'txhashes': [txhash], 'blockhash': blockhash})['result']
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['block_height'], 244668)
+        self.assertEqual(data[0]['pos'], 1)
+
+    def test_getmerkles_without_blockhash(self):
+        txhash = '748a2229c02e2a857a369249bdbd9c91e0338495ac004f1d3e27f9c978050fbd'
+
+        data = self._call('getmerkles', {'txhashes': [txhash]})['result']
+        self.assertEqual(data[0]['block_height'], 244668)
+
     def test_getrawtransaction(self):
         txhash = 'f0315ffc38709d70ad5647e22048358dd3745f3ce3874223c80a7c92fab0c8ba'
         raw_transaction = '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff0e0420e7494d017f062f503253482fffffffff0100f2052a010000002321021aeaf2f8638a129a3156fbe7e5ef635226b0bafd495ff03afe2c843d7e3a4b51ac00000000'
@@ -84,16 +163,70 @@ class TestTransportHTTP(unittest.TestCase):
         txhash = '748a2229c02e2a857a369249bdbd9c91e0338495ac004f1d3e27f9c978050fbd'
 
         response = self._call('gettxblockhash', {'txhash': txhash})
-        data = json.loads(response['result'])
+        data = response['result']
         self.assertEqual(len(data), 2)
         self.assertEqual(data[1], False)
 
     def test_prefetch(self):
         pass
 
+    def test_metrics(self):
+        self._call('getblockcount')
+        body = urllib2.urlopen(self.server_url + 'metrics').read()
+        self.assertIn('ngcccbase_requests_total{method="getblockcount"}', body)
+        self.assertIn('ngcccbase_request_seconds_bucket{method="getblockcount",le="+Inf"}', body)
+        self.assertIn('ngcccbase_height ', body)
+
     def test_sendrawtransaction(self):
         pass
 
 
+
+class EchoResource(Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        return request.content.read()
+
+
+class TestRequestBody(unittest.TestCase):
+    """Body limit, runs without server"""
+
+    def _post(self, headers, body):
+        channel = Site(EchoResource(), max_body=100).buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        channel.makeConnection(transport)
+        channel.dataReceived('POST / HTTP/1.1\r\nHost: localhost\r\n%s\r\n%s' % (
+            ''.join('%s: %s\r\n' % header for header in headers), body))
+        return transport
+
+    def _chunked(self, chunks):
+        return ''.join('%x\r\n%s\r\n' % (len(chunk), chunk) for chunk in chunks) + '0\r\n\r\n'
+
+    def _assertError413(self, transport):
+        response = transport.value()
+        self.assertTrue(response.startswith('HTTP/1.1 413 '))
+        self.assertEqual(json.loads(response.split('\r\n\r\n', 1)[1]),
+                         {'result': None, 'error': 'request body too large'})
+        self.assertTrue(transport.disconnecting)
+
+    def test_content_length(self):
+        transport = self._post([('Content-Length', '100')], 'x' * 100)
+        self.assertTrue(transport.value().startswith('HTTP/1.1 200 '))
+        self.assertTrue(transport.value().endswith('x' * 100))
+
+        # rejected on headers, before body arrives
+        transport = self._post([('Content-Length', '101'), ('Expect', '100-continue')], '')
+        self._assertError413(transport)
+        self.assertFalse('100 Continue' in transport.value())
+
+    def test_chunked(self):
+        transport = self._post([('Transfer-Encoding', 'chunked')], self._chunked(['x' * 50] * 2))
+        self.assertTrue(transport.value().startswith('HTTP/1.1 200 '))
+
+        transport = self._post([('Transfer-Encoding', 'chunked')], self._chunked(['x' * 50] * 3))
+        self._assertError413(transport)
+
+
 if __name__ == "__main__":
     unittest.main()
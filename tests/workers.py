@@ -0,0 +1,45 @@
+import unittest
+
+from lib import workers
+from lib.backend.chain import InvalidHeader, hash_headers
+from lib.backend.headers import HEADER_SIZE
+
+
+def fail(message):
+    raise InvalidHeader(message)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def _result(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results[0]
+
+    def test_inline(self):
+        pool = workers.WorkerPool(0)
+        self.assertEqual(self._result(pool.run(len, 'abc')), 3)
+        # without process pool jobs run like run() ones
+        raw = '\x01' * HEADER_SIZE * 2
+        self.assertEqual(self._result(pool.run_process(hash_headers, raw)), hash_headers(raw))
+        failure = self._result(pool.run_process(fail, 'bad'))
+        self.assertTrue(failure.check(InvalidHeader))
+
+    def test_call(self):
+        # exceptions come back from pool processes as results
+        self.assertEqual(workers._call(len, ('abc',)), (True, 3))
+        success, e = workers._call(fail, ('bad',))
+        self.assertFalse(success)
+        self.assertTrue(isinstance(e, InvalidHeader))
+
+    def test_processes(self):
+        pool = workers.WorkerPool(0, processes=1)
+        try:
+            success, e = pool._processes.apply(workers._call, (fail, ('bad',)))
+            self.assertFalse(success)
+            self.assertEqual(str(e), 'bad')
+        finally:
+            pool._stop_processes()
+
+
+if __name__ == "__main__":
+    unittest.main()